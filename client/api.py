@@ -0,0 +1,389 @@
+"""
+The client side of the protocol: the connection to the server and its routes.
+No UI here, so it works headless too (see loadgen.py)
+"""
+import base64
+import concurrent.futures
+import contextlib
+import itertools
+import logging
+import queue
+import random
+import socket
+import threading
+import time
+import traceback
+
+from models import *
+from utils import *
+
+
+class ExitResponded(Exception):
+  """Raised when the server responds ok with the exit request (easy to stop the loop)"""
+  pass
+
+
+def exit_resp(sock: socket.socket):
+  raise ExitResponded
+
+
+def handle_server_response(sock: socket.socket, mdata: dict):
+  """
+   Handle messages that come from the server.
+   Message is already parsed in the dict and ready to be handled.
+  """
+
+  # possible items in mdata:
+  mtype = mdata['type']
+  mdata = mdata['data']  # data (raw/json)
+
+  if mtype == MessageType.ERROR:
+    # This is where we can handle the specific error codes with specific messages
+    # for now we just print the error code and message, but we can do more.
+    print(f'Server responded with error: {mdata}')
+
+    # check if the server is still connected
+    # because some errors are critical (like the server shutting down) and we should exit
+    # but some are fine like unknown command or bad arguments.
+    if not is_alive(sock):  # We send an OK? message to the server to check if it's still alive
+      raise ConnectionError
+    return mdata
+
+  elif mtype not in [MessageType.JSON, MessageType.RAW]:
+    print(f'Server response (unstructured): {mdata}')
+    return
+
+  return mdata
+
+
+def send_to_server(sock: socket.socket, msg_type: int, msg_route: str, msg_data):
+  """
+  Send a emssage to the server, following the protocol.
+  Only one thread may use a socket at a time (its NetworkThread), so there is no lock here
+  """
+
+  if msg_type in [MessageType.JSON, MessageType.ERROR]:
+    msg_data = json.dumps(msg_data)
+    msg = build_message('c', msg_type, msg_route, msg_data.encode())
+  else:
+    msg = build_message('c', msg_type, msg_route, msg_data)
+
+  try:
+    sock.sendall(msg)
+
+    if msg_route not in ('ROOM', 'TIME'):  # it's in loop so avoid spamming
+      logging.info(f'[@] Sent message \n\t{msg_type=}\n\t{msg_route=}\n\t{msg_data[:100]=}')
+      # logging.info(msg)
+
+    # we expect a response from the server, so we wait for it
+    resp = fetch_all(sock)
+    mdata = parse_message_by_protocol(resp)
+
+    return handle_server_response(sock, mdata)
+  except ConnectionError:
+    logging.warning('Connection to server was lost')
+    return "EXIT_SIGNAL"
+  except ExitResponded:
+    logging.warning("Server tells you ok, bye bye")
+    return "EXIT_SIGNAL"
+
+  except DisconnectedError:
+    logging.error('Server disconnected during recv()')
+    return "EXIT_SIGNAL"
+
+  except BadMessageError as e:
+    logging.error(f'Server sent bad message ({e})')
+    return "EXIT_SIGNAL"
+
+  except socket.error as err:
+    logging.error(f'Socket Error exit client loop: err:  {err}')
+    return "EXIT_SIGNAL"
+
+  except Exception as err:
+    logging.error(f'General Error %s exit client loop: {err}')
+    logging.error(traceback.format_exc())
+    return "EXIT_SIGNAL"
+
+
+class NetworkThread(threading.Thread):
+  """
+  The only thread that talks with the server. Requests are queued from any thread and get a Future of the response,
+  so the UI never waits on the socket.
+
+  The protocol answers in order, so requests are sent one by one: the ones of the UI (search, add, skip)
+  go before the background ones (room updates, song chunks), a request that was cancelled or expired
+  while waiting is not sent at all. Future callbacks run on this thread, so they must not wait for another request
+  (it would never be sent): whatever talks with the server goes to another thread (Screens.when_done).
+
+  When the connection drops it connects again (waiting longer after every failed try), calls `on_reconnect`
+  and sends the request that was lost again, so the callers only see a slower answer.
+
+  :param sock: The connected socket
+  :param on_disconnect: Called (on this thread) when the connection is lost for good
+  :param connect: Returns a new connected socket (None = no reconnecting)
+  :param on_reconnect: Called with the new socket before anything else is sent on it (to resume the session)
+  :param attempts: Connection tries before giving up
+  :param max_backoff: Maximum seconds between tries
+  """
+
+  UI = 0
+  BACKGROUND = 1
+
+  NOT_RESENT = {'RSKP'}  # the server may have got it before the connection dropped, twice would skip two songs
+
+  def __init__(self, sock: socket.socket, on_disconnect=None, connect=None, on_reconnect=None, attempts: int = 8,
+               max_backoff: float = 8):
+    super().__init__(name='network', daemon=True)
+
+    self.sock = sock
+    self.on_disconnect = on_disconnect
+    self.connect = connect
+    self.on_reconnect = on_reconnect
+    self.attempts = attempts
+    self.max_backoff = max_backoff
+
+    self._queue = queue.PriorityQueue()
+    self._order = itertools.count()  # same priority: first come, first served
+
+  def submit(self, msg_type: int, msg_route: str, msg_data, parse=None, priority: int = BACKGROUND,
+             timeout: float = None) -> concurrent.futures.Future:
+    """
+    Queue a request. The future's result is the response, passed through `parse` unless it is an error.
+    If it is not sent within `timeout` seconds, the future fails with TimeoutError
+    """
+    future = concurrent.futures.Future()
+    deadline = time.monotonic() + timeout if timeout else None
+    self._queue.put((priority, next(self._order), (msg_type, msg_route, msg_data, parse, deadline, future)))
+    return future
+
+  def run(self):
+    while True:
+      msg_type, msg_route, msg_data, parse, deadline, future = self._queue.get()[2]
+
+      if not future.set_running_or_notify_cancel():  # superseded, e.g. an older search
+        continue
+
+      if deadline is not None and time.monotonic() > deadline:
+        future.set_exception(TimeoutError(f'{msg_route} was not sent in time'))
+        continue
+
+      future.sent_at = time.time()  # when it was on the wire (TIME requests are timed)
+      resp = send_to_server(self.sock, msg_type, msg_route, msg_data)
+
+      if resp == "EXIT_SIGNAL" and self._reconnect():
+        future.sent_at = time.time()
+        resp = (send_to_server(self.sock, msg_type, msg_route, msg_data) if msg_route not in self.NOT_RESENT
+                else dict(error="The connection dropped, try again"))
+
+      future.answered_at = time.time()
+
+      if resp == "EXIT_SIGNAL":
+        if self.on_disconnect:
+          self.on_disconnect()
+        future.set_result(dict(error="Server disconnected"))
+        continue
+
+      try:
+        future.set_result(parse(resp) if parse and not (isinstance(resp, dict) and 'error' in resp) else resp)
+      except Exception as e:
+        future.set_exception(e)
+
+
+  def _reconnect(self) -> bool:
+    """Connect to the server again, returns whether it worked"""
+    if self.connect is None:
+      return False
+
+    with contextlib.suppress(OSError):
+      self.sock.close()
+
+    backoff = 0.5
+
+    for attempt in range(1, self.attempts + 1):
+      logging.warning(f'Connection to the server was lost, reconnecting ({attempt}/{self.attempts})')
+
+      try:
+        self.sock = self.connect()
+      except OSError:
+        time.sleep(backoff * random.uniform(0.5, 1))  # not all the clients at once after a server restart
+        backoff = min(backoff * 2, self.max_backoff)
+        continue
+
+      logging.info('Reconnected to the server')
+
+      if self.on_reconnect:
+        self.on_reconnect(self.sock)
+
+      return True
+
+    return False
+
+
+class API:
+  """
+  The server's routes. The methods that the room screen's events call return a Future right away,
+  the rest wait for the answer (they are called from background threads) up to `[network] timeout` seconds.
+  """
+
+  def __init__(self, client: socket.socket, on_disconnect=None):
+    self.client = client
+
+    self.token = None
+    self.room = None  # joined, to join again after a reconnect
+    self.timeout = config.getfloat('network', 'timeout', fallback=10)
+
+    self.network = NetworkThread(client, on_disconnect=on_disconnect, connect=connect_to_server,
+                                 on_reconnect=self._resume,
+                                 attempts=config.getint('network', 'reconnect_attempts', fallback=8),
+                                 max_backoff=config.getfloat('network', 'reconnect_max_backoff', fallback=8))
+    self.network.start()
+    self._latest: dict[str, concurrent.futures.Future] = {}  # route -> last request, for the superseding ones
+
+  def _request(self, msg_type: int, msg_route: str, msg_data, parse=None,
+               supersede: bool = False) -> concurrent.futures.Future:
+    """
+    A UI request, it returns at once. With `supersede`, the previous request of the same route
+    is cancelled if it was not sent yet (and its answer should be ignored if it was)
+    """
+    future = self.network.submit(msg_type, msg_route, msg_data, parse=parse, priority=NetworkThread.UI,
+                                 timeout=self.timeout)
+
+    if supersede:
+      if (previous := self._latest.get(msg_route)) is not None:
+        previous.cancel()
+      self._latest[msg_route] = future
+
+    return future
+
+  def _resume(self, sock: socket.socket):
+    """On a new connection: back into the room (the server keeps our place in it for a while, so nothing changes)"""
+    if self.token is not None and self.room is not None:
+      send_to_server(sock, MessageType.JSON, "JOIN", dict(auth=self.token, room=self.room))
+
+  def _send(self, msg_type: int, msg_route: str, msg_data, parse=None):
+    """A background request, waits for the answer (an error dict if there is none in time)"""
+    future = self.network.submit(msg_type, msg_route, msg_data, parse=parse, timeout=self.timeout)
+
+    try:
+      return future.result(self.timeout)
+    except TimeoutError:
+      future.cancel()  # not sent yet, or the answer is dropped when it comes
+      return dict(error="The server did not answer in time")
+
+  def login(self, username: str, password: str):
+    """
+    Login to your account
+    """
+    resp = self._send(MessageType.JSON, "LOGN", dict(
+      username=username, password=password
+    ))
+
+    if err := resp.get('error'):
+      return False, err
+
+    self.token = resp['auth']
+    return True, None
+
+  def register(self, username: str, password: str):
+    """
+    Register a new account
+    """
+    resp = self._send(MessageType.JSON, "RGST", dict(
+      username=username, password=password
+    ))
+
+    if err := resp.get('error'):
+      return False, err
+
+    self.token = resp['auth']
+    return True, None
+
+  def logout(self):
+    self.token = None
+    self.room = None
+
+  def get_room_info(self, room: int, queue_limit: int = None, listeners_limit: int = None) -> RoomInfo | dict:
+    """
+    The room, with the first `queue_limit` queued songs and `listeners_limit` listeners (the server's page size by default).
+    An error dict if there is no answer or the server refused
+    """
+    resp = self._send(MessageType.JSON, "ROOM", dict(auth=self.token, room=room, queue_limit=queue_limit,
+                                                     listeners_limit=listeners_limit))
+
+    if 'error' in resp:
+      return resp
+
+    return RoomInfo(
+      listeners=resp['listeners'],
+      queue=[Song(**song) for song in resp['queue']],
+      current_song=Song(**resp['current_song']),
+      current_seek=resp['current_seek'],
+      start_time=resp.get('start_time'),
+      listeners_count=resp.get('listeners_count', len(resp['listeners'])),
+      queue_length=resp.get('queue_length', len(resp['queue'])),
+    )
+
+  def get_time(self) -> tuple[float, float | None, float]:
+    """When the request was sent, the server's time (None if it did not answer) and when the answer came"""
+    future = self.network.submit(MessageType.JSON, "TIME", dict(), priority=NetworkThread.UI, timeout=self.timeout)
+
+    try:
+      resp = future.result(self.timeout)
+    except TimeoutError:
+      future.cancel()
+      return 0, None, 0
+
+    return future.sent_at, resp.get('time'), future.answered_at
+
+  def get_current_song(self, have_hash: str = None) -> dict:
+    resp = self._send(MessageType.JSON, "RCUR", dict(auth=self.token, have_hash=have_hash))
+    return resp
+
+  def get_song_chunk(self, offset: int, size: int, song_id: str = None, have_hash: str = None) -> dict:
+    """
+    A part of the current song file, `song_id` makes sure it is still the same song.
+    With `have_hash` (of a cached copy) the server sends no chunk if it is the same audio
+    """
+    return self._send(MessageType.JSON, "RCHK", dict(auth=self.token, offset=offset, size=size, song_id=song_id,
+                                                     have_hash=have_hash))
+
+  def get_next_song(self) -> dict:
+    """The next song, once the server has it ready (fetch it with get_song_chunk)"""
+    return self._send(MessageType.JSON, "RNXT", dict(auth=self.token))
+
+  def list_rooms(self, offset: int = 0, limit: int = 50) -> dict:
+    return self._send(MessageType.JSON, "RLST", dict(auth=self.token, offset=offset, limit=limit))
+
+  def join_room(self, room: int):
+    self.room = room
+    resp = self._send(MessageType.JSON, "JOIN", dict(auth=self.token, room=room))
+    return resp
+
+  def leave_room(self):
+    self.room = None
+    return self._send(MessageType.JSON, "LEAV", dict(auth=self.token))
+
+  def search_songs(self, query: str) -> concurrent.futures.Future:
+    """Future of the list of songs, a new search cancels the previous one"""
+    def parse(resp: dict) -> list[Song]:
+      return [Song(**song) for song in json.loads(base64.b64decode(resp['songs']).decode())]
+
+    return self._request(MessageType.JSON, "SONG", dict(auth=self.token, query=query), parse=parse, supersede=True)
+
+  def send_add_to_queue(self, song: Song) -> concurrent.futures.Future:
+    return self._request(MessageType.JSON, "RQUE", dict(auth=self.token, song_id=song.id))
+
+  def skip_song(self) -> concurrent.futures.Future:
+    return self._request(MessageType.JSON, "RSKP", dict(auth=self.token))
+
+
+def connect_to_server() -> socket.socket:
+  """A new connection to the server (raises OSError if it cannot connect)"""
+  ip = SERVER_IP
+
+  if ip == '0.0.0.0':
+    ip = '127.0.0.1'
+
+  sock = socket.create_connection((ip, SERVER_PORT), timeout=config.getfloat('network', 'timeout', fallback=10))
+  sock.settimeout(None)
+  return sock
@@ -0,0 +1,96 @@
+import collections
+import contextlib
+import os
+import shutil
+import threading
+
+
+class AudioCache:
+  """
+  Songs that were already played, on the disk, so playing them again (in any room or session) needs no download.
+
+  Files are named <track id>-<sha256 of the content>.mp3, the server tells which hash the room plays,
+  so an old version of a track is never played by mistake.
+  The least recently played songs are deleted when the cache is bigger than `max_bytes`.
+
+  :param path: The cache directory
+  :param max_bytes: Maximum size of all the cached songs
+  """
+
+  def __init__(self, path: str = 'cache', max_bytes: int = 512 * 1024 * 1024):
+    self.path = path
+    self.max_bytes = max_bytes
+
+    os.makedirs(path, exist_ok=True)
+
+    self._lock = threading.Lock()
+    self._entries: collections.OrderedDict[str, tuple[str, int]] = collections.OrderedDict()  # id -> (hash, size)
+    self._size = 0
+
+    self._load()
+
+  def _file(self, song_id: str, song_hash: str) -> str:
+    return os.path.join(self.path, f'{song_id}-{song_hash}.mp3')
+
+  def _load(self):
+    """Index the files already in the cache directory, least recently used first"""
+    files = []
+
+    for name in os.listdir(self.path):
+      song_id, _, rest = name.rpartition('-')
+
+      if not song_id or not rest.endswith('.mp3'):
+        continue
+
+      stat = os.stat(os.path.join(self.path, name))
+      files.append((stat.st_mtime, song_id, rest[:-len('.mp3')], stat.st_size))
+
+    for _, song_id, song_hash, size in sorted(files):
+      self._remove(song_id)  # an older version of the same track
+      self._entries[song_id] = (song_hash, size)
+      self._size += size
+
+  def get(self, song_id: str) -> tuple[str, str] | None:
+    """The hash and the file of a cached track (marks it as recently used)"""
+    with self._lock:
+      if (entry := self._entries.get(song_id)) is None:
+        return None
+
+      self._entries.move_to_end(song_id)
+      path = self._file(song_id, entry[0])
+
+    with contextlib.suppress(OSError):
+      os.utime(path)  # the order survives a restart
+
+    return entry[0], path
+
+  def put(self, song_id: str, song_hash: str, source: str):
+    """Copy a downloaded song into the cache (the source file is left alone, it may still be playing)"""
+    size = os.path.getsize(source)
+
+    if size > self.max_bytes:
+      return
+
+    tmp = self._file(song_id, song_hash) + '.tmp'
+    shutil.copyfile(source, tmp)
+
+    with self._lock:
+      self._remove(song_id)
+      os.replace(tmp, self._file(song_id, song_hash))
+      self._entries[song_id] = (song_hash, size)
+      self._size += size
+
+      while self._size > self.max_bytes:
+        self._remove(next(iter(self._entries)))
+
+  def _remove(self, song_id: str):
+    if (entry := self._entries.pop(song_id, None)) is None:
+      return
+
+    self._size -= entry[1]
+
+    with contextlib.suppress(OSError):  # still playing (on windows), it is evicted again after a restart
+      os.remove(self._file(song_id, entry[0]))
+
+  def __len__(self):
+    return len(self._entries)
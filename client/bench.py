@@ -0,0 +1,188 @@
+"""
+Performance benchmarks of the client UI (no server and no window needed, the Flet messages are only measured).
+
+Usage:
+  python bench.py <benchmark> [options]   (python bench.py -h for the list)
+"""
+import argparse
+import json
+import os
+import time
+
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')  # no sound card needed
+
+import flet as ft
+from flet_core.local_connection import LocalConnection
+from flet_core.protocol import CommandEncoder, PageCommandResponsePayload, PageCommandsBatchResponsePayload
+
+from models import Song, RoomInfo
+
+
+class MeasuredConnection(LocalConnection):
+  """A Flet connection that answers like the real one but only counts the messages it would send"""
+
+  def __init__(self):
+    super().__init__()
+    self.messages = 0
+    self.bytes = 0
+
+  def _measure(self, message):
+    self.messages += 1
+    self.bytes += len(json.dumps(message, cls=CommandEncoder, separators=(',', ':')))
+
+  def send_command(self, session_id, command):
+    result, message = self._process_command(command)
+    if message:
+      self._measure(message)
+    return PageCommandResponsePayload(result=result, error="")
+
+  def send_commands(self, session_id, commands):
+    results = []
+    for command in commands:
+      result, message = self._process_command(command)
+      if command.name in ["add", "get"]:
+        results.append(result)
+      if message:
+        self._measure(message)
+    return PageCommandsBatchResponsePayload(results=results, error="")
+
+
+class FakeAPI:
+  """
+  A room with a long queue where, every tick, one song is over and another one is queued
+  (what a busy room looks like to the client)
+  """
+
+  def __init__(self, queue: int, listeners: int):
+    self.token = 'bench'
+    self.next_id = queue
+    self.queue = [self.song(i) for i in range(queue)]
+    self.listeners = [f'user{i}' for i in range(listeners)]
+
+  @staticmethod
+  def song(i: int) -> Song:
+    return Song(id=f'song{i}', title=f'Song {i}', artist=f'Artist {i % 50}', image_url=f'https://i.scdn.co/image/{i}')
+
+  def tick(self):
+    self.queue.pop(0)
+    self.queue.append(self.song(self.next_id))
+    self.next_id += 1
+
+  def get_room_info(self, room: int, queue_limit: int = None, listeners_limit: int = None) -> RoomInfo:
+    """Like the server: a page of the queue and of the listeners (50 by default)"""
+    return RoomInfo(listeners=self.listeners[:listeners_limit or 50], queue=self.queue[:queue_limit or 50],
+                    current_song=Song(), listeners_count=len(self.listeners), queue_length=len(self.queue))
+
+  def get_time(self):
+    now = time.time()
+    return now, now, now
+
+  def join_room(self, room: int):
+    return {"status": "ok"}
+
+  def leave_room(self):
+    return {"status": "ok"}
+
+
+def make_page() -> tuple[ft.Page, MeasuredConnection]:
+  conn = MeasuredConnection()
+  page = ft.Page(conn, 'bench')
+  page._set_attr('width', 1600)
+  page._set_attr('height', 900)
+  return page, conn
+
+
+def bench_room(args):
+  """CPU time and Flet traffic of the room screen's update tick with a long queue"""
+  from client import Screens
+
+  def rebuild(screens: Screens):
+    """The tick as it was: every card and listener is created again, three separate updates"""
+    info = screens.api.get_room_info(screens.current_room, queue_limit=args.queue)
+    screens.queue_component.content.controls[2:] = [
+      SongCard(song, alignment="start")
+      for song in screens.api.get_room_info(screens.current_room, queue_limit=args.queue).queue
+    ]
+    screens.queue_component.content.controls[1].value = screens.get_queue_text(info)
+    screens.queue_component.update()
+    screens.listeners_component.content.controls[2:] = [ft.Text(listener, size=20) for listener in info.listeners]
+    screens.listeners_component.content.controls[1].value = screens.get_listeners_text(info)
+    screens.listeners_component.update()
+    screens.current_song_component.update()
+
+  from components import SongCard
+
+  for name, tick in [('rebuild everything', rebuild), ('keyed diff', Screens.update_room_info)]:
+    page, conn = make_page()
+    api = FakeAPI(args.queue, args.listeners)
+    screens = Screens(page, api=api)
+    screens.thumbnails = None  # no album art downloads, the fake urls lead nowhere
+
+    start = time.perf_counter()
+    screens.room(1)
+    opened = time.perf_counter() - start
+
+    conn.messages = conn.bytes = 0
+    cpu = time.process_time()
+
+    for _ in range(args.ticks):
+      api.tick()
+      tick(screens)
+
+    cpu = time.process_time() - cpu
+
+    print(f'{name:<20} open {opened * 1000:8.1f}ms  tick cpu {cpu / args.ticks * 1000:8.2f}ms  '
+          f'{conn.messages / args.ticks:6.1f} messages/tick  {conn.bytes / args.ticks / 1024:9.1f}KB/tick')
+
+
+def bench_open(args):
+  """Room screen open time, memory and amount of controls as the queue grows"""
+  import gc
+  import tracemalloc
+  from client import Screens
+
+  for queue in args.queue:
+    page, conn = make_page()
+    screens = Screens(page, api=FakeAPI(queue, args.listeners))
+    screens.thumbnails = None
+
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    screens.room(1)
+    opened = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f'{queue:>7} songs  open {opened * 1000:8.1f}ms  {memory / 1024:9.1f}KB  {len(page._index):6} controls  '
+          f'{conn.bytes / 1024:8.1f}KB sent')
+
+
+BENCHMARKS = {
+  "room": (bench_room, lambda p: (
+    p.add_argument('--queue', type=int, default=500, help='songs in the queue'),
+    p.add_argument('--listeners', type=int, default=50),
+    p.add_argument('--ticks', type=int, default=50, help='updates to measure'),
+  )),
+  "open": (bench_open, lambda p: (
+    p.add_argument('--queue', type=int, nargs='+', default=[10, 500, 10_000], help='queue lengths to measure'),
+    p.add_argument('--listeners', type=int, default=1000),
+  )),
+}
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Client performance benchmarks')
+  subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+  for name, (fun, add_arguments) in BENCHMARKS.items():
+    sub = subparsers.add_parser(name, help=fun.__doc__)
+    add_arguments(sub)
+    sub.set_defaults(fun=fun)
+
+  args = parser.parse_args()
+  args.fun(args)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,12 +1,9 @@
-import base64
-import io
+import concurrent.futures
 import logging
 import socket
 import threading
 import time
-import traceback
 
-import flet
 import pygame.mixer
 from flet import Text
 import coloredlogs
@@ -15,183 +12,11 @@ coloredlogs.install(level='INFO')
 
 from models import *
 from components import *
-
-
-class ExitResponded(Exception):
-  """Raised when the server responds ok with the exit request (easy to stop the loop)"""
-  pass
-
-
-def exit_resp(sock: socket.socket):
-  raise ExitResponded
-
-
-socket_lock = threading.Lock()
-
-
-def handle_server_response(sock: socket.socket, mdata: dict):
-  """
-   Handle messages that come from the server.
-   Message is already parsed in the dict and ready to be handled.
-  """
-
-  route = mdata['route']
-  mtype = mdata['type']
-
-  # possible items in mdata:
-  mtype = mdata['type']
-  mdata = mdata['data']  # data (raw/json)
-
-  if mtype == MessageType.ERROR:
-    # This is where we can handle the specific error codes with specific messages
-    # for now we just print the error code and message, but we can do more.
-    print(f'Server responded with error: {mdata}')
-
-    # check if the server is still connected
-    # because some errors are critical (like the server shutting down) and we should exit
-    # but some are fine like unknown command or bad arguments.
-    if not is_alive(sock):  # We send an OK? message to the server to check if it's still alive
-      raise ConnectionError
-    return mdata
-
-  elif mtype not in [MessageType.JSON, MessageType.RAW]:
-    print(f'Server response (unstructured): {margs}')
-    return
-
-  # print the response
-  # print(f'Server responded to {route}:\n\t{mdata=}')
-
-  return mdata
-
-
-def send_to_server(sock: socket.socket, msg_type: int, msg_route: str, msg_data):
-  """
-  Send a emssage to the server, following the protocol
-  """
-
-  with socket_lock:
-    if msg_type in [MessageType.JSON, MessageType.ERROR]:
-      msg_data = json.dumps(msg_data)
-      msg = f"c{msg_type}{msg_route}{msg_data}".encode()
-    else:
-      msg = f"c{msg_type}{msg_route}".encode() + msg_data
-    length_header = length_header_send(msg)
-
-    try:
-      sock.send(length_header + msg)
-
-      if msg_route != 'ROOM':  # it's in loop so avoid spamming
-        logging.info(f'[@] Sent message \n\t{msg_type=}\n\t{msg_route=}\n\t{msg_data[:100]=}')
-        # logging.info(length_header + msg)
-
-      # we expect a response from the server, so we wait for it
-      resp = fetch_all(sock)
-      mdata = parse_message_by_protocol(resp)
-
-      return handle_server_response(sock, mdata)
-    except ConnectionError:
-      logging.warning('Connection to server was lost')
-      return "EXIT_SIGNAL"
-    except ExitResponded:
-      logging.warning("Server tells you ok, bye bye")
-      return "EXIT_SIGNAL"
-
-    except DisconnectedError:
-      logging.error(f'Server disconnected during recv()')
-      return "EXIT_SIGNAL"
-
-    except BadMessageError as e:
-      logging.error(f'Server sent bad message ({e})')
-      return "EXIT_SIGNAL"
-
-    except socket.error as err:
-      logging.error(f'Socket Error exit client loop: err:  {err}')
-      return "EXIT_SIGNAL"
-
-    except Exception as err:
-      logging.error(f'General Error %s exit client loop: {err}')
-      logging.error(traceback.format_exc())
-      return "EXIT_SIGNAL"
-
-
-class API:
-  def __init__(self, client: socket.socket, page: flet.Page):
-    self.client = client
-    self.page = page
-
-    self.token = None
-
-  def _send(self, msg_type: int, msg_route: str, msg_data):
-    resp = send_to_server(self.client, msg_type, msg_route, msg_data)
-
-    if resp == "EXIT_SIGNAL":
-      self.page.window_close()
-      return dict(error="Server disconnected")
-
-    return resp
-
-  def login(self, username: str, password: str):
-    """
-    Login to your account
-    """
-    resp = self._send(MessageType.JSON, "LOGN", dict(
-      username=username, password=password
-    ))
-
-    if err := resp.get('error'):
-      return False, err
-
-    self.token = resp['auth']
-    return True, None
-
-  def register(self, username: str, password: str):
-    """
-    Register a new account
-    """
-    resp = self._send(MessageType.JSON, "RGST", dict(
-      username=username, password=password
-    ))
-
-    if err := resp.get('error'):
-      return False, err
-
-    self.token = resp['auth']
-    return True, None
-
-  def logout(self):
-    self.token = None
-
-  def get_room_info(self, room: int) -> RoomInfo:
-    resp = self._send(MessageType.JSON, "ROOM", dict(auth=self.token, room=room))
-
-    return RoomInfo(
-      listeners=resp['listeners'],
-      queue=[Song(**song) for song in resp['queue']],
-      current_song=Song(**resp['current_song']),
-      current_seek=resp['current_seek'],
-    )
-
-  def get_current_song(self) -> dict:
-    resp = self._send(MessageType.JSON, "RCUR", dict(auth=self.token))
-    return resp
-
-  def join_room(self, room: int):
-    resp = self._send(MessageType.JSON, "JOIN", dict(auth=self.token, room=room))
-    return resp
-
-  def leave_room(self):
-    return self._send(MessageType.JSON, "LEAV", dict(auth=self.token))
-
-  def search_songs(self, query: str) -> list[Song]:
-    resp = self._send(MessageType.JSON, "SONG", dict(auth=self.token, query=query))
-
-    return [Song(**song) for song in json.loads(base64.b64decode(resp['songs']).decode())]
-
-  def send_add_to_queue(self, song: Song):
-    return self._send(MessageType.JSON, "RQUE", dict(auth=self.token, song_id=song.id))
-
-  def skip_song(self):
-    return self._send(MessageType.JSON, "RSKP", dict(auth=self.token))
+from api import API, connect_to_server
+from clock import ServerClock
+from playback import Player
+from search_cache import SearchCache
+from thumbnails import ThumbnailCache
 
 
 class Screens:
@@ -209,15 +34,25 @@ class Screens:
 
     self.current_room = None
     self.queue_component: ft.Container = None
+    self.queue_list: LazyList = None
     self.listeners_component: ft.Container = None
+    self.listeners_list: LazyList = None
     self.current_song_component: SongCard = None
-    self.search_results_component: ft.Column = None
+    self.search_hint: ft.Text = None
+    self.search_results_component: LazyList = None
+    self.update_lock = threading.Lock()  # the room is updated by the events thread and by the UI events
     self.search_query_ref: ft.Ref = None
+    self.search_future: concurrent.futures.Future = None  # the search whose results should be shown
+    self.search_timer: threading.Timer = None  # searches once the typing pauses
+    self.search_cache = SearchCache(config.getint('search', 'cache_size', fallback=200))
+    self.search_debounce = config.getint('search', 'debounce_ms', fallback=300) / 1000
 
     # audio manager
     pygame.mixer.init()
-
-    self.currently_playing = None
+    self.player = Player.from_config(api)
+    self.clock = ServerClock.from_config(api)  # the songs' start times are on the server's clock
+    self.clock.start()
+    self.thumbnails = ThumbnailCache.from_config()
 
     def do_logout(e: ControlEvent):
       self.api.logout()
@@ -311,9 +146,10 @@ class Screens:
     self.current_room = None
     self.api.leave_room()
 
-    if pygame.mixer.music.get_busy():
-      pygame.mixer.music.stop()
-      self.currently_playing = None
+    self.player.stop()
+
+    if self.search_timer is not None:
+      self.search_timer.cancel()
 
   def home(self, *args, **kwargs):
     self.page.clean()
@@ -323,142 +159,249 @@ class Screens:
       logging.info(f"Enter room {room}")
       self.room(room)
 
+    def on_room_number(e: ControlEvent):
+      if room_number.value.isdigit() and int(room_number.value) > 0:
+        on_room_click(e, room=int(room_number.value))
+
+    # the rooms people are in, or the first 6 rooms when nobody is around
+    resp = self.api.list_rooms()
+    rooms = resp.get('rooms') or [dict(id=i, listeners=0) for i in range(1, 6 + 1)]
+
     room_buttons = [
-      ft.FilledButton(f"Room {i}", icon=ft.icons.LIBRARY_MUSIC, on_click=functools.partial(on_room_click, room=i),
-                      height=80, width=200)
-      for i in range(1, 6 + 1)
+      ft.FilledButton(f"Room {room['id']} ({room['listeners']} 🎧)", icon=ft.icons.LIBRARY_MUSIC,
+                      on_click=functools.partial(on_room_click, room=room['id']), height=80, width=200)
+      for room in rooms
     ]
 
+    room_number = ft.TextField(label="Room number", width=200, on_submit=on_room_number,
+                               keyboard_type=ft.KeyboardType.NUMBER)
+
     self.page.add(
       self.logged_title,
       ft.Divider(height=20),
-      ft.Row(room_buttons[:3], alignment=ft.MainAxisAlignment.SPACE_AROUND, height=self.page.height / 3),
-      ft.Row(room_buttons[3:], alignment=ft.MainAxisAlignment.SPACE_AROUND, height=self.page.height / 3),
+      ft.Row([
+        room_number, IconButton(icon=ft.icons.LOGIN, tooltip="Go to room", on_click=on_room_number)
+      ], alignment="center"),
+      ft.Row(room_buttons, alignment=ft.MainAxisAlignment.SPACE_AROUND, wrap=True, scroll=ft.ScrollMode.AUTO,
+             height=self.page.height * 2 / 3),
     )
 
   def update_room_info(self):
     """
     Update the UI of the room screen when new data is available
     """
-    if self.current_room:
+    if not self.current_room or self.queue_list is None:
+      return
+
+    with self.update_lock:
       logging.debug("updating room")
 
-      info: RoomInfo = self.api.get_room_info(self.current_room)
-      # print(info)
+      # as many songs and listeners as the lists show
+      info: RoomInfo = self.api.get_room_info(self.current_room, queue_limit=self.queue_list.shown,
+                                              listeners_limit=self.listeners_list.shown)
+
+      if isinstance(info, dict):  # no answer this time, the next update tries again
+        logging.warning(f"Cannot update the room: {info['error']}")
+        return
 
-      if self.queue_component:
-        self.queue_component.content.controls[2:] = [
-          SongCard(song, alignment="start") for song in self.api.get_room_info(self.current_room).queue
-        ]
-        self.queue_component.content.controls[1].value = self.get_queue_text(info)
-        self.queue_component.update()
+      changed = []  # the components to send, all in one update
 
-      if self.listeners_component:
-        self.listeners_component.content.controls[2:] = [
-          ft.Text(listener, size=20) for listener in info.listeners
-        ]
-        self.listeners_component.content.controls[1].value = self.get_listeners_text(info)
-        self.listeners_component.update()
+      if self.queue_component and self.sync_queue(info):
+        changed.append(self.queue_component)
 
-      if self.current_song_component:
-        self.current_song_component.update_song(info)
+      if self.listeners_component and self.sync_listeners(info):
+        changed.append(self.listeners_component)
+
+      if self.current_song_component and self.current_song_component.update_song(info.current_song):
+        changed.append(self.current_song_component)
+
+      if changed:
+        self.page.update(*changed)
 
       if info.current_song.id is None:
         # stop if anything is running
-        if pygame.mixer.music.get_busy():
-          pygame.mixer.music.stop()
+        if self.player.current is not None:
+          self.player.stop()
 
-      if info.current_song.id and self.currently_playing != info.current_song:
-        js = self.api.get_current_song()
-        song_base64 = js['song_base64']
-
-        self.currently_playing = info.current_song
-        buffer = io.BytesIO(base64.b64decode(song_base64))
-        buffer.seek(0)
-        pygame.mixer.music.load(buffer)
-        self.currently_playing = info.current_song
-        pygame.mixer.music.play()
-        pygame.mixer.music.set_pos(info.current_seek)
+      # a new song (not while it is loading ⏳, it has no id yet)
+      if info.current_song.id and self.player.current != info.current_song:
+        self.player.play(info.current_song, self.started_at(info))
+      elif info.current_song.id:
+        self.player.correct_drift(self.started_at(info))  # with the latest clock estimate
 
       # self.room(self.current_room)
 
+  def started_at(self, info: RoomInfo) -> float:
+    """When the room started its current song, on our clock"""
+    if info.start_time is None:  # an older server, only the seek at the time it answered
+      return time.time() - info.current_seek
+
+    return self.clock.to_local(info.start_time)
+
+  def sync_queue(self, info: RoomInfo) -> bool:
+    """Make the queue pane show the room's queue (only the changed songs are touched). Returns whether it changed"""
+    column = self.queue_component.content
+    text = self.get_queue_text(info)
+
+    changed = self.queue_list.set_items(info.queue, total=info.queue_length)
+
+    if column.controls[1].value != text:
+      column.controls[1].value = text
+      changed = True
+
+    return changed
+
+  def sync_listeners(self, info: RoomInfo) -> bool:
+    """Like sync_queue, for the listeners pane"""
+    column = self.listeners_component.content
+    text = self.get_listeners_text(info)
+
+    changed = self.listeners_list.set_items(info.listeners, total=info.listeners_count)
+
+    if column.controls[1].value != text:
+      column.controls[1].value = text
+      changed = True
+
+    return changed
+
+  def search_typed(self, e: ControlEvent):
+    """
+    The search box changed: show what is already known about the query right away,
+    and search once the typing pauses
+    """
+    if self.search_timer is not None:
+      self.search_timer.cancel()
+
+    query = self.search_query_ref.current.value
+
+    if not query or self.search_cache.get(query) is not None:
+      return self.search_song(e)
+
+    self.search_future = None  # the results of an older query are not wanted anymore
+    self.show_search_results(self.search_cache.preview(query), "Searching...")
+
+    self.search_timer = threading.Timer(self.search_debounce, self.search_song, args=(e,))
+    self.search_timer.daemon = True
+    self.search_timer.start()
+
   def search_song(self, e: ControlEvent):
     """
     Search for a song and display the results.
-    The results come from the Spotify API
+    The results come from the Spotify API (or from the searches cache)
     """
+    if self.search_timer is not None:
+      self.search_timer.cancel()
 
     query = self.search_query_ref.current.value
 
+    if not query or not query.strip():  # only spaces, nothing to ask the server
+      self.search_future = None
+      return self.show_search_results([], "Search for something...")
+
+    if (songs := self.search_cache.get(query)) is not None:
+      self.search_future = None
+      return self.show_search_results(songs, "No results")
+
     logging.info(f"Search query: {query}")
 
-    if not query:
-      self.search_results_component.controls = [
-        ft.Text("Search for something...", color=ft.colors.GREY, size=15, italic=True)
-      ]
-    else:
-      song_results = self.api.search_songs(query)
+    if not self.search_results_component.controls:
+      self.search_hint.value = "Searching..."
+      self.search_hint.visible = True
+      self.search_hint.update()
 
-      if len(song_results) == 0:
-        self.search_results_component.controls = [ft.Text("No results", size=15, color=ft.colors.GREY, italic=True)]
-      else:
-        self.search_results_component.controls = [
-          ft.Row(
-            [
-              ft.IconButton(icon=ft.icons.ADD, tooltip="Add song",
-                            on_click=functools.partial(self.add_to_queue, song=song),
-                            icon_color="white", bgcolor="green"),
-              ft.Container(SongCard(song, alignment="start"), margin=ft.margin.only(right=20, left=20)),
-            ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN, scroll=ft.ScrollMode.AUTO)
-          for song in song_results
-        ]
-    #
-    self.search_results_component.update()
+    self.search_future = future = self.api.search_songs(query)
+
+    def done(future: concurrent.futures.Future):
+      if future is not self.search_future:  # the query changed meanwhile
+        return
+
+      if isinstance(future.exception(), TimeoutError):
+        return self.show_search_results([], "The server did not answer in time")
+
+      resp = future.result()
+      if isinstance(resp, dict):
+        return self.show_search_results([], resp.get('error', "No results"))
+
+      self.search_cache.put(query, resp)
+      self.show_search_results(resp, "No results")
+
+    self.when_done(future, lambda future: future.cancelled() or done(future))
+
+  @staticmethod
+  def when_done(future: concurrent.futures.Future, fun):
+    """
+    Call fun(future) when the request is answered, on its own thread: the futures are completed on the network thread,
+    and a callback there that sends a request (e.g. update_room_info) would wait for itself
+    """
+    future.add_done_callback(lambda future: threading.Thread(target=fun, args=(future,), daemon=True).start())
+
+  def show_search_results(self, song_results: list[Song], hint: str):
+    self.search_hint.value = hint
+    self.search_hint.visible = not song_results
+    self.search_results_component.set_items(song_results)
+    self.page.update(self.search_hint, self.search_results_component)
+
+  def queue_row(self, song: Song) -> SongCard:
+    return SongCard(song, alignment="start", thumbnails=self.thumbnails)
+
+  def search_result_row(self, song: Song) -> ft.Row:
+    return ft.Row(
+      [
+        ft.IconButton(icon=ft.icons.ADD, tooltip="Add song",
+                      on_click=functools.partial(self.add_to_queue, song=song),
+                      icon_color="white", bgcolor="green"),
+        ft.Container(SongCard(song, alignment="start", thumbnails=self.thumbnails),
+                     margin=ft.margin.only(right=20, left=20)),
+      ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN, scroll=ft.ScrollMode.AUTO)
 
   def skip_song(self, e: ControlEvent):
     logging.info("Skip song")
 
-    # if current song is loading ⏳, no skip
-    info = self.api.get_room_info(self.current_room)
+    def done(future: concurrent.futures.Future):
+      if isinstance(future.exception(), TimeoutError):
+        return self.show_dialog("The server did not answer in time")
 
-    if info.current_song.title.startswith('⏳'):
-      return self.show_dialog("Cannot skip while loading the song")
+      # if current song is loading ⏳, no skip
+      if future.result().get('error') == 'Song is loading':
+        return self.show_dialog("Cannot skip while loading the song")
 
-    self.api.skip_song()
+      self.update_room_info()
 
-    self.update_room_info()
+    self.when_done(self.api.skip_song(), done)
 
   def add_to_queue(self, e: ControlEvent, song: Song):
     logging.info(f"Add song to queue: {song.title}")
 
-    info = self.api.get_room_info(self.current_room)
+    def done(future: concurrent.futures.Future):
+      if isinstance(future.exception(), TimeoutError):
+        return self.show_dialog("The server did not answer in time")
 
-    # if last in queue == current song, dont add
-    # if len(info.queue) > 0 and info.queue[-1] == info.current_song:
-    #   return self.show_dialog("Cannot add the same song in a row")
+      resp = future.result()
 
-    resp = self.api.send_add_to_queue(song)
+      if resp.get('error') == 'Song is already in the queue':
+        return self.show_dialog("This song is already in the queue")
+      elif err := resp.get('error'):
+        return self.show_dialog(err)
 
-    if resp.get('error') == 'Song is already in the queue':
-      return self.show_dialog("Cannot add the same song in a row")
+      self.update_room_info()
 
-    self.update_room_info()
+    self.when_done(self.api.send_add_to_queue(song), done)
 
   def get_listeners_text(self, info: RoomInfo):
-    if len(info.listeners) == 0:
+    if info.listeners_count == 0:
       return "No other listeners"
-    elif len(info.listeners) == 1:
+    elif info.listeners_count == 1:
       return "1 other listener"
     else:
-      return f"{len(info.listeners)} other listeners"
+      return f"{info.listeners_count} other listeners"
 
   def get_queue_text(self, info: RoomInfo):
-    if len(info.queue) == 0:
+    if info.queue_length == 0:
       return "No songs in queue"
-    elif len(info.queue) == 1:
+    elif info.queue_length == 1:
       return "1 queued song"
     else:
-      return f"{len(info.queue)} queued songs"
+      return f"{info.queue_length} queued songs"
 
   def room(self, room: int):
     try:
@@ -467,39 +410,53 @@ class Screens:
 
       self.api.join_room(room)
 
+      self.queue_list = self.listeners_list = None  # not built yet, the updates wait
+
       info: RoomInfo = self.api.get_room_info(room)
 
+      if isinstance(info, dict):
+        return self.show_dialog(f"Cannot open the room: {info['error']}", on_close=self.home)
+
       # print('playing first', info)
 
       # layout:
       # TOP: current song
       # REST: [LEFT: queue, MIDDLE: add song, RIGHT: listeners]
 
+      # the lists build only the rows that are scrolled to, and ask the server for more when needed
+      self.queue_list = LazyList(item_key=lambda song: song.id, make_row=self.queue_row,
+                                 on_more=self.update_room_info, expand=True)
+      self.listeners_list = LazyList(item_key=lambda listener: listener,
+                                     make_row=lambda listener: ft.Text(listener, size=20),
+                                     page_size=50, on_more=self.update_room_info, expand=True)
+
       self.queue_component = ft.Container(
         ft.Column([
           ft.Text("Queue", size=20, weight="bold", style=ft.TextStyle(decoration=ft.TextDecoration.UNDERLINE)),
-          ft.Text(value=self.get_queue_text(info), size=15, color=ft.colors.GREY),
-          *[SongCard(song, alignment="start") for song in info.queue]
-        ], horizontal_alignment="center", width=self.page.width * 0.15, scroll=ft.ScrollMode.AUTO),
+          ft.Text(size=15, color=ft.colors.GREY),
+          self.queue_list,
+        ], horizontal_alignment="center", width=self.page.width * 0.15),
         border_radius=10, border=ft.border.all(2, ft.colors.BLUE), padding=20, height=self.page.height / 2
       )
 
       self.listeners_component = ft.Container(
         ft.Column([
           ft.Text("Listeners", size=20, weight="bold", style=ft.TextStyle(decoration=ft.TextDecoration.UNDERLINE)),
-          ft.Text(value=self.get_listeners_text(info), size=15, color=ft.colors.GREY),
-          *[
-            ft.Text(listener, size=20) for listener in info.listeners
-          ]
+          ft.Text(size=15, color=ft.colors.GREY),
+          self.listeners_list,
         ], horizontal_alignment="center", width=self.page.width * 0.15), border_radius=10,
         border=ft.border.all(2, ft.colors.BLUE), padding=20, height=self.page.height / 2
       )
 
-      self.current_song_component = SongCard(info.current_song, is_main=True, alignment="center")
+      self.sync_queue(info)
+      self.sync_listeners(info)
+
+      self.current_song_component = SongCard(info.current_song, is_main=True, alignment="center",
+                                              thumbnails=self.thumbnails)
 
-      self.search_results_component = ft.Column([
-        ft.Text("Search for something...", color=ft.colors.GREY, size=15, italic=True),
-      ], scroll=ft.ScrollMode.AUTO)
+      self.search_hint = ft.Text("Search for something...", color=ft.colors.GREY, size=15, italic=True)
+      self.search_results_component = LazyList(item_key=lambda song: song.id, make_row=self.search_result_row,
+                                               page_size=10, expand=True)
 
       self.search_query_ref = ft.Ref[ft.TextField]()
 
@@ -515,13 +472,13 @@ class Screens:
             ft.Text("Add song", size=20, weight="bold", style=ft.TextStyle(decoration=ft.TextDecoration.UNDERLINE)),
             ft.Row([
               ft.TextField(label="Search song", width=self.page.width * 0.3, hint_text="Song name",
-                           ref=self.search_query_ref),
+                           ref=self.search_query_ref, on_change=self.search_typed, on_submit=self.search_song),
               IconButton(icon=ft.icons.SEARCH, tooltip="Search", icon_size=30,
                          on_click=self.search_song),
             ], alignment="center"),
             ft.Text("Search results", size=15, color=ft.colors.GREY),
             ft.Container(
-              self.search_results_component,
+              ft.Column([self.search_hint, self.search_results_component]),
               border=ft.border.all(1, ft.colors.GREY),
               padding=20, height=self.page.height * 0.3,
               width=self.page.width * 0.35
@@ -539,20 +496,8 @@ class Screens:
       )
 
       if info.current_song.id:
-        # if busy stop
-        if pygame.mixer.music.get_busy():
-          pygame.mixer.music.stop()
-
-        logging.info('loading song from buffer')
-        js = self.api.get_current_song()
-        song_base64 = js['song_base64']
-        # print(song_base64[:50])
-        buffer = io.BytesIO(base64.b64decode(song_base64))
-        buffer.seek(0)
-        pygame.mixer.music.load(buffer)
-        self.currently_playing = info.current_song
-        pygame.mixer.music.play()
-        pygame.mixer.music.set_pos(info.current_seek)
+        logging.info('streaming the current song')
+        self.player.play(info.current_song, self.started_at(info))
 
     except Exception as e:
       logging.error(f"Error in room: {e}")
@@ -563,7 +508,10 @@ def events_listener(client: socket.socket, page: ft.Page, screens: Screens, api:
   while True:
     if api.token and screens.current_room is not None:
       # update data
-      screens.update_room_info()
+      try:
+        screens.update_room_info()
+      except Exception as e:  # e.g. the server did not answer in time, try again next time
+        logging.warning(f'Cannot update the room: {e}')
 
     time.sleep(1)
 
@@ -576,32 +524,25 @@ def main():
   Main client - handle socket and load ui
   """
 
-  sock = socket.socket()
-  ip = SERVER_IP
-
-  if ip == '0.0.0.0':
-    ip = '127.0.0.1'
-
-  port = SERVER_PORT
-
   try:
-    sock.connect((ip, port))
-    logging.info(f"Connected to the server {ip}:{port}")
+    sock = connect_to_server()
+    logging.info(f"Connected to the server {SERVER_IP}:{SERVER_PORT}")
   except Exception as e:
-    logging.error(f"Error while trying to connect. Check IP or port -- {ip}:{port}")
+    logging.error(f"Error while trying to connect. Check IP or port -- {SERVER_IP}:{SERVER_PORT}")
     return
 
   events_thread = None
+  api = None
 
   def flet_main(page: ft.Page):
-    nonlocal events_thread
+    nonlocal events_thread, api
 
     page.title = config.get('app', 'name')
     page.vertical_alignment = "start"
     page.horizontal_alignment = "center"
     page.theme_mode = "light"
 
-    api = API(client=sock, page=page)
+    api = API(client=sock, on_disconnect=page.window_close)
 
     screens = Screens(page, api=api)
 
@@ -613,7 +554,7 @@ def main():
   ft.app(target=flet_main)
 
   logging.info("Closing the client")
-  sock.close()
+  (api.network.sock if api else sock).close()  # a new one if it reconnected
 
 
 if __name__ == '__main__':
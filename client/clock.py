@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+
+from utils import config
+
+
+class ServerClock:
+  """
+  The offset between the server's clock and ours, estimated NTP style:
+  every TIME request is timed, and if it took `rtt` seconds the server read its clock about rtt/2 after we sent it.
+  Of a few samples, the one with the shortest round trip is the most accurate (the least queueing on the way).
+
+  With it the server's times (when a song started) are turned into our times,
+  so every client plays the same part of the song no matter how long the answers took.
+
+  :param api: The client API
+  :param samples: TIME requests in every sync
+  :param interval: Seconds between syncs (clocks drift apart slowly)
+  """
+
+  def __init__(self, api, samples: int = 5, interval: float = 60):
+    self.api = api
+    self.samples = samples
+    self.interval = interval
+
+    self.offset = 0.0  # server clock - our clock
+    self.rtt: float | None = None  # of the sample the offset comes from, None before the first sync
+
+  @classmethod
+  def from_config(cls, api) -> 'ServerClock':
+    return cls(
+      api,
+      samples=config.getint('sync', 'samples', fallback=5),
+      interval=config.getfloat('sync', 'interval', fallback=60),
+    )
+
+  def sync(self) -> bool:
+    """Estimate the offset again. Returns whether the server answered"""
+    best = None
+
+    for _ in range(self.samples):
+      sent_at, server_time, answered_at = self.api.get_time()
+
+      if server_time is None:
+        continue
+
+      rtt = answered_at - sent_at
+
+      if best is None or rtt < best[0]:
+        best = (rtt, server_time - (sent_at + answered_at) / 2)
+
+    if best is None:
+      return False
+
+    self.rtt, self.offset = best
+    logging.info(f'Clock offset from the server {self.offset * 1000:+.1f}ms (rtt {self.rtt * 1000:.1f}ms)')
+    return True
+
+  def start(self):
+    """Keep the offset fresh in the background"""
+    def loop():
+      while True:
+        self.sync()
+        time.sleep(self.interval)
+
+    threading.Thread(target=loop, name='clock', daemon=True).start()
+
+  def to_local(self, server_time: float) -> float:
+    """A time on the server's clock, on ours"""
+    return server_time - self.offset
@@ -1,8 +1,12 @@
 import flet as ft
 from flet_core.control_event import ControlEvent
 from models import Song
+import contextlib
 import functools
 
+# shown until the album art is in the thumbnail cache (a transparent 1x1 png)
+PLACEHOLDER_IMAGE = 'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII='
+
 class FormComponent(ft.UserControl):
   def __init__(self, on_submit):
     super().__init__()
@@ -39,33 +43,142 @@ class SongCard(ft.UserControl):
 
   :param song: The song to display
   :param main: If True, the card will be bigger
+  :param thumbnails: A ThumbnailCache to get the album art from (else Flutter downloads the full image)
   """
 
-  def __init__(self, song: Song, is_main: bool = False, alignment="start"):
+  def __init__(self, song: Song, is_main: bool = False, alignment="start", thumbnails=None):
     super().__init__()
 
     self.song = song
     self.is_main = is_main
     self.alignment = alignment
+    self.thumbnails = thumbnails
 
   def build(self):
     im_size = 50 if not self.is_main else 80
     title_size = 20 if not self.is_main else 30
     artist_size = 15 if not self.is_main else 20
 
-    return ft.Row([
-      ft.Image(src=self.song.image_url, width=im_size, height=im_size, fit=ft.ImageFit.CONTAIN, border_radius=10),
+    image = ft.Image(width=im_size, height=im_size, fit=ft.ImageFit.CONTAIN, border_radius=10)
+    row = ft.Row([
+      image,
       ft.Column([
         ft.Text(self.song.title, size=title_size, weight="bold"),
         ft.Text(self.song.artist, size=artist_size),
       ], alignment="center", spacing=0),
     ], alignment=self.alignment)
 
-  def update_song(self, info):
-    self.controls[0].controls[1].controls[0].value = info.current_song.title
-    self.controls[0].controls[1].controls[1].value = info.current_song.artist
-    self.controls[0].controls[0].src = info.current_song.image_url
-    self.update()
+    self._set_image(image, self.song.image_url)
+    return row
+
+  def _set_image(self, image: ft.Image, url: str):
+    """Point the image at the song's art, through the thumbnail cache when there is one"""
+    if self.thumbnails is None or not url:
+      image.src, image.src_base64 = url, None
+      return
+
+    def ready(data: str):
+      if self.song.image_url != url:  # the card shows another song by now
+        return
+
+      first = image.src_base64 is None  # still building, the card is sent with it
+      image.src, image.src_base64 = None, data
+
+      if not first and self.page:
+        with contextlib.suppress(Exception):
+          image.update()
+
+    image.src, image.src_base64 = None, None
+    self.thumbnails.load(url, ready)
+
+    if image.src_base64 is None:  # downloading
+      image.src_base64 = PLACEHOLDER_IMAGE
+
+  def update_song(self, song: Song) -> bool:
+    """Show another song (the caller updates the page). Returns whether anything changed"""
+    if song == self.song and song.image_url == self.song.image_url:
+      return False
+
+    self.song = song
+    self.controls[0].controls[1].controls[0].value = song.title
+    self.controls[0].controls[1].controls[1].value = song.artist
+    self._set_image(self.controls[0].controls[0], song.image_url)
+    return True
+
+
+def sync_keyed(controls: list, items: list, key, make, start: int = 0) -> bool:
+  """
+  Make controls[start:] show `items`, one control per item, like a keyed list:
+  the controls of items that are still there are kept (matched by key(item), saved in control.data),
+  only new items get a new control (make(item)) and only gone ones are removed.
+  Flet then sends just those changes. Returns whether anything changed
+  """
+  keys = [key(item) for item in items]
+
+  if [control.data for control in controls[start:]] == keys:
+    return False
+
+  existing = {control.data: control for control in controls[start:]}
+  new = []
+
+  for item, item_key in zip(items, keys):
+    control = existing.pop(item_key, None)
+
+    if control is None:
+      control = make(item)
+      control.data = item_key
+
+    new.append(control)
+
+  controls[start:] = new
+  return True
+
+
+class LazyList(ft.ListView):
+  """
+  A list that builds its rows lazily: it starts with `page_size` rows and grows by another page
+  when it is scrolled near its end, so only rows that are (about to be) seen get controls,
+  and a SongCard fetches its album art only then. Flutter lays out only the visible ones.
+
+  :param item_key: item -> the unique key of its row
+  :param make_row: item -> the row control
+  :param page_size: Rows built at first, and added on every scroll to the end
+  :param on_more: Called after the list grew, to get the items for the new rows
+  """
+
+  def __init__(self, item_key, make_row, page_size: int = 20, on_more=None, **kwargs):
+    super().__init__(on_scroll=self._on_scroll, on_scroll_interval=200, **kwargs)
+
+    self.item_key = item_key
+    self.make_row = make_row
+    self.page_size = page_size
+    self.on_more = on_more
+
+    self.shown = page_size
+    self._items = []
+    self._total = 0
+
+  def set_items(self, items: list, total: int = None) -> bool:
+    """
+    Show these items (the rows of the first `shown` ones), `total` is how many exist (if more than given).
+    The caller updates the page. Returns whether anything changed
+    """
+    self._items = items
+    self._total = len(items) if total is None else total
+    return sync_keyed(self.controls, items[:self.shown], self.item_key, self.make_row)
+
+  def _on_scroll(self, e: ft.OnScrollEvent):
+    # near the end and there are more items?
+    if e.pixels < e.max_scroll_extent - e.viewport_dimension or self.shown >= self._total:
+      return
+
+    self.shown += self.page_size
+
+    if self.set_items(self._items, self._total):
+      self.update()
+
+    if self.on_more and len(self._items) < self.shown:
+      self.on_more()
 
 
 class IconButton(ft.IconButton):
@@ -0,0 +1,176 @@
+"""
+A load generator: thousands of headless listeners (the real API and protocol, no Flet and no pygame)
+that register, join rooms and then poll, search, queue and skip like people do.
+
+Run it against a server with the fakes, so the load is the server's own:
+  server/config.ini:  [spotify_api] fake_url = http://127.0.0.1:4833   [downloader] backend = fake
+  python fake_spotify.py 4833 & python server.py      (in server/)
+  python loadgen.py --users 1000 --rooms 50            (in client/, python loadgen.py -h for the options)
+"""
+import argparse
+import collections
+import logging
+import random
+import threading
+import time
+import uuid
+
+from api import API, connect_to_server
+from utils import percentile
+
+WORDS = ['love', 'night', 'baby', 'dance', 'heart', 'time', 'fire', 'rain', 'summer', 'dream', 'girl', 'blue',
+         'home', 'light', 'world', 'money', 'party', 'crazy', 'river', 'moon', 'wild', 'gold', 'run', 'stay']
+
+# what a listener does, and the route it is measured as
+ACTIONS = {
+  "poll": ("ROOM", lambda bot: bot.api.get_room_info(bot.room)),
+  "chunk": ("RCHK", lambda bot: bot.api.get_song_chunk(0, bot.chunk_size)),
+  "search": ("SONG", lambda bot: bot.search()),
+  "queue": ("RQUE", lambda bot: bot.queue()),
+  "skip": ("RSKP", lambda bot: bot.api.skip_song().result(bot.api.timeout)),
+  "rooms": ("RLST", lambda bot: bot.api.list_rooms()),
+}
+
+
+class Stats:
+  """Latencies and errors of every route, from all the bots"""
+
+  def __init__(self):
+    self.latencies: dict[str, list[float]] = collections.defaultdict(list)
+    self.errors: dict[str, collections.Counter] = collections.defaultdict(collections.Counter)
+    self.lock = threading.Lock()
+
+  def measure(self, route: str, fun):
+    """Call fun() and record how long it took, and its error (an exception or an error answer)"""
+    start = time.perf_counter()
+    error = None
+
+    try:
+      resp = fun()
+      if isinstance(resp, dict) and 'error' in resp:
+        error = resp['error']
+    except Exception as e:
+      resp = None
+      error = f'{type(e).__name__}: {e}'
+
+    latency = time.perf_counter() - start
+
+    with self.lock:
+      self.latencies[route].append(latency)
+      if error is not None:
+        self.errors[route][error] += 1
+
+    return resp
+
+
+class Bot:
+  """One simulated listener, on its own connection"""
+
+  def __init__(self, name: str, room: int, stats: Stats, chunk_size: int):
+    self.name = name
+    self.room = room
+    self.stats = stats
+    self.chunk_size = chunk_size
+
+    self.api: API = None
+    self.found = []  # songs of the last search, to queue
+
+  def search(self):
+    songs = self.api.search_songs(' '.join(random.sample(WORDS, random.randint(1, 2)))).result(self.api.timeout)
+
+    if isinstance(songs, list):
+      self.found = songs
+    return songs
+
+  def queue(self):
+    if not self.found:
+      return self.search()  # nothing to queue yet, people search first
+
+    return self.api.send_add_to_queue(random.choice(self.found)).result(self.api.timeout)
+
+  def register(self) -> dict:
+    ok, err = self.api.register(self.name, 'loadgen')
+    return {"status": "ok"} if ok else {"error": err}
+
+  def run(self, actions: list[str], weights: list[float], think: float, until: float):
+    if (sock := self.stats.measure('connect', connect_to_server)) is None:
+      return
+
+    self.api = API(sock)
+
+    if 'error' in self.stats.measure('RGST', self.register):
+      return
+
+    self.stats.measure('JOIN', lambda: self.api.join_room(self.room))
+
+    while time.time() < until:
+      time.sleep(random.expovariate(1 / think))
+      route, fun = ACTIONS[random.choices(actions, weights)[0]]
+      self.stats.measure(route, lambda: fun(self))
+
+    self.stats.measure('LEAV', self.api.leave_room)
+    self.api.network.sock.close()
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+  """"poll=70,search=10" -> {"poll": 70, "search": 10}"""
+  weights = {}
+
+  for part in mix.split(','):
+    name, _, weight = part.partition('=')
+    if name not in ACTIONS:
+      raise argparse.ArgumentTypeError(f'Unknown action {name}, the actions are {", ".join(ACTIONS)}')
+    weights[name] = float(weight)
+
+  return weights
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Simulated listeners load test (the server is in config.ini)')
+  parser.add_argument('--users', type=int, default=1000, help='simulated listeners')
+  parser.add_argument('--rooms', type=int, default=50, help='rooms they are spread over')
+  parser.add_argument('--duration', type=float, default=60, help='seconds every listener keeps going')
+  parser.add_argument('--ramp', type=float, default=10, help='seconds over which the listeners arrive')
+  parser.add_argument('--think', type=float, default=1, help='mean seconds between the actions of a listener')
+  parser.add_argument('--mix', type=parse_mix, default='poll=60,chunk=20,search=10,queue=6,skip=2,rooms=2',
+                      help=f'weights of the actions ({", ".join(ACTIONS)})')
+  parser.add_argument('--chunk-kb', type=int, default=256, help='size of the song chunks the listeners fetch')
+  args = parser.parse_args()
+
+  logging.disable(logging.WARNING)  # a thousand reconnects would flood the output, they are counted instead
+
+  stats = Stats()
+  run_id = uuid.uuid4().hex[:6]  # new users every run
+  actions, weights = list(args.mix), list(args.mix.values())
+
+  start = time.time()
+  until = start + args.ramp + args.duration
+  threads = []
+
+  for i in range(args.users):
+    bot = Bot(f'bot{run_id}{i}', i % args.rooms + 1, stats, args.chunk_kb * 1024)
+    thread = threading.Thread(target=bot.run, args=(actions, weights, args.think, until), daemon=True)
+    threads.append(thread)
+
+    time.sleep(max(0.0, start + args.ramp * i / args.users - time.time()))
+    thread.start()
+
+  for thread in threads:
+    thread.join(timeout=max(0.0, until - time.time()) + 30)
+
+  seconds = time.time() - start
+  print(f'--- {args.users} listeners in {args.rooms} rooms, {seconds:.0f}s')
+
+  for route, latencies in sorted(stats.latencies.items(), key=lambda item: -len(item[1])):
+    errors = sum(stats.errors[route].values())
+    print(f'{route:<8} {len(latencies):>9} calls  {len(latencies) / seconds:>9.1f}/s  '
+          f'p50 {percentile(latencies, 50) * 1000:8.2f}ms  p99 {percentile(latencies, 99) * 1000:8.2f}ms  '
+          f'errors {errors / len(latencies):6.1%}')
+
+  for route, errors in stats.errors.items():
+    for error, count in errors.most_common(3):
+      print(f'{route:<8} x{count}: {error}')
+
+
+if __name__ == '__main__':
+  main()
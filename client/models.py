@@ -20,4 +20,7 @@ class RoomInfo:
   queue: list[Song]
   current_song: Song
   current_seek: int = 0
+  start_time: float = None  # when the current song started, on the server's clock
+  listeners_count: int = 0  # all the other listeners, `listeners` is only the first page of them
+  queue_length: int = 0  # the whole queue, `queue` is only the first page of it
 
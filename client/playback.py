@@ -0,0 +1,344 @@
+import base64
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import pygame.mixer
+
+from audio_cache import AudioCache
+from models import Song
+from utils import config, file_hash
+
+
+class Player:
+  """
+  Plays the room's current song while it is still downloading.
+
+  The song is fetched in chunks (RCHK) into a spool file, and the music starts as soon as the file
+  holds the part to seek to plus a small lead. The rest keeps downloading in the background,
+  ahead of what the mixer reads, so the time to the first sound doesn't grow with the song size.
+  The position comes from when the room started the song (on our clock, see ServerClock) rather than from a seek,
+  so it doesn't depend on how long the answers took, and correct_drift keeps it there.
+  The mixer stops at the end of what was downloaded when it was loaded. If the download falls behind,
+  the music is loaded again (at the room's position) once enough of the rest is there.
+
+  :param api: The client API
+  :param spool_dir: Where the songs being played are written
+  :param chunk_size: Bytes asked for in every RCHK
+  :param lead_size: Bytes that must be downloaded past the seek position before the music starts
+  :param cache: Where finished downloads are kept for the next time (None = no cache, and no prefetching)
+  :param prefetch_interval: Seconds between checks whether the server has the next song ready
+  :param max_drift: Seconds the music may be off from the room before it is seeked back (see correct_drift)
+  """
+
+  def __init__(self, api, spool_dir: str = 'spool', chunk_size: int = 256 * 1024, lead_size: int = 256 * 1024,
+               cache: AudioCache = None, prefetch_interval: float = 2, max_drift: float = 0.04):
+    self.api = api
+    self.spool_dir = spool_dir
+    self.chunk_size = chunk_size
+    self.lead_size = lead_size
+    self.cache = cache
+    self.prefetch_interval = prefetch_interval
+    self.max_drift = max_drift
+
+    os.makedirs(spool_dir, exist_ok=True)
+
+    self.current: Song | None = None
+    self._generation = 0  # changed on every play/stop, an older download sees it and stops
+    self._spooled: str | None = None  # spool file of a download that ended, deleted when its song stops
+    self._queued: Song | None = None  # prefetched, the mixer plays it after the current song
+    self._started_at: float | None = None  # when the room started the current song, on our clock
+    self._position_base: float | None = None  # song position = base + mixer's get_pos, None = not aligned yet
+    self._duration: float | None = None  # of the current song (no drift corrections past its end)
+    self._queued_duration: float | None = None
+    # [spool file, bytes downloaded, total, bytes the mixer loaded] of the current song, None once the mixer has it all
+    self._partial: list | None = None
+    self._lock = threading.Lock()
+
+  @classmethod
+  def from_config(cls, api) -> 'Player':
+    return cls(
+      api,
+      spool_dir=config.get('playback', 'spool_dir', fallback='spool'),
+      chunk_size=config.getint('playback', 'chunk_kb', fallback=256) * 1024,
+      lead_size=config.getint('playback', 'lead_kb', fallback=256) * 1024,
+      cache=AudioCache(config.get('playback', 'cache_dir', fallback='cache'),
+                       config.getint('playback', 'cache_mb', fallback=512) * 1024 * 1024),
+      prefetch_interval=config.getfloat('playback', 'prefetch_interval', fallback=2),
+      max_drift=config.getint('sync', 'max_drift_ms', fallback=40) / 1000,
+    )
+
+  def play(self, song: Song, started_at: float):
+    """
+    Start playing a song that the room started at `started_at` (on our clock), from where the room is now.
+    Returns at once, the download runs in the background
+    """
+    with self._lock:
+      self._generation += 1
+      generation = self._generation
+      self._started_at = started_at
+      self._position_base = None
+
+      # prefetched and queued in the mixer, which already plays it (or will, right after the last one)
+      if self._queued is not None and self._queued.id == song.id and pygame.mixer.music.get_busy():
+        logging.info(f'Switched to the prefetched {song.title}')
+        self._queued = None
+        self._duration = self._queued_duration
+        self._remove_spooled()
+        self.current = song
+        threading.Thread(target=self._prefetch, args=(generation,), daemon=True).start()
+        return
+
+      self._unload()
+      self.current = song
+      self._duration = None
+
+    # the seek is computed when the music starts, so it is right after the buffering
+    threading.Thread(target=self._stream, args=(generation, song, started_at), daemon=True).start()
+
+  def stop(self):
+    with self._lock:
+      self._generation += 1
+      self._unload()
+      self.current = None
+      self._started_at = self._position_base = None
+
+  def correct_drift(self, started_at: float = None) -> float | None:
+    """
+    Seek the music back to where the room is, if it is more than `max_drift` off (call it every now and then).
+    `started_at` is the room's start of the current song by the latest clock estimate.
+    Returns how far off it was (seconds, positive = ahead of the room), None if nothing is playing
+    """
+    with self._lock:
+      if started_at is not None:
+        self._started_at = started_at
+
+      if self._started_at is None or self._queued is not None and self._position_base is None:
+        return None  # the prefetched song is not playing yet
+
+      if not pygame.mixer.music.get_busy():
+        self._resume_stalled()
+        return None
+
+      expected = time.time() - self._started_at
+
+      if self._duration and expected > self._duration - 1:
+        return None  # the mixer may be on the prefetched song already, the room not yet
+
+      mixer_position = pygame.mixer.music.get_pos() / 1000  # since play(), set_pos doesn't change it
+
+      # the first check after a switch to a prefetched song: the mixer started it when the last one ended
+      drift = self._position_base + mixer_position - expected if self._position_base is not None else None
+
+      if drift is None or abs(drift) > self.max_drift:
+        if drift is not None:
+          logging.info(f'Music is {drift * 1000:+.0f}ms off the room, seeking to {expected:.2f}s')
+        pygame.mixer.music.set_pos(expected)
+        self._position_base = expected - mixer_position
+
+      return drift
+
+  def _unload(self):
+    if pygame.mixer.music.get_busy():
+      pygame.mixer.music.stop()
+    pygame.mixer.music.unload()
+
+    self._queued = None  # the mixer forgets it too
+    self._partial = None
+    self._remove_spooled()
+
+  def _remove_spooled(self):
+    if self._spooled:
+      with contextlib.suppress(OSError):
+        os.remove(self._spooled)
+      self._spooled = None
+
+  def _stream(self, generation: int, song: Song, started_at: float):
+    """
+    Download the song into the spool file, start the music once enough of it is there.
+    A song that is in the cache (with the hash the server has) is played from there right away.
+    Then the next song is prefetched
+    """
+    cached = self.cache.get(song.id) if self.cache is not None else None
+    resp = self.api.get_song_chunk(0, self.chunk_size, song_id=song.id, have_hash=cached and cached[0])
+
+    if err := resp.get('error'):
+      logging.warning(f'Cannot download {song.title}: {err}')
+      return
+
+    if resp.get('cached'):
+      logging.info(f'Playing {song.title} from the cache')
+      self._start(generation, cached[1], time.time() - started_at, resp['duration'])
+      self._prefetch(generation)
+      return
+
+    path = os.path.join(self.spool_dir, f'{generation}-{song.id}.mp3')
+
+    try:
+      if (resp := self._download(generation, song, resp, path, started_at)) is None:
+        return
+
+      if self.cache is not None and file_hash(path) == resp['hash']:
+        self.cache.put(song.id, resp['hash'], path)
+    finally:
+      with self._lock:
+        if generation == self._generation:
+          self._spooled = path
+        else:  # already stopped, nobody plays this file
+          with contextlib.suppress(OSError):
+            os.remove(path)
+
+    self._prefetch(generation)
+
+  def _download(self, generation: int, song: Song, resp: dict, path: str, started_at: float = None) -> dict | None:
+    """
+    Write a song into `path` chunk by chunk, `resp` is the response with the first chunk.
+    With `started_at` the music starts as soon as enough of it is there.
+    Returns the last response, None if it was stopped (another song, or an error)
+    """
+    offset = 0
+    playing = started_at is None
+    current = not playing  # the room's song (not a prefetched one), the mixer plays it while it downloads
+
+    if current:
+      with self._lock:
+        if generation == self._generation:
+          self._partial = [path, 0, None, 0]
+
+    with open(path, 'wb') as f:
+      while True:
+        chunk = base64.b64decode(resp['chunk'])
+        f.write(chunk)
+        f.flush()
+        offset += len(chunk)
+
+        total, duration = resp['total'], resp['duration']
+        done = offset >= total or not chunk
+
+        if not playing and (done or offset >= self._needed(total, duration, time.time() - started_at)):
+          playing = self._start(generation, path, time.time() - started_at, duration)
+
+        with self._lock:
+          if current and generation == self._generation and self._partial is not None:
+            self._partial[1:3] = offset, total
+            if playing and not pygame.mixer.music.get_busy():  # it played all that was there when it was loaded
+              self._resume_stalled()
+
+        if done:
+          logging.info(f'Downloaded {song.title} ({offset} bytes)')
+          return resp
+
+        if generation != self._generation:
+          return None
+
+        resp = self.api.get_song_chunk(offset, self.chunk_size, song_id=song.id)
+
+        # the connection is slow or reconnecting, the music goes on from what is downloaded meanwhile
+        while resp.get('error') == "The server did not answer in time" and generation == self._generation:
+          logging.warning(f'No answer from the server, downloading {song.title} again from {offset}')
+          resp = self.api.get_song_chunk(offset, self.chunk_size, song_id=song.id)
+
+        if err := resp.get('error'):
+          logging.warning(f'Stopped downloading {song.title}: {err}')
+          return None
+
+  def _prefetch(self, generation: int):
+    """
+    Once the server has the next song ready, get it into the cache and queue it in the mixer,
+    so it starts right when the current one ends
+    """
+    if self.cache is None:
+      return
+
+    while generation == self._generation:
+      resp = self.api.get_next_song()
+
+      if resp.get('ready'):
+        break
+      elif resp.get('error'):
+        return
+
+      time.sleep(self.prefetch_interval)
+    else:
+      return
+
+    song, song_hash = Song(**resp['song']), resp['hash']
+
+    if (cached := self.cache.get(song.id)) is None or cached[0] != song_hash:
+      path = os.path.join(self.spool_dir, f'{generation}-next-{song.id}.mp3')
+
+      try:
+        first = self.api.get_song_chunk(0, self.chunk_size, song_id=song.id)
+
+        if first.get('error') or self._download(generation, song, first, path) is None:
+          return
+
+        if file_hash(path) != song_hash:
+          return
+
+        self.cache.put(song.id, song_hash, path)
+      finally:
+        with contextlib.suppress(OSError):
+          os.remove(path)
+
+      if (cached := self.cache.get(song.id)) is None:  # too big for the cache
+        return
+
+    with self._lock:
+      if generation != self._generation:
+        return
+
+      pygame.mixer.music.queue(cached[1])
+      self._queued = song
+      self._queued_duration = resp['duration']
+
+    logging.info(f'Prefetched {song.title}, it plays next')
+
+  def _needed(self, total: int, duration: float | None, seek: float) -> int:
+    """Bytes to have before playing from `seek` (all of them when the duration is unknown)"""
+    if not duration:
+      return total
+
+    return min(total, int(total * seek / duration) + self.lead_size)
+
+  def _start(self, generation: int, path: str, seek: float, duration: float = None) -> bool:
+    with self._lock:
+      if generation != self._generation:  # another song (or stop) in the meantime
+        return False
+
+      logging.info(f'Playing {path} from {seek:.1f}s')
+      self._load(path, seek)
+      self._duration = duration
+      return True
+
+  def _resume_stalled(self):
+    """
+    The mixer stopped at the end of the part of the song it loaded (the download was behind):
+    load it again at the room's position, once enough past it is downloaded. Called with the lock held
+    """
+    if self._partial is None or self._position_base is None:  # the mixer has all of it, or it didn't start yet
+      return
+
+    path, offset, total, loaded = self._partial
+    expected = time.time() - self._started_at
+
+    if self._duration and expected >= self._duration:
+      return
+
+    if offset <= loaded or offset < self._needed(total, self._duration, expected):
+      return  # still too little, the next chunk checks again
+
+    logging.info(f'The download fell behind the music, playing {path} again from {expected:.1f}s')
+    self._load(path, expected)
+
+  def _load(self, path: str, seek: float):
+    if self._partial is not None and self._partial[0] == path:  # it plays up to what is downloaded now
+      path, offset, total, _ = self._partial
+      self._partial = None if offset >= total else [path, offset, total, offset]
+
+    pygame.mixer.music.load(path)
+    pygame.mixer.music.play()
+    pygame.mixer.music.set_pos(seek)
+    self._position_base = seek - pygame.mixer.music.get_pos() / 1000
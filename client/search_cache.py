@@ -0,0 +1,64 @@
+import collections
+import re
+import threading
+
+from models import Song
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize_query(query: str) -> str:
+  """Lowercase the query and keep only its words ("Hey,  Jude!" -> "hey jude"), like the server's index"""
+  return ' '.join(TOKEN_RE.findall(query.lower()))
+
+
+def matches(song: Song, words: list[str]) -> bool:
+  """Does every word start a word of the song's title or artist? (how the server's index matches)"""
+  song_words = TOKEN_RE.findall(f'{song.title} {song.artist}'.lower())
+  return all(any(song_word.startswith(word) for song_word in song_words) for word in words)
+
+
+class SearchCache:
+  """
+  The results of the latest searches, so typing a query that was already searched needs no request,
+  and a longer query shows the results of its prefix while its own are on the way.
+
+  :param max_queries: How many searches are remembered
+  """
+
+  def __init__(self, max_queries: int = 200):
+    self.max_queries = max_queries
+
+    self._lock = threading.Lock()
+    self._results: collections.OrderedDict[str, list[Song]] = collections.OrderedDict()
+
+  def get(self, query: str) -> list[Song] | None:
+    """The results of this exact query, if it was searched"""
+    key = normalize_query(query)
+
+    with self._lock:
+      if (songs := self._results.get(key)) is not None:
+        self._results.move_to_end(key)
+
+      return songs
+
+  def put(self, query: str, songs: list[Song]):
+    key = normalize_query(query)
+
+    with self._lock:
+      self._results[key] = songs
+      self._results.move_to_end(key)
+
+      while len(self._results) > self.max_queries:
+        self._results.popitem(last=False)
+
+  def preview(self, query: str) -> list[Song]:
+    """The results of the longest searched prefix of the query that still match it ("hey j" from "hey")"""
+    key = normalize_query(query)
+    words = key.split()
+
+    with self._lock:
+      prefixes = [searched for searched in self._results if searched and key.startswith(searched)]
+      songs = self._results[max(prefixes, key=len)] if prefixes else []
+
+    return [song for song in songs if matches(song, words)]
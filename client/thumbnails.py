@@ -0,0 +1,167 @@
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import logging
+import os
+import threading
+import urllib.request
+
+try:
+  from PIL import Image
+except ImportError:  # optional, without it the images are kept as they were downloaded
+  Image = None
+
+from utils import config
+
+
+class ThumbnailCache:
+  """
+  Album art, downloaded once, shrunk to the size the cards show it at and kept on the disk,
+  so refreshing a list doesn't download big images again.
+
+  The files are named by the hash of their url. The least recently used ones are deleted when the cache
+  is bigger than `max_bytes`, and the most recent ones are also kept in memory (base64, ready for Flet).
+
+  :param path: The cache directory
+  :param max_bytes: Maximum size of all the thumbnails on the disk
+  :param size: Thumbnails are shrunk to fit in size x size pixels (needs Pillow)
+  :param workers: Downloads at the same time
+  :param memory_items: Thumbnails kept in memory
+  """
+
+  def __init__(self, path: str = 'thumbnails', max_bytes: int = 32 * 1024 * 1024, size: int = 160,
+               workers: int = 4, memory_items: int = 256):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.size = size
+    self.memory_items = memory_items
+
+    os.makedirs(path, exist_ok=True)
+
+    self._lock = threading.Lock()
+    self._pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='thumbnails')
+    self._files: collections.OrderedDict[str, int] = collections.OrderedDict()  # name -> size, LRU first
+    self._memory: collections.OrderedDict[str, str] = collections.OrderedDict()  # name -> base64
+    self._waiting: dict[str, list] = {}  # name -> callbacks of a download in progress
+    self._size = 0
+
+    for name in sorted(os.listdir(path), key=lambda name: os.path.getmtime(os.path.join(path, name))):
+      self._files[name] = os.path.getsize(os.path.join(path, name))
+      self._size += self._files[name]
+
+  @classmethod
+  def from_config(cls) -> 'ThumbnailCache':
+    return cls(
+      config.get('thumbnails', 'path', fallback='thumbnails'),
+      max_bytes=config.getint('thumbnails', 'cache_mb', fallback=32) * 1024 * 1024,
+      size=config.getint('thumbnails', 'size', fallback=160),
+    )
+
+  @staticmethod
+  def _name(url: str) -> str:
+    return hashlib.sha1(url.encode()).hexdigest()
+
+  def get(self, url: str) -> str | None:
+    """The base64 thumbnail of a url, if it is cached"""
+    name = self._name(url)
+
+    with self._lock:
+      if (data := self._memory.get(name)) is not None:
+        self._memory.move_to_end(name)
+        return data
+
+      if name not in self._files:
+        return None
+
+      self._files.move_to_end(name)
+
+    try:
+      with open(os.path.join(self.path, name), 'rb') as f:
+        data = base64.b64encode(f.read()).decode()
+    except OSError:
+      return None
+
+    with contextlib.suppress(OSError):
+      os.utime(os.path.join(self.path, name))  # the order survives a restart
+
+    self._remember(name, data)
+    return data
+
+  def load(self, url: str, callback):
+    """
+    Call callback(base64 thumbnail) once it is ready: right away if it is cached, else from a download thread
+    """
+    if (data := self.get(url)) is not None:
+      return callback(data)
+
+    name = self._name(url)
+
+    with self._lock:
+      if name in self._waiting:  # already downloading
+        self._waiting[name].append(callback)
+        return
+
+      self._waiting[name] = [callback]
+
+    self._pool.submit(self._download, url, name)
+
+  def _download(self, url: str, name: str):
+    data = None
+
+    try:
+      with urllib.request.urlopen(url, timeout=10) as resp:
+        image = self._shrink(resp.read())
+
+      self._store(name, image)
+      data = base64.b64encode(image).decode()
+      self._remember(name, data)
+    except Exception as e:
+      logging.warning(f'Cannot get the image {url}: {e}')
+
+    with self._lock:
+      callbacks = self._waiting.pop(name, [])
+
+    if data is not None:
+      for callback in callbacks:
+        with contextlib.suppress(Exception):  # the card may be gone already
+          callback(data)
+
+  def _shrink(self, image: bytes) -> bytes:
+    """Downsample to the thumbnail size (if Pillow is installed and the image is bigger)"""
+    if Image is None:
+      return image
+
+    with Image.open(io.BytesIO(image)) as im:
+      if max(im.size) <= self.size:
+        return image
+
+      im.thumbnail((self.size, self.size))
+      out = io.BytesIO()
+      im.convert('RGB').save(out, format='JPEG', quality=85)
+      return out.getvalue()
+
+  def _store(self, name: str, image: bytes):
+    with open(os.path.join(self.path, name), 'wb') as f:
+      f.write(image)
+
+    with self._lock:
+      self._size += len(image) - self._files.pop(name, 0)
+      self._files[name] = len(image)
+
+      while self._size > self.max_bytes and len(self._files) > 1:
+        old, size = self._files.popitem(last=False)
+        self._size -= size
+
+        with contextlib.suppress(OSError):
+          os.remove(os.path.join(self.path, old))
+
+  def _remember(self, name: str, data: str):
+    with self._lock:
+      self._memory[name] = data
+      self._memory.move_to_end(name)
+
+      while len(self._memory) > self.memory_items:
+        self._memory.popitem(last=False)
@@ -1,8 +1,8 @@
 import enum
+import hashlib
 import socket
 import struct
 import configparser
-import sys
 from urllib.parse import parse_qs
 
 import json
@@ -15,6 +15,9 @@ MSG_SIZE_FIELD = config.getint('protocol', 'length_header_size')  # message are
 MSG_ROUTE_LENGTH = config.getint('protocol', 'length_route')
 MSG_SENDER_LENGTH = config.getint('protocol', 'length_sender')
 MSG_TYPE_LENGTH = config.getint('protocol', 'length_type')
+MSG_LENGTH = struct.Struct('!I')  # the length header, in network byte order
+MSG_HEADER = struct.Struct(f'{MSG_SENDER_LENGTH}s{MSG_TYPE_LENGTH}s{MSG_ROUTE_LENGTH}s')  # [who][type][route]
+MSG_MAX_LENGTH = config.getint('protocol', 'max_message_kb', fallback=65536) * 1024  # longer frames are refused
 
 ### SOCKET SETTINGS ###
 SERVER_IP = config.get('socket', 'ip')
@@ -33,6 +36,10 @@ class BadMessageError(Exception):
   eid = '02'
 
 
+class MessageTooLongError(BadMessageError):
+  """Raised when the length header is over MSG_MAX_LENGTH (the frame is not read, so the connection can't go on)"""
+
+
 class ResponseGenerateError(Exception):
   """Raised when the side failed to generate response"""
   eid = '03'
@@ -81,34 +88,45 @@ def is_alive(sock: socket.socket):
     return False
 
 
-def fetch_amount(sock: socket.socket, amount: int) -> bytes:
+def fetch_amount(sock: socket.socket, amount: int) -> bytearray:
   """
-  Fetch a specific amount of bytes from the socket
+  Fetch a specific amount of bytes from the socket.
+  They are received straight into one buffer of that size (adding up bytes copies all of it on every recv)
   """
-  data = b''
+  data = bytearray(amount)
 
-  while len(data) < amount:
-    b = sock.recv(amount - len(data))
-    is_connected(b)
-    data += b
+  # small messages come whole in the first recv
+  got = sock.recv_into(data, amount)
+  if got == 0:
+    raise DisconnectedError()
+  if got == 2 and data[:2] == b'OK':
+    raise OkCheck()
+
+  view = memoryview(data)
+  while got < amount:
+    n = sock.recv_into(view[got:], amount - got)
+    if n == 0:
+      raise DisconnectedError()
+    got += n
 
   return data
 
 
-def fetch_all(sock: socket.socket) -> bytes:
+def fetch_all(sock: socket.socket, max_length: int = MSG_MAX_LENGTH) -> bytearray:
   """
-  Fetch all the message from the socket (size is determined by first 4 bytes)
+  Fetch all the message from the socket (size is determined by first 4 bytes).
+  A length over max_length is refused before anything is allocated for it
   """
 
   # get message length header
   size = fetch_amount(sock, MSG_SIZE_FIELD)
   length = get_message_length(size)
+  if length > max_length:
+    raise MessageTooLongError(f"Message of {length} bytes is over the limit ({max_length} bytes)")
 
   # get the rest of the message
   msg = fetch_amount(sock, length)
 
-  # print("FETCHALL", msg)
-
   return msg
 
 
@@ -119,48 +137,73 @@ def parse_message_by_protocol(msg: bytes) -> dict:
   Protocol:
     [who 1 byte][type 1 byte][api route 4 bytes][json/raw size header - 5…]
   """
-
-
-  k = 0
-
-  msg_sender, k = msg[k:MSG_SENDER_LENGTH].decode(), k + MSG_SENDER_LENGTH
-
   try:
-    msg_type, k = int(msg[k:k + MSG_TYPE_LENGTH].decode()), k + MSG_TYPE_LENGTH
-  except ValueError:
-    print("ERORRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRR")
-    print(msg)
-    print("ERORRRRRRRRRRRRRRRRRRRRRRRRRRRRRRRR")
-    sys.exit(1)
+    msg_sender, msg_type, msg_route = MSG_HEADER.unpack_from(msg)
+    msg_type = int(msg_type)
+  except (struct.error, ValueError):
+    raise BadMessageError("Message header is not valid")
 
-  msg_route, k = msg[k:k + MSG_ROUTE_LENGTH].decode(), k + MSG_ROUTE_LENGTH
-  msg_data = msg[k:]
+  d = dict(sender=msg_sender.decode(), type=msg_type, route=msg_route.decode())
 
-  d = dict(sender=msg_sender, type=msg_type, route=msg_route)
+  if msg_type in [MessageType.JSON, MessageType.ERROR]:  # error is also json format
+    if len(msg) == MSG_HEADER.size:
+      return {**d, 'data': b''}
 
-  if msg_data and msg_type in [MessageType.JSON, MessageType.ERROR]:  # error is also json format
     try:
-      msg_data = json.loads(msg_data.decode())
-    except json.JSONError:
+      # decoded right from the buffer, without slicing a copy of the data first
+      msg_data = json.loads(str(memoryview(msg)[MSG_HEADER.size:], 'utf-8'))
+    except (json.JSONDecodeError, UnicodeDecodeError):
       raise BadMessageError("Message is not valid json")
+  else:
+    msg_data = bytes(memoryview(msg)[MSG_HEADER.size:])
 
   return {**d, 'data': msg_data}
 
 
+def build_message(sender: str, msg_type: int, route: str, data: bytes) -> bytes:
+  """
+  A whole message by the protocol, length header included.
+  The parts are joined once (adding them up copies the data again for every part)
+  """
+  header = f'{sender}{msg_type}{route}'.encode()
+  return b''.join((MSG_LENGTH.pack(len(header) + len(data)), header, data))
+
+
 def length_header_send(data):
   """
   Calculate length and set its size to int (4 bytes)
   """
-  length = socket.htonl(len(data))  # to network byte order
-  length = struct.pack('I', length)  # to 4 bytes format (Integer)
-
-  return length
+  return MSG_LENGTH.pack(len(data))  # to 4 bytes in network byte order
 
 
 def get_message_length(data):
   """
   Get length of message from length header
   """
-  length, = struct.unpack('I', data[:MSG_SIZE_FIELD])  # to 4 bytes format (Integer)
-  length = socket.ntohl(length)  # to host byte order
+  length, = MSG_LENGTH.unpack_from(data)  # from 4 bytes in network byte order
   return length
+
+
+def percentile(values, p):
+  """
+  Get the p-th percentile (0-100) of a list of numbers (nearest rank)
+  """
+  if not values:
+    return 0
+
+  values = sorted(values)
+  k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+  return values[k]
+
+
+def file_hash(path: str) -> str:
+  """
+  sha256 (hex) of a file's content, the server and the client compare songs by it
+  """
+  digest = hashlib.sha256()
+
+  with open(path, 'rb') as f:
+    while block := f.read(1024 * 1024):
+      digest.update(block)
+
+  return digest.hexdigest()
@@ -0,0 +1,505 @@
+"""
+Performance benchmarks of the server parts.
+
+Usage:
+  python bench.py <benchmark> [options]   (python bench.py -h for the list)
+"""
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from utils import percentile
+
+
+def report(name: str, count: int, seconds: float, latencies: list[float] = None):
+  """Print the throughput (and latency percentiles) of a benchmark step"""
+  line = f'{name:<30} {count:>9} ops  {seconds:8.3f}s  {count / seconds:>12.0f} ops/s'
+
+  if latencies:
+    line += f'  p50 {percentile(latencies, 50) * 1000:.3f}ms  p99 {percentile(latencies, 99) * 1000:.3f}ms'
+
+  print(line)
+
+
+def run_threads(threads: int, count: int, fun) -> tuple[float, list[float]]:
+  """
+  Call fun(i) for every i in range(count) from a few threads.
+  Returns the total time and the latency of every call
+  """
+  latencies = []
+  lock = threading.Lock()
+
+  def worker(start):
+    mine = []
+    for i in range(start, count, threads):
+      t = time.perf_counter()
+      fun(i)
+      mine.append(time.perf_counter() - t)
+
+    with lock:
+      latencies.extend(mine)
+
+  workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+
+  start = time.perf_counter()
+  for t in workers:
+    t.start()
+  for t in workers:
+    t.join()
+
+  return time.perf_counter() - start, latencies
+
+
+def bench_db(args):
+  """Register and login queries throughput on a big users table, and logins with their password check"""
+  from db import Database
+  from passwords import PasswordHasher, hash_password
+  from utils import config
+  import sqlite3
+
+  hashed = hash_password('x')  # everyone has the same password, one scrypt for the whole table
+
+  with tempfile.TemporaryDirectory() as tmp:
+    db = Database(os.path.join(tmp, 'bench.db'), pool_size=args.threads)
+    db.migrate()
+
+    start = time.perf_counter()
+    with db.connection() as conn:
+      conn.execute("""BEGIN;""")
+      conn.executemany("""INSERT INTO users (username, password) VALUES (?, ?);""",
+                       ((f'user{i}', hashed) for i in range(args.users)))
+      conn.execute("""COMMIT;""")
+    report('fill users', args.users, time.perf_counter() - start)
+
+    def register(i):
+      try:
+        db.execute("""INSERT INTO users (username, password) VALUES (?, ?);""", args=(f'new{i}', 'x' * 64))
+      except sqlite3.IntegrityError:
+        pass
+
+    def login(i):  # the query of LOGN, the password is checked by the hasher
+      return db.execute("""SELECT username, password FROM users WHERE username=?;""",
+                        args=(f'user{i * 7919 % args.users}',), fetchone=True)
+
+    hasher = PasswordHasher(workers=config.getint('passwords', 'workers', fallback=2), max_pending=args.threads,
+                            timeout=60)
+    hasher.verify('x', hashed, 'user0')  # start the processes before measuring
+
+    def checked_login(i):
+      username, password = login(i)
+      assert hasher.verify('x', password, username)
+
+    def taken(i):
+      try:
+        db.execute("""INSERT INTO users (username, password) VALUES (?, ?);""", args=(f'user{i}', 'x' * 64))
+      except sqlite3.IntegrityError:
+        pass
+
+    for name, fun in [('register', register), ('login', login), ('register (taken username)', taken)]:
+      seconds, latencies = run_threads(args.threads, args.ops, fun)
+      report(name, args.ops, seconds, latencies)
+
+    seconds, latencies = run_threads(args.threads, args.login_ops, checked_login)
+    report('login (with the password check)', args.login_ops, seconds, latencies)
+
+    hasher.close()
+    db.close()
+
+
+def make_server(tmp: str, spotify_latency: float = 0):
+  """
+  A Server with its files in a temp directory, a fake Spotify and no background threads
+  (needs config.ini like the server itself)
+  """
+  from fake_spotify import FakeSpotify
+  from utils import config
+
+  fake = FakeSpotify(latency=spotify_latency).start()
+  config.read_dict({
+    "spotify_api": {"fake_url": fake.url, "requests_per_second": "1000000", "burst": "1000000"},
+    "database": {"path": os.path.join(tmp, 'database.db')},
+    "index": {"path": os.path.join(tmp, 'tracks.db')},
+    "snapshots": {"path": os.path.join(tmp, 'rooms.journal')},
+  })
+
+  from server import Server
+  server = Server(background=False)
+
+  logging.disable(logging.CRITICAL)  # the routes log every call
+  return server
+
+
+def bench_rooms(args):
+  """Route latency with a few rooms and with many rooms"""
+  import random
+  from server import manage_room_songs
+
+  with tempfile.TemporaryDirectory() as tmp:
+    server = make_server(tmp)
+    songs = [{"id": f'song{i}', "title": f'Song {i}', "artist": 'Artist', "image_url": ''} for i in range(100)]
+    server.track_index.add(songs)
+
+    tokens = []
+
+    for rooms in args.rooms:
+      # one listener in every room
+      while len(tokens) < rooms:
+        token = server.sessions.login(f'user{len(tokens)}')
+        server.room_join(None, token, len(tokens) + 1)
+        tokens.append(token)
+
+      print(f'--- {rooms} rooms ({len(server.rooms)} allocated, {server.rooms.active_count()} active)')
+
+      picks = [random.randrange(rooms) for _ in range(args.ops)]
+
+      steps = [
+        ('ROOM', lambda i: server.room_info(None, tokens[picks[i]], picks[i] + 1)),
+        ('RQUE', lambda i: server.room_add_queue(None, tokens[picks[i]], f'song{i % 100}')),
+        ('RCUR', lambda i: server.room_current(None, tokens[picks[i]])),
+        ('RLST', lambda i: server.room_list(None, tokens[picks[i]])),
+        ('JOIN (move)', lambda i: server.room_join(None, tokens[picks[i]], (picks[i] + 1) % rooms + 1)),
+        ('JOIN (back)', lambda i: server.room_join(None, tokens[picks[i]], picks[i] + 1)),
+      ]
+
+      for name, fun in steps:
+        seconds, latencies = run_threads(1, args.ops, fun)
+        report(name, args.ops, seconds, latencies)
+
+      # empty the queues again, so the song manager has nothing to download
+      for room in server.rooms:
+        with room.lock:
+          room.queue.clear()
+
+      start = time.perf_counter()
+      for room in server.rooms.active():
+        manage_room_songs(room)
+      server.rooms.reap()
+      report('song manager pass', 1, time.perf_counter() - start)
+
+
+def bench_listeners(args):
+  """ROOM poll and JOIN/LEAV latency in one room with many listeners"""
+  import random
+
+  with tempfile.TemporaryDirectory() as tmp:
+    server = make_server(tmp)
+    tokens = []
+
+    for listeners in args.listeners:
+      while len(tokens) < listeners:
+        token = server.sessions.login(f'user{len(tokens)}')
+        server.room_join(None, token, 1)
+        tokens.append(token)
+
+      print(f'--- {listeners} listeners in the room')
+
+      picks = [random.randrange(listeners) for _ in range(args.ops)]
+
+      steps = [
+        ('ROOM', lambda i: server.room_info(None, tokens[picks[i]], 1)),
+        ('LEAV', lambda i: server.room_leave(None, tokens[picks[i]])),
+        ('JOIN', lambda i: server.room_join(None, tokens[picks[i]], 1)),
+      ]
+
+      for name, fun in steps:
+        seconds, latencies = run_threads(1, args.ops, fun)
+        report(name, args.ops, seconds, latencies)
+
+
+def bench_search(args):
+  """SONG latency of queries typed letter by letter (every prefix is a search), the first time and again"""
+  import random
+
+  with tempfile.TemporaryDirectory() as tmp:
+    server = make_server(tmp, spotify_latency=args.spotify_latency)
+    token = server.sessions.login('user')
+
+    words = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(6)) for _ in range(500)]
+    server.track_index.add([{"id": f'song{i}', "title": f'{words[i % 500]} {words[i * 7 % 500]}',
+                             "artist": words[i * 13 % 500], "image_url": ''} for i in range(args.tracks)])
+
+    typed = [f'{a} {b}' for a, b in (random.sample(words, 2) for _ in range(args.queries))]
+    prefixes = [query[:n] for query in typed for n in range(2, len(query) + 1) if not query[:n].endswith(' ')]
+
+    for name in ['typing (first time)', 'typing (again)']:
+      seconds, latencies = run_threads(1, len(prefixes), lambda i: server.search_songs(None, token, prefixes[i]))
+      report(name, len(prefixes), seconds, latencies)
+
+
+def bench_codec(args):
+  """Protocol framing, parsing and serialization, from a ROOM answer to a whole song (RCUR), old and new reader"""
+  import base64
+  import json
+  import socket
+  import struct
+  from utils import build_message, fetch_all, parse_message_by_protocol, MessageType
+
+  def old_fetch_all(sock):  # the reader before recv_into: adds up the bytes, copying all of them on every recv
+    def fetch_amount(amount):
+      data = b''
+      while len(data) < amount:
+        data += sock.recv(amount - len(data))
+      return data
+
+    length, = struct.unpack('!I', fetch_amount(4))
+    return fetch_amount(length)
+
+  def old_parse(msg):  # the parser before the struct header: slices and decodes every field
+    sender, msg_type, route = msg[0:1].decode(), int(msg[1:2].decode()), msg[2:6].decode()
+    return dict(sender=sender, type=msg_type, route=route, data=json.loads(msg[6:].decode()))
+
+  def old_serialize(route, payload):
+    msg = f's{MessageType.JSON}{route}'.encode() + json.dumps(payload).encode()
+    return struct.pack('!I', len(msg)) + msg
+
+  def new_serialize(route, payload):
+    return build_message('s', MessageType.JSON, route, json.dumps(payload).encode())
+
+  song = lambda kb: base64.b64encode(os.urandom(kb * 1024 * 3 // 4)).decode()
+  payloads = [
+    ("ROOM", {"name": "room 1", "listeners": 12, "song": "song42", "start_time": time.time()}),
+    ("SONG", [{"id": f'song{i}', "title": f'title {i}', "artist": f'artist {i}', "image_url": ''} for i in range(5)]),
+    ("RCHK", {"chunk": song(256), "size": 4 * 2 ** 20}),
+    ("RCUR", {"song": song(args.song_mb * 1024), "start_time": time.time()}),
+  ]
+
+  def read_all(reader, ops, frame):
+    a, b = socket.socketpair()
+    writer = threading.Thread(target=lambda: [a.sendall(frame) for _ in range(ops)])
+    writer.start()
+
+    seconds, latencies = run_threads(1, ops, lambda i: reader(b))
+
+    writer.join()
+    a.close()
+    b.close()
+    return seconds, latencies
+
+  for route, payload in payloads:
+    frame = new_serialize(route, payload)
+    msg = frame[4:]
+    ops = max(5, min(args.ops, args.budget_mb * 2 ** 20 // len(frame)))
+    print(f'--- {route} ({len(frame):,} bytes)')
+
+    steps = [
+      ('serialize (old)', lambda i: old_serialize(route, payload)),
+      ('serialize', lambda i: new_serialize(route, payload)),
+      ('parse (old)', lambda i: old_parse(msg)),
+      ('parse', lambda i: parse_message_by_protocol(msg)),
+    ]
+    for name, fun in steps:
+      seconds, latencies = run_threads(1, ops, fun)
+      report(name, ops, seconds, latencies)
+
+    for name, reader in [('read (old)', old_fetch_all), ('read', lambda sock: fetch_all(sock, len(msg)))]:
+      seconds, latencies = read_all(reader, ops, frame)
+      report(name, ops, seconds, latencies)
+
+
+def bench_stress(args):
+  """Hammer one room from many threads at once and check it is still consistent"""
+  import collections
+  import random
+  from server import manage_room_songs
+
+  with tempfile.TemporaryDirectory() as tmp:
+    server = make_server(tmp)
+    songs = [{"id": f'song{i}', "title": f'Song {i}', "artist": 'Artist', "image_url": ''} for i in range(200)]
+    server.track_index.add(songs)
+
+    audio_path = os.path.join(tmp, 'song.mp3')
+    with open(audio_path, 'wb') as f:
+      f.write(os.urandom(64 * 1024))
+
+    def fake_download(song):
+      time.sleep(random.random() * 0.01)
+      return 0.05, audio_path  # every song is over quickly, so the manager keeps changing it
+
+    tokens = [server.sessions.login(f'user{i}') for i in range(args.threads)]
+    for token in tokens:
+      server.room_join(None, token, 1)
+
+    routes = {
+      'ROOM': lambda token: server.room_info(None, token, 1),
+      'RQUE': lambda token: server.room_add_queue(None, token, f'song{random.randrange(len(songs))}'),
+      'RSKP': lambda token: server.room_skip(None, token),
+      'RCUR': lambda token: server.room_current(None, token),
+      'LEAV+RJOI': lambda token: (server.room_leave(None, token), server.room_join(None, token, 1)),
+    }
+    names = list(routes)
+
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    lock = threading.Lock()
+    barrier = threading.Barrier(args.threads + 1)
+    done = threading.Event()
+
+    def worker(token):
+      mine = collections.defaultdict(list)
+      barrier.wait()
+
+      for _ in range(args.ops):
+        name = random.choice(names)
+        t = time.perf_counter()
+        try:
+          routes[name](token)
+        except Exception as e:
+          with lock:
+            errors[f'{name}: {type(e).__name__}: {e}'] += 1
+        mine[name].append(time.perf_counter() - t)
+
+      with lock:
+        for name, values in mine.items():
+          latencies[name].extend(values)
+
+    def manager():
+      while not done.is_set():
+        try:
+          manage_room_songs(server.rooms.get(1), download=fake_download)
+        except Exception as e:
+          with lock:
+            errors[f'song manager: {type(e).__name__}: {e}'] += 1
+
+    workers = [threading.Thread(target=worker, args=(token,)) for token in tokens]
+    for t in workers:
+      t.start()
+    threading.Thread(target=manager, daemon=True).start()
+
+    barrier.wait()
+    start = time.perf_counter()
+    for t in workers:
+      t.join()
+    seconds = time.perf_counter() - start
+    done.set()
+
+    print(f'--- {args.threads} threads, {args.ops} calls each, one room')
+    for name in names:
+      report(name, len(latencies[name]), seconds, latencies[name])
+
+    # the room must still agree with itself and with the sessions
+    room = server.rooms.get(1)
+    problems = []
+
+    with room.lock:
+      queued = [song['id'] for song in room.queue]
+      if collections.Counter(queued) != room.queue._ids:
+        problems.append('queue index does not match the queue')
+      if len(set(queued)) != len(queued) or room.playback.song_id in queued:
+        problems.append('a song is queued twice')
+
+    in_room = {token for token in tokens if server.sessions.room_of(token) == 1}
+    if in_room != set(room.listeners):
+      problems.append(f'{len(room.listeners)} listeners in the room, {len(in_room)} by the sessions')
+
+    for error, count in errors.most_common():
+      print(f'ERROR x{count}: {error}')
+    for problem in problems:
+      print(f'INCONSISTENT: {problem}')
+
+    print('OK' if not errors and not problems else 'FAILED')
+
+
+def bench_memory(args):
+  """Memory of many rooms with queues and a playing song, and of their audio before and after everyone leaves"""
+  import gc
+  import tracemalloc
+  from server import manage_room_songs
+
+  with tempfile.TemporaryDirectory() as tmp:
+    server = make_server(tmp)
+
+    audio_path = os.path.join(tmp, 'song.mp3')
+    with open(audio_path, 'wb') as f:
+      f.write(os.urandom(args.audio_kb * 1024))
+
+    def measure() -> int:
+      gc.collect()
+      return tracemalloc.get_traced_memory()[0]
+
+    tokens = [server.sessions.login(f'user{i}') for i in range(args.rooms)]
+
+    tracemalloc.start()
+    base = measure()
+
+    for i in range(args.rooms):
+      room = server.rooms.get_or_create(i + 1)
+      for k in range(args.queue):
+        room.enqueue({"id": f'song{i}-{k}', "title": f'Song {i}-{k}', "artist": f'Artist {k}',
+                      "image_url": f'https://i.scdn.co/image/{i:020}{k:020}'})
+      manage_room_songs(room, download=lambda song: (600, audio_path))  # starts the first song, nobody listens
+
+    rooms = measure() - base
+    print(f'--- {args.rooms} rooms, {args.queue} queued songs each, {args.audio_kb}KB songs')
+    print(f'rooms, queues and songs       {rooms / 2 ** 20:9.1f}MB  {rooms / args.rooms:9.0f} bytes/room')
+
+    for i, token in enumerate(tokens):
+      server.room_join(None, token, i + 1)
+      server.room_current(None, token)  # the first listener brings the audio back
+
+    listened = measure() - base
+    print(f'everyone listening            {listened / 2 ** 20:9.1f}MB  {listened / args.rooms:9.0f} bytes/room')
+
+    for token in tokens:
+      server.room_leave(None, token)
+
+    left = measure() - base
+    print(f'everyone left                 {left / 2 ** 20:9.1f}MB  {left / args.rooms:9.0f} bytes/room')
+
+    tracemalloc.stop()
+
+
+BENCHMARKS = {
+  "db": (bench_db, lambda p: (
+    p.add_argument('--users', type=int, default=1_000_000, help='users in the table before measuring'),
+    p.add_argument('--ops', type=int, default=20_000, help='operations to measure'),
+    p.add_argument('--login-ops', type=int, default=200, help='logins with the password check (scrypt, ~50ms each)'),
+    p.add_argument('--threads', type=int, default=8),
+  )),
+  "rooms": (bench_rooms, lambda p: (
+    p.add_argument('--rooms', type=int, nargs='+', default=[6, 1000, 10_000], help='room counts to measure'),
+    p.add_argument('--ops', type=int, default=5000, help='calls of every route'),
+  )),
+  "listeners": (bench_listeners, lambda p: (
+    p.add_argument('--listeners', type=int, nargs='+', default=[10, 1000, 10_000], help='room sizes to measure'),
+    p.add_argument('--ops', type=int, default=5000, help='calls of every route'),
+  )),
+  "memory": (bench_memory, lambda p: (
+    p.add_argument('--rooms', type=int, default=10_000),
+    p.add_argument('--queue', type=int, default=10, help='queued songs in every room'),
+    p.add_argument('--audio-kb', type=int, default=8, help='size of the song file'),
+  )),
+  "search": (bench_search, lambda p: (
+    p.add_argument('--tracks', type=int, default=50_000, help='tracks in the index'),
+    p.add_argument('--queries', type=int, default=50, help='queries to type'),
+    p.add_argument('--spotify-latency', type=float, default=0.05, help='seconds every Spotify search takes'),
+  )),
+  "codec": (bench_codec, lambda p: (
+    p.add_argument('--ops', type=int, default=20_000, help='most operations of every step'),
+    p.add_argument('--budget-mb', type=int, default=500, help='bytes every step handles at most, big payloads get fewer ops'),
+    p.add_argument('--song-mb', type=int, default=10, help='size of the song in the RCUR answer'),
+  )),
+  "stress": (bench_stress, lambda p: (
+    p.add_argument('--threads', type=int, default=1000, help='clients hammering the room'),
+    p.add_argument('--ops', type=int, default=50, help='random calls by every client'),
+  )),
+}
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Server performance benchmarks')
+  subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+  for name, (fun, add_arguments) in BENCHMARKS.items():
+    sub = subparsers.add_parser(name, help=fun.__doc__)
+    add_arguments(sub)
+    sub.set_defaults(fun=fun)
+
+  args = parser.parse_args()
+  args.fun(args)
+
+
+if __name__ == '__main__':
+  main()
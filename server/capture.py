@@ -0,0 +1,128 @@
+import hashlib
+import json
+import struct
+import threading
+import time
+
+from utils import MSG_HEADER, MessageType
+
+FILE_HEADER = struct.Struct('!6sd')  # magic, when the capture started (epoch)
+MAGIC = b'SRCAP1'
+
+# seconds since the capture started, connection id, event, length of the frame, length of what is stored of it
+RECORD_HEADER = struct.Struct('!dIBII')
+
+RECEIVED, SENT, CLOSED = 0, 1, 2
+EVENTS = {'recieved': RECEIVED, 'sent': SENT, 'closed': CLOSED}
+
+CREDENTIAL_ROUTES = (b'RGST', b'LOGN')
+REPLAY_PASSWORD = 'replay'  # captured passwords are replaced by it, replay.py registers the users with it
+
+
+def pseudonym(token: str) -> str:
+  """What a captured auth token is stored as: the same every time, but not usable on the server"""
+  return 'cap-' + hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+class TrafficCapture:
+  """
+  Records the frames of every connection to a compact file, for replay.py.
+
+  Records are [RECORD_HEADER][data] after a FILE_HEADER. The received frames are stored whole
+  (they are the requests to replay), the sent ones only up to sent_max_bytes (a whole song is not worth storing,
+  its header and length are). No credentials are written: auth tokens are stored as their pseudonym()
+  and passwords as REPLAY_PASSWORD.
+
+  :param path: The capture file (overwritten)
+  :param sent_max_bytes: Sent frames bigger than this are stored without their data
+  :param flush_interval: Seconds the records may wait in the buffer
+  """
+
+  def __init__(self, path: str, sent_max_bytes: int = 256, flush_interval: float = 1):
+    self.path = path
+    self.sent_max_bytes = sent_max_bytes
+    self.flush_interval = flush_interval
+
+    self.started_at = time.time()
+    self._start = time.perf_counter()
+    self._flushed_at = self._start
+    self._lock = threading.Lock()
+
+    self._file = open(path, 'wb', buffering=1024 * 1024)
+    self._file.write(FILE_HEADER.pack(MAGIC, self.started_at))
+
+  def record(self, direction: str, tid, data: bytes = b''):
+    """Record a frame (without its length header) of connection tid. direction is 'recieved', 'sent' or 'closed'"""
+    event = EVENTS[direction]
+    length = len(data)
+
+    if event == SENT and length > self.sent_max_bytes:
+      stored = bytes(data[:MSG_HEADER.size])
+    else:
+      stored = self._scrub(data)
+
+    with self._lock:
+      now = time.perf_counter()
+      self._file.write(RECORD_HEADER.pack(now - self._start, int(tid), event, length, len(stored)))
+      self._file.write(stored)
+
+      if event == CLOSED or now - self._flushed_at > self.flush_interval:
+        self._file.flush()
+        self._flushed_at = now
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+
+  @staticmethod
+  def _scrub(data) -> bytes:
+    """The frame with its auth token and password replaced"""
+    if len(data) <= MSG_HEADER.size:
+      return bytes(data)
+
+    sender, msg_type, route = MSG_HEADER.unpack_from(data)
+    if msg_type != str(MessageType.JSON).encode():  # only json frames carry them
+      return bytes(data)
+
+    try:
+      body = json.loads(bytes(data[MSG_HEADER.size:]))
+    except ValueError:
+      return bytes(data)
+
+    if not isinstance(body, dict) or not ({'auth', 'password'} & body.keys()):
+      return bytes(data)
+
+    if isinstance(body.get('auth'), str):
+      body['auth'] = pseudonym(body['auth'])
+    if 'password' in body and route in CREDENTIAL_ROUTES:
+      body['password'] = REPLAY_PASSWORD
+
+    return bytes(data[:MSG_HEADER.size]) + json.dumps(body).encode()
+
+
+def read_capture(path: str) -> tuple[float, list[tuple[float, int, int, int, bytes]]]:
+  """
+  Read a capture. Returns when it started and its records: (seconds, connection, event, frame length, data).
+  A record cut in the middle of a write (the server was killed) ends it
+  """
+  with open(path, 'rb') as f:
+    data = f.read()
+
+  magic, started_at = FILE_HEADER.unpack_from(data)
+  if magic != MAGIC:
+    raise ValueError(f'{path} is not a capture')
+
+  records = []
+  k = FILE_HEADER.size
+
+  while k + RECORD_HEADER.size <= len(data):
+    seconds, conn, event, length, stored = RECORD_HEADER.unpack_from(data, k)
+    k += RECORD_HEADER.size
+
+    if k + stored > len(data):
+      break
+
+    records.append((seconds, conn, event, length, data[k:k + stored]))
+    k += stored
+
+  return started_at, records
@@ -0,0 +1,146 @@
+import contextlib
+import queue
+import sqlite3
+import threading
+
+# every schema change is a new migration, they run in order and the applied count is kept in `PRAGMA user_version`
+MIGRATIONS = [
+  # 1 - users table
+  """
+  CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    password TEXT NOT NULL
+  );
+  """,
+
+  # 2 - unique index on the username. Duplicates (from the old check-then-insert race) are not deleted, every one
+  # but the first is renamed to <username>#<id> (it can still log in with its own password) and listed in renamed_users.
+  # If someone already has that name it is <username>#<id>-1, -2... (the first free one). The new names can't be
+  # the same for two users: the part after the last # is the id
+  """
+  CREATE TABLE IF NOT EXISTS renamed_users (
+    user_id INTEGER PRIMARY KEY,
+    old_username TEXT NOT NULL,
+    new_username TEXT NOT NULL
+  );
+  WITH RECURSIVE candidates (id, username, n, new_username) AS (
+    SELECT id, username, 0, username || '#' || id FROM users
+      WHERE id NOT IN (SELECT MIN(id) FROM users GROUP BY username)
+    UNION ALL
+    SELECT id, username, n + 1, username || '#' || id || '-' || (n + 1) FROM candidates
+      WHERE new_username IN (SELECT username FROM users)
+  )
+  INSERT INTO renamed_users (user_id, old_username, new_username)
+    SELECT id, username, new_username FROM candidates WHERE new_username NOT IN (SELECT username FROM users);
+  UPDATE users SET username = (SELECT new_username FROM renamed_users WHERE user_id = users.id)
+    WHERE id IN (SELECT user_id FROM renamed_users);
+  CREATE UNIQUE INDEX IF NOT EXISTS users_username ON users (username);
+  """,
+
+  # 3 - login sessions (auth tokens), kept until they expire
+  """
+  CREATE TABLE IF NOT EXISTS sessions (
+    token TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    expires_at REAL NOT NULL
+  );
+  CREATE INDEX IF NOT EXISTS sessions_username ON sessions (username);
+  CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at);
+  """,
+]
+
+
+class Database:
+  """
+  SQLite access for all the client threads.
+
+  The database is in WAL mode (readers never wait for a writer) and connections are pooled,
+  each connection caches its prepared statements.
+
+  :param path: The sqlite database file
+  :param pool_size: Maximum amount of open connections
+  """
+
+  def __init__(self, path: str = 'database.db', pool_size: int = 8, cached_statements: int = 128):
+    self.path = path
+    self.cached_statements = cached_statements
+
+    self._pool = queue.LifoQueue()
+    self._slots = threading.BoundedSemaphore(pool_size)
+
+  def _connect(self) -> sqlite3.Connection:
+    conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                           cached_statements=self.cached_statements)
+    conn.execute("""PRAGMA journal_mode=WAL;""")
+    conn.execute("""PRAGMA synchronous=NORMAL;""")  # safe with WAL, commits don't wait for fsync
+    conn.execute("""PRAGMA busy_timeout=5000;""")
+    return conn
+
+  @contextlib.contextmanager
+  def connection(self):
+    """
+    Borrow a connection from the pool (BLOCKING if all of them are in use)
+    """
+    self._slots.acquire()
+
+    try:
+      conn = self._pool.get_nowait()
+    except queue.Empty:
+      try:
+        conn = self._connect()
+      except BaseException:
+        self._slots.release()
+        raise
+
+    try:
+      yield conn
+    finally:
+      self._pool.put(conn)
+      self._slots.release()
+
+  def execute(self, command, args=None, fetchall=False, fetchone=False, getid=False):
+    """Executes a command."""
+    with self.connection() as conn:
+      cur = conn.execute(command, args or ())
+
+      resp = cur.fetchall() if fetchall else cur.fetchone() if fetchone else None
+
+      if getid:
+        resp = cur.lastrowid
+
+      cur.close()
+
+    return resp
+
+  def migrate(self) -> int:
+    """
+    Apply the migrations the database doesn't have yet. Returns how many were applied
+    """
+    with self.connection() as conn:
+      version, = conn.execute("""PRAGMA user_version;""").fetchone()
+
+      for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+          conn.executescript(f"""BEGIN; {migration} PRAGMA user_version={i}; COMMIT;""")
+        except Exception:
+          if conn.in_transaction:
+            conn.execute("""ROLLBACK;""")
+          raise
+
+    return max(0, len(MIGRATIONS) - version)
+
+  def renamed_users(self) -> list[tuple[int, str, str]]:
+    """The users migration 2 renamed (duplicated usernames): (id, old username, new username)"""
+    try:
+      return self.execute("""SELECT user_id, old_username, new_username FROM renamed_users;""", fetchall=True)
+    except sqlite3.OperationalError:  # not migrated yet
+      return []
+
+  def close(self):
+    """Close all the idle connections"""
+    while True:
+      try:
+        self._pool.get_nowait().close()
+      except queue.Empty:
+        break
@@ -0,0 +1,137 @@
+"""
+A local fake of the Spotify Web API (search + track routes only).
+It lets the server and the performance tools run without a real Spotify account and
+can simulate rate limiting (429 + Retry-After).
+
+Run it on its own:
+  python fake_spotify.py [port]
+and set `fake_url = http://127.0.0.1:<port>` under [spotify_api] in config.ini
+"""
+import hashlib
+import http.server
+import json
+import sys
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+
+def fake_track(track_id: str) -> dict:
+  """
+  Build a track object (same shape as Spotify's) out of an id
+  """
+  n = int(hashlib.md5(track_id.encode()).hexdigest(), 16)
+
+  return {
+    "id": track_id,
+    "name": f"Song {n % 100000}",
+    "duration_ms": 120000 + n % 120000,
+    "artists": [{"name": f"Artist {n % 1000}"}],
+    "album": {"images": [
+      {"url": f"https://i.imgur.com/pTjJEDX.png?s=640&t={track_id}", "width": 640, "height": 640},
+      {"url": f"https://i.imgur.com/pTjJEDX.png?s=300&t={track_id}", "width": 300, "height": 300},
+      {"url": f"https://i.imgur.com/pTjJEDX.png?s=64&t={track_id}", "width": 64, "height": 64},
+    ]},
+  }
+
+
+def track_id_for(query: str, i: int) -> str:
+  """Deterministic 22 chars id for the i-th result of a query"""
+  return hashlib.sha1(f'{query}:{i}'.encode()).hexdigest()[:22]
+
+
+class FakeSpotifyHandler(http.server.BaseHTTPRequestHandler):
+  server: 'FakeSpotify'
+
+  def log_message(self, *args):
+    pass  # no logs
+
+  def send_json(self, status: int, js: dict, headers: dict = None):
+    body = json.dumps(js).encode()
+
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    for k, v in (headers or {}).items():
+      self.send_header(k, str(v))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    url = urlparse(self.path)
+    args = {k: v[0] for k, v in parse_qs(url.query).items()}
+
+    if self.server.latency:
+      time.sleep(self.server.latency)
+
+    if retry_after := self.server.take_request():
+      return self.send_json(429, {"error": {"status": 429, "message": "API rate limit exceeded"}},
+                            headers={"Retry-After": retry_after})
+
+    if url.path == '/v1/search':
+      query = args.get('q', '')
+      limit = int(args.get('limit', 10))
+      items = [fake_track(track_id_for(query, i)) for i in range(limit)]
+      return self.send_json(200, {"tracks": {"items": items, "total": limit}})
+
+    if url.path.startswith('/v1/tracks/'):
+      return self.send_json(200, fake_track(url.path.rsplit('/', 1)[1]))
+
+    self.send_json(404, {"error": {"status": 404, "message": "Not found"}})
+
+
+class FakeSpotify(http.server.ThreadingHTTPServer):
+  """
+  The fake Spotify http server.
+
+  :param rate_limit: How many requests are allowed every second before answering 429 (None = unlimited)
+  :param latency: Seconds to wait before answering every request
+  """
+  daemon_threads = True
+
+  def __init__(self, address=('127.0.0.1', 0), rate_limit: int = None, latency: float = 0):
+    super().__init__(address, FakeSpotifyHandler)
+
+    self.rate_limit = rate_limit
+    self.latency = latency
+    self.requests = 0
+    self.throttled = 0
+
+    self._window = int(time.time())
+    self._window_count = 0
+    self._lock = threading.Lock()
+
+  @property
+  def url(self):
+    return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+  def take_request(self):
+    """
+    Count a request. Returns the Retry-After seconds if it is over the limit, else 0
+    """
+    with self._lock:
+      self.requests += 1
+
+      now = time.time()
+      if int(now) != self._window:
+        self._window, self._window_count = int(now), 0
+
+      self._window_count += 1
+
+      if self.rate_limit is not None and self._window_count > self.rate_limit:
+        self.throttled += 1
+        return 1
+
+      return 0
+
+  def start(self):
+    """Serve in a background thread, returns self"""
+    threading.Thread(target=self.serve_forever, daemon=True).start()
+    return self
+
+
+if __name__ == '__main__':
+  port = int(sys.argv[1]) if len(sys.argv) > 1 else 4833
+  fake = FakeSpotify(('127.0.0.1', port))
+  print(f'Fake Spotify running on {fake.url}')
+  fake.serve_forever()
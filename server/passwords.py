@@ -0,0 +1,147 @@
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+
+from utils import percentile
+
+# scrypt cost: 16MB of memory and ~50ms of cpu for every hash
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+
+class HasherBusy(Exception):
+  """Raised when too many passwords are waiting to be hashed"""
+
+
+def hash_password(password: str) -> str:
+  """
+  Hash a password with scrypt and a random salt.
+  Format: scrypt$<n>$<r>$<p>$<salt hex>$<hash hex>
+  """
+  salt = os.urandom(16)
+  digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+  return f'scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}'
+
+
+def legacy_hash(password: str, username: str) -> str:
+  """The old (salted sha256) hash, the users registered before scrypt still have it"""
+  return hashlib.sha256(password.encode() + b"spotishai" + username.encode()).hexdigest()
+
+
+def is_legacy(hashed: str) -> bool:
+  return not hashed.startswith('scrypt$')
+
+
+def verify_password(password: str, hashed: str, username: str) -> bool:
+  """Check a password against its stored hash (scrypt or legacy)"""
+  if is_legacy(hashed):
+    return hmac.compare_digest(legacy_hash(password, username), hashed)
+
+  _, n, r, p, salt, digest = hashed.split('$')
+  check = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p))
+  return hmac.compare_digest(check.hex(), digest)
+
+
+class PasswordHasher:
+  """
+  Runs the password hashing on a pool of processes, so a login storm doesn't hold the GIL
+  for all the other routes.
+
+  At most `max_pending` jobs can wait for the pool, more than that are rejected at once (HasherBusy).
+  A job that is not done in `timeout` seconds is given up on (HasherBusy too), but it keeps its slot until the pool
+  is done with it, so the limit holds when the pool is saturated.
+
+  The processes are started with spawn, which imports the main module again in each of them (server.py, with
+  spotipy and yt_dlp: about 0.3s and 30MB a process). That is paid once per process, when the pool starts them.
+  Whatever the jobs need must come from this module, which imports only utils.
+
+  :param workers: Amount of hashing processes
+  :param max_pending: Maximum amount of jobs in the pool (running + waiting)
+  :param timeout: Seconds to wait for a job before giving up
+  """
+
+  def __init__(self, workers: int = 2, max_pending: int = 32, timeout: float = 10):
+    self.timeout = timeout
+
+    self._pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+    self._slots = threading.BoundedSemaphore(max_pending)
+    self.max_pending = max_pending
+
+    self._lock = threading.Lock()
+    self._pending = 0
+    self._done = 0
+    self._rejected = 0
+    self._timed_out = 0
+    self._latencies = collections.deque(maxlen=1000)  # seconds from submit to result
+
+  def _run(self, fun, *args):
+    if not self._slots.acquire(blocking=False):  # saturated, fast reject
+      with self._lock:
+        self._rejected += 1
+      raise HasherBusy()
+
+    start = time.perf_counter()
+
+    with self._lock:
+      self._pending += 1
+
+    def finished(future: concurrent.futures.Future):
+      # the slot is the job's, until the pool is done with it (not when we stop waiting)
+      with self._lock:
+        self._pending -= 1
+        if not future.cancelled():
+          self._done += 1
+          self._latencies.append(time.perf_counter() - start)
+      self._slots.release()
+
+    try:
+      future = self._pool.submit(fun, *args)
+    except BaseException:
+      finished(concurrent.futures.Future())
+      raise
+
+    future.add_done_callback(finished)
+
+    try:
+      return future.result(timeout=self.timeout)
+    except TimeoutError:
+      future.cancel()  # still waiting for a process: it is not run at all
+      with self._lock:
+        self._timed_out += 1
+      raise HasherBusy()
+
+  def hash(self, password: str) -> str:
+    """Hash a password (BLOCKING, raises HasherBusy)"""
+    return self._run(hash_password, password)
+
+  def verify(self, password: str, hashed: str, username: str) -> bool:
+    """Check a password against its hash (BLOCKING, raises HasherBusy)"""
+    if is_legacy(hashed):  # a single sha256, not worth a trip to the pool
+      return verify_password(password, hashed, username)
+
+    return self._run(verify_password, password, hashed, username)
+
+  def stats(self) -> dict:
+    """Queue depth and latency percentiles"""
+    with self._lock:
+      latencies = list(self._latencies)
+
+      return {
+        "pending": self._pending,
+        "max_pending": self.max_pending,
+        "done": self._done,
+        "rejected": self._rejected,
+        "timed_out": self._timed_out,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p90": percentile(latencies, 90),
+        "latency_p99": percentile(latencies, 99),
+      }
+
+  def close(self):
+    self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,246 @@
+"""
+Replays a capture ([capture] in config.ini, see capture.py) against a server: every captured connection
+on its own socket, its requests at the times they were made, sped up or as fast as the server answers.
+
+  python replay.py capture.bin --speed 10      (in server/, the server is [socket] in config.ini, or --host/--port)
+
+The captured users are registered again with capture.REPLAY_PASSWORD, so replay against a fresh database
+(a copy of it, to replay the same capture on every build and compare the tables).
+"""
+import argparse
+import collections
+import json
+import socket
+import threading
+import time
+
+from capture import read_capture, RECEIVED, SENT, CLOSED, CREDENTIAL_ROUTES, REPLAY_PASSWORD
+from utils import (MSG_HEADER, MessageType, SERVER_IP, SERVER_PORT, DisconnectedError, BadMessageError,
+                   fetch_all, length_header_send, parse_message_by_protocol, percentile)
+
+BUSY = 'Server is busy, try again soon'  # the hashers are full, a user would press login again
+LOGIN_ATTEMPTS = 5
+ANSWER_MAX_LENGTH = 64 * 1024 * 1024  # the answers are read whole, RCUR is a whole song
+
+
+class Stats:
+  """Latencies and errors of every route, from all the connections"""
+
+  def __init__(self):
+    self.latencies: dict[str, list[float]] = collections.defaultdict(list)
+    self.errors: dict[str, collections.Counter] = collections.defaultdict(collections.Counter)
+    self.lags: list[float] = []  # how late the requests were sent (the server is slower than the capture)
+    self.lock = threading.Lock()
+
+  def add(self, route: str, latency: float, error: str = None):
+    with self.lock:
+      self.latencies[route].append(latency)
+      if error is not None:
+        self.errors[route][error] += 1
+
+
+def exchange(sock: socket.socket, data: bytes) -> dict:
+  """Send a frame (without its length header) and get the server's answer"""
+  sock.sendall(length_header_send(data) + data)
+  return parse_message_by_protocol(fetch_all(sock, ANSWER_MAX_LENGTH))
+
+
+def error_of(mdata: dict) -> str | None:
+  """The error of an answer, None if it is not one"""
+  if isinstance(mdata['data'], dict) and 'error' in mdata['data']:
+    return str(mdata['data']['error'])
+  return 'error' if mdata['type'] == MessageType.ERROR else None
+
+
+def json_frame(route: str, body: dict) -> bytes:
+  return f'c{MessageType.JSON}{route}'.encode() + json.dumps(body).encode()
+
+
+class Tokens:
+  """The captured auth tokens (their pseudonyms) -> the tokens the server gave this replay"""
+
+  def __init__(self, stats: Stats):
+    self.stats = stats
+    self.tokens: dict[str, str] = {}
+    self.lock = threading.Lock()
+
+  def login(self, sock: socket.socket, route: str, body: dict) -> str | None:
+    """
+    Register or login like the captured request, the other one if it fails
+    (the user is not in this database yet, or it is from an earlier replay). Returns the new token
+    """
+    body = {**body, "password": REPLAY_PASSWORD}
+
+    for route in [route, 'RGST' if route == 'LOGN' else 'LOGN']:
+      for attempt in range(LOGIN_ATTEMPTS):
+        start = time.perf_counter()
+        mdata = exchange(sock, json_frame(route, body))
+        error = error_of(mdata)
+        self.stats.add(route, time.perf_counter() - start, error)
+
+        if error is None:
+          return mdata['data']['auth']
+        if error != BUSY:
+          break
+
+        time.sleep(0.2 * (attempt + 1))
+
+    return None
+
+  def get(self, sock: socket.socket, captured: str) -> str:
+    """The token of a captured one. A user that logged in before the capture started gets a stand-in user"""
+    with self.lock:
+      if captured in self.tokens:
+        return self.tokens[captured]
+
+    token = self.login(sock, 'LOGN', {"username": f'replay-{captured[-16:]}'}) or captured
+    return self.map(captured, token)
+
+  def map(self, captured: str, token: str) -> str:
+    with self.lock:
+      return self.tokens.setdefault(captured, token)
+
+
+class Connection:
+  """One captured connection, replayed on its own socket"""
+
+  def __init__(self, steps: list, tokens: Tokens, stats: Stats, address: tuple[str, int]):
+    self.steps = steps  # (seconds, event, request, the captured answer)
+    self.tokens = tokens
+    self.stats = stats
+    self.address = address
+
+    self.sock: socket.socket = None
+
+  def run(self, start: float, speed: float):
+    for seconds, event, request, answer in self.steps:
+      if speed:
+        due = start + seconds / speed
+        time.sleep(max(0.0, due - time.perf_counter()))
+        with self.stats.lock:
+          self.stats.lags.append(max(0.0, time.perf_counter() - due))
+
+      if event == CLOSED:
+        break
+
+      try:
+        if self.sock is None:
+          self.sock = socket.create_connection(self.address)
+        self.request(request, answer)
+      except (OSError, DisconnectedError, BadMessageError) as e:
+        route = MSG_HEADER.unpack_from(request)[2].decode(errors='replace')
+        self.stats.add(route, 0.0, f'{type(e).__name__}: {e}')
+        self.close()
+
+    self.close()
+
+  def request(self, request: bytes, answer: bytes | None):
+    sender, msg_type, route = MSG_HEADER.unpack_from(request)
+    body = None
+
+    if msg_type == str(MessageType.JSON).encode() and len(request) > MSG_HEADER.size:
+      body = json.loads(request[MSG_HEADER.size:])
+
+    if route in CREDENTIAL_ROUTES and isinstance(body, dict):
+      token = self.tokens.login(self.sock, route.decode(), body)
+
+      if token is not None and answer and len(answer) > MSG_HEADER.size:
+        captured = json.loads(answer[MSG_HEADER.size:])
+        if isinstance(captured, dict) and 'auth' in captured:
+          self.tokens.map(captured['auth'], token)
+      return
+
+    if isinstance(body, dict) and isinstance(body.get('auth'), str):
+      body['auth'] = self.tokens.get(self.sock, body['auth'])
+      request = json_frame(route.decode(), body)
+
+    start = time.perf_counter()
+    mdata = exchange(self.sock, request)
+    self.stats.add(route.decode(), time.perf_counter() - start, error_of(mdata))
+
+  def close(self):
+    if self.sock is not None:
+      self.sock.close()
+      self.sock = None
+
+
+def connections_of(records: list) -> dict[int, list]:
+  """The steps of every connection: its requests with the answers they got, and when it closed"""
+  connections = collections.defaultdict(list)
+
+  for seconds, conn, event, length, data in records:
+    steps = connections[conn]
+
+    if event == RECEIVED:
+      steps.append([seconds, RECEIVED, data, None])
+    elif event == SENT and steps and steps[-1][1] == RECEIVED and steps[-1][3] is None:
+      steps[-1][3] = data
+    elif event == CLOSED:
+      steps.append([seconds, CLOSED, b'', None])
+
+  return {conn: steps for conn, steps in connections.items() if steps}
+
+
+def parse_speed(speed: str) -> float:
+  """"10x" or "10" -> 10.0, "max" -> 0 (no waiting)"""
+  if speed == 'max':
+    return 0.0
+
+  try:
+    value = float(speed.rstrip('x'))
+  except ValueError:
+    value = 0
+
+  if value <= 0:
+    raise argparse.ArgumentTypeError('The speed is a positive number (1, 10x) or max')
+  return value
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Replay captured traffic against a server')
+  parser.add_argument('capture', help='capture file (the [capture] path of the server)')
+  parser.add_argument('--speed', type=parse_speed, default=1.0, help='1, 10, ... times as fast as captured, or max')
+  parser.add_argument('--host', default=SERVER_IP)
+  parser.add_argument('--port', type=int, default=SERVER_PORT)
+  args = parser.parse_args()
+
+  started_at, records = read_capture(args.capture)
+  connections = connections_of(records)
+  requests = sum(step[1] == RECEIVED for steps in connections.values() for step in steps)
+  print(f'Capture of {time.ctime(started_at)}: {len(connections)} connections, {requests} requests, '
+        f'{records[-1][0] if records else 0:.0f}s')
+
+  stats = Stats()
+  tokens = Tokens(stats)
+  threads = []
+  start = time.perf_counter()
+
+  for steps in connections.values():
+    connection = Connection(steps, tokens, stats, (args.host, args.port))
+    threads.append(threading.Thread(target=connection.run, args=(start, args.speed), daemon=True))
+
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  seconds = time.perf_counter() - start
+  print(f'--- replayed at {f"{args.speed:g}x" if args.speed else "max speed"} in {seconds:.1f}s')
+
+  for route, latencies in sorted(stats.latencies.items(), key=lambda item: -len(item[1])):
+    errors = sum(stats.errors[route].values())
+    print(f'{route:<8} {len(latencies):>9} calls  {len(latencies) / seconds:>9.1f}/s  '
+          f'p50 {percentile(latencies, 50) * 1000:8.2f}ms  p99 {percentile(latencies, 99) * 1000:8.2f}ms  '
+          f'errors {errors / len(latencies):6.1%}')
+
+  if stats.lags:
+    print(f'late by  p50 {percentile(stats.lags, 50) * 1000:.2f}ms  p99 {percentile(stats.lags, 99) * 1000:.2f}ms  '
+          f'(the requests the server was too slow to take on time)')
+
+  for route, errors in stats.errors.items():
+    for error, count in errors.most_common(3):
+      print(f'{route:<8} x{count}: {error}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,434 @@
+import base64
+import collections
+import dataclasses
+import itertools
+import threading
+import time
+import typing
+
+
+VERSIONS = itertools.count(1)  # room versions, unique over all the rooms (a reclaimed room's id is used again)
+
+
+class QueueFull(Exception):
+  """Raised when a song can't be queued, the message says why"""
+
+
+class Song(typing.NamedTuple):
+  """A song as kept in the queues, a tuple is about a third of the size of the dict the clients get"""
+  id: str
+  title: str
+  artist: str
+  image_url: str
+
+  @classmethod
+  def from_dict(cls, song: dict) -> 'Song':
+    return cls(song['id'], song['title'], song['artist'], song['image_url'])
+
+  def to_dict(self) -> dict:
+    return self._asdict()
+
+
+class SongQueue:
+  """
+  A room's queue of songs: O(1) append and pop, O(1) "is this song queued?" and per-user counts.
+  It is changed only under its room's lock. The deque itself is behind a small lock of its own:
+  a change holds it for O(1), a read for the page it copies, so reads never see the deque in the middle of a change.
+
+  :param max_length: Maximum amount of songs in the queue
+  :param max_per_user: Maximum amount of songs a single user can have in the queue
+  """
+  __slots__ = ('max_length', 'max_per_user', '_songs', '_ids', '_users', '_lock')
+
+  def __init__(self, max_length: int = 500, max_per_user: int = 20):
+    self.max_length = max_length
+    self.max_per_user = max_per_user
+
+    self._songs: collections.deque[tuple[Song, str]] = collections.deque()  # (song, username who queued it)
+    self._ids = collections.Counter()
+    self._users = collections.Counter()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._songs)
+
+  def __iter__(self):
+    with self._lock:
+      songs = list(self._songs)
+    return (song.to_dict() for song, _ in songs)
+
+  def __contains__(self, song_id: str):
+    return self._ids[song_id] > 0
+
+  def append(self, song: dict, username: str = None):
+    """Queue a song (raises QueueFull if the queue or the user's quota is full)"""
+    if len(self._songs) >= self.max_length:
+      raise QueueFull("Queue is full")
+
+    if username is not None and self._users[username] >= self.max_per_user:
+      raise QueueFull("You have too many songs in the queue")
+
+    with self._lock:
+      self._songs.append((Song.from_dict(song), username))
+    self._ids[song['id']] += 1
+    self._users[username] += 1
+
+  def popleft(self) -> dict:
+    """Take the next song"""
+    with self._lock:
+      song, username = self._songs.popleft()
+
+    for counter, key in ((self._ids, song.id), (self._users, username)):
+      counter[key] -= 1
+      if counter[key] <= 0:
+        del counter[key]
+
+    return song.to_dict()
+
+  def clear(self):
+    with self._lock:
+      self._songs.clear()
+    self._ids.clear()
+    self._users.clear()
+
+  def peek(self) -> dict | None:
+    """The next song, without taking it"""
+    with self._lock:
+      first = self._songs[0] if self._songs else None
+    return first[0].to_dict() if first else None
+
+  def window(self, offset: int = 0, limit: int = 50) -> list[dict]:
+    """A page of the queue, costs O(offset + limit) (the queue is at most max_length long)"""
+    with self._lock:
+      page = list(itertools.islice(self._songs, offset, offset + limit))
+    return [song.to_dict() for song, _ in page]
+
+  def to_list(self) -> list[list]:
+    """[song, username] pairs, for the snapshots"""
+    with self._lock:
+      songs = list(self._songs)
+    return [[song.to_dict(), username] for song, username in songs]
+
+  def load_list(self, items: list):
+    """Fill the queue from to_list() (or a plain list of songs), ignoring the limits"""
+    self.clear()
+
+    for item in items:
+      song, username = item if isinstance(item, list) else (item, None)
+      with self._lock:
+        self._songs.append((Song.from_dict(song), username))
+      self._ids[song['id']] += 1
+      self._users[username] += 1
+
+  def __repr__(self):
+    return f'SongQueue({len(self)} songs)'
+
+
+@dataclasses.dataclass(frozen=True, slots=True)
+class Playback:
+  """
+  What a room is playing. Never changed in place, the room swaps it for a new one,
+  so a reader that took `room.playback` once sees a song, its start time and its audio that agree
+  """
+  song: dict = dataclasses.field(default_factory=dict)
+  start_time: float = None
+  duration: float = None
+  audio_path: str = None
+  audio_base64: str = ''
+  song_id: str = None  # also while it is loading, when `song` is only the ⏳ placeholder
+  audio_hash: str = None  # sha256 of the audio file, clients that have it cached skip the download
+
+  @property
+  def loading(self):
+    return self.song.get('title', '').startswith('⏳')
+
+  @property
+  def seek(self):
+    if self.start_time is None:  # not playing
+      return 0
+
+    return time.time() - self.start_time
+
+
+NOTHING_PLAYING = Playback()
+
+
+@dataclasses.dataclass(slots=True)
+class Room:
+  """
+  A room. Every change goes through the methods here, under the room's lock, so the client threads
+  and the song manager can't interleave in the middle of one.
+  Reads take as little as they can: the playback is a frozen snapshot swapped on every change (read it once,
+  without a lock), the queue is read under its own lock (SongQueue, held only for the page that is copied)
+  and a listeners page holds the room's lock only for the page itself.
+
+  The audio of the current song is kept in memory only while the room has listeners
+  and only if it fits in `max_audio_bytes`, otherwise it is read from the disk when asked for.
+  """
+  id: int
+  listeners: dict[str, str] = dataclasses.field(default_factory=dict)  # token -> username, in join order
+  queue: SongQueue = dataclasses.field(default_factory=SongQueue)
+  playback: Playback = NOTHING_PLAYING
+  prepared: Playback = None  # the next song in the queue, downloaded while the current one plays (not started)
+  max_audio_bytes: int = 32 * 1024 * 1024  # of base64 audio
+  version: int = 0  # changes with the queue or the song (not the listeners or the audio in memory), see snapshots
+
+  lock: threading.Lock = dataclasses.field(default_factory=threading.Lock, repr=False, compare=False)
+
+  def is_empty(self):
+    """No listeners and nothing to play"""
+    return not self.listeners and not self.queue and not self.playback.song
+
+  @property
+  def listener_count(self):
+    return len(self.listeners)
+
+  @property
+  def current_song(self) -> dict:
+    return self.playback.song
+
+  @property
+  def current_seek(self):
+    return self.playback.seek
+
+  @property
+  def song_base64(self) -> str:
+    return self.playback.audio_base64
+
+  def add_listener(self, token: str, username: str):
+    with self.lock:
+      self.listeners[token] = username
+
+  def remove_listener(self, token: str):
+    with self.lock:
+      self.listeners.pop(token, None)
+
+      if not self.listeners and self.playback.audio_base64:  # nobody listens, the audio is read again on the next join
+        self.playback = dataclasses.replace(self.playback, audio_base64='')
+
+  def listeners_page(self, offset: int = 0, limit: int = 50, exclude: str = None) -> list[str]:
+    """
+    A page of the listeners usernames (without `exclude`), costs O(offset + limit) however big the room is
+    """
+    with self.lock:
+      usernames = (u for u in self.listeners.values() if u != exclude)
+      return list(itertools.islice(usernames, offset, offset + limit))
+
+  def enqueue(self, song: dict, username: str = None):
+    """
+    Queue a song, unless it is already queued or playing (raises QueueFull)
+    """
+    with self.lock:
+      if song['id'] in self.queue or self.playback.song_id == song['id']:
+        raise QueueFull("Song is already in the queue")
+
+      self.queue.append(song, username)
+      self.version = next(VERSIONS)
+
+  def next_song(self) -> tuple[dict, Playback] | None:
+    """
+    Take the next song from the queue if nothing is playing. If it was prepared it plays right away,
+    else it is shown as loading.
+    Returns the song and the loading playback (to pass to play()), None if there is nothing to download
+    """
+    with self.lock:
+      if self.playback.song or not self.queue:
+        return None
+
+      song = self.queue.popleft()
+      prepared, self.prepared = self.prepared, None
+      self.version = next(VERSIONS)
+
+      if prepared is not None and prepared.song_id == song['id'] and prepared.audio_path:
+        self.playback = dataclasses.replace(prepared, song=song, start_time=time.time())
+        return None
+      loading = Playback(song={"title": f"⏳ {song['title']}", "artist": song['artist'],
+                               "image_url": song['image_url']}, song_id=song['id'])
+      self.playback = loading
+
+      return song, loading
+
+  def song_to_prepare(self) -> dict | None:
+    """The next song, if it should be downloaded now: something plays and it was not prepared yet"""
+    playback, prepared, song = self.playback, self.prepared, self.queue.peek()
+
+    if song is None or not playback.audio_path or (prepared is not None and prepared.song_id == song['id']):
+      return None
+
+    return song
+
+  def prepare(self, song: dict, duration: float = None, audio_path: str = None, audio_hash: str = None):
+    """
+    Keep the downloaded next song (if it is still next) for when the current one is over.
+    Without an audio path it marks a failed download, the song is downloaded again when its turn comes
+    """
+    with self.lock:
+      if (head := self.queue.peek()) is not None and head['id'] == song['id']:
+        self.prepared = Playback(song, None, duration, audio_path, song_id=song['id'], audio_hash=audio_hash)
+
+  def play(self, loading: Playback, song: dict, duration: float, audio_path: str, audio_base64: str = '',
+           audio_hash: str = None) -> bool:
+    """
+    Start playing a song that finished loading. Returns False if it was skipped while it was loading
+    """
+    with self.lock:
+      if self.playback is not loading:
+        return False
+
+      self.playback = Playback(song, time.time(), duration, audio_path, audio_base64, song['id'], audio_hash)
+      self.version = next(VERSIONS)
+      return True
+
+  def resume(self, song: dict, seek: float, duration: float, audio_path: str, audio_hash: str = None):
+    """Play a song from the middle (after a restart), its audio is loaded with load_audio()"""
+    with self.lock:
+      self.playback = Playback(song, time.time() - seek, duration, audio_path, song_id=song['id'],
+                               audio_hash=audio_hash)
+      self.version = next(VERSIONS)
+
+  def stop(self, playback: Playback = None) -> bool:
+    """
+    Stop playing. If `playback` is given, only if it is still the one playing. Returns whether it stopped
+    """
+    with self.lock:
+      if playback is not None and self.playback is not playback:
+        return False
+
+      self.playback = NOTHING_PLAYING
+      self.version = next(VERSIONS)
+      return True
+
+  def load_audio(self, playback: Playback = None) -> str:
+    """
+    The base64 audio of the current song (or of `playback`, a snapshot the caller already took).
+    Read from the disk (without the lock) if it is not in memory, and kept in memory if someone listens
+    and it fits in the budget
+    """
+    playback = playback or self.playback
+
+    if playback.audio_base64 or not playback.audio_path:
+      return playback.audio_base64
+
+    with open(playback.audio_path, 'rb') as f:
+      audio_base64 = base64.b64encode(f.read()).decode()
+
+    if self.listeners and len(audio_base64) <= self.max_audio_bytes:
+      with self.lock:
+        if self.playback is playback:  # still the same song
+          self.playback = dataclasses.replace(playback, audio_base64=audio_base64)
+
+    return audio_base64
+
+  def remember_hash(self, playback: Playback, audio_hash: str):
+    """Save the audio hash of `playback` (computed without the lock), if it still plays"""
+    with self.lock:
+      if self.playback is playback:
+        self.playback = dataclasses.replace(playback, audio_hash=audio_hash)
+        self.version = next(VERSIONS)
+
+  def __str__(self):
+    return f'Room {self.id} - {self.listener_count} listeners, {len(self.queue)} queued, {self.current_song=}'
+
+  def __repr__(self):
+    return str(self)
+
+
+class RoomRegistry:
+  """
+  All the rooms, by id. A room is allocated the first time someone joins it and reclaimed
+  after it stays empty (no listeners, queue or song) for `idle_timeout` seconds.
+
+  The rooms that have listeners or songs are "active", only they need the song manager.
+
+  :param max_rooms: Room ids are 1 to max_rooms
+  :param idle_timeout: Seconds an empty room is kept before it is reclaimed
+  :param max_queue: Maximum songs in a room's queue
+  :param max_queued_per_user: Maximum songs a user can have in a room's queue
+  :param max_audio_bytes: Maximum base64 audio a room keeps in memory
+  """
+
+  def __init__(self, max_rooms: int = 100000, idle_timeout: float = 60, max_queue: int = 500,
+               max_queued_per_user: int = 20, max_audio_bytes: int = 32 * 1024 * 1024):
+    self.max_rooms = max_rooms
+    self.idle_timeout = idle_timeout
+    self.max_queue = max_queue
+    self.max_queued_per_user = max_queued_per_user
+    self.max_audio_bytes = max_audio_bytes
+
+    self._rooms: dict[int, Room] = {}
+    self._active: dict[int, Room] = {}  # ordered like a set
+    self._empty_since: dict[int, float] = {}
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._rooms)
+
+  def __iter__(self):
+    return iter(list(self._rooms.values()))
+
+  def is_valid_id(self, room_id) -> bool:
+    return isinstance(room_id, int) and 1 <= room_id <= self.max_rooms
+
+  def get(self, room_id: int) -> Room | None:
+    """The room, None if it was not created"""
+    return self._rooms.get(room_id)
+
+  def get_or_create(self, room_id: int) -> Room:
+    """The room, created if needed. It is marked active"""
+    with self._lock:
+      room = self._rooms.get(room_id)
+
+      if room is None:
+        room = self._rooms[room_id] = Room(id=room_id, queue=SongQueue(self.max_queue, self.max_queued_per_user),
+                                           max_audio_bytes=self.max_audio_bytes)
+
+      self._active[room_id] = room
+      self._empty_since.pop(room_id, None)
+      return room
+
+  def activate(self, room: Room):
+    """Mark a room as active (got a listener or a song)"""
+    with self._lock:
+      if self._rooms.get(room.id) is room:
+        self._active[room.id] = room
+        self._empty_since.pop(room.id, None)
+
+  def active(self) -> list[Room]:
+    """The rooms with listeners or songs"""
+    return list(self._active.values())
+
+  def active_count(self) -> int:
+    return len(self._active)
+
+  def active_page(self, offset: int, limit: int) -> list[Room]:
+    """A page of the active rooms, without copying all of them"""
+    with self._lock:
+      return list(itertools.islice(self._active.values(), offset, offset + limit))
+
+  def reap(self, now: float = None) -> int:
+    """
+    Deactivate the active rooms that became empty and reclaim the ones that stayed empty long enough.
+    Returns how many rooms were reclaimed
+    """
+    now = now or time.time()
+    reclaimed = 0
+
+    with self._lock:
+      for room in list(self._active.values()):
+        if not room.is_empty():
+          continue
+
+        del self._active[room.id]
+        self._empty_since.setdefault(room.id, now)
+
+      for room_id, since in list(self._empty_since.items()):
+        if now - since < self.idle_timeout:
+          break  # ordered by time, the rest are newer
+
+        del self._empty_since[room_id]
+
+        if (room := self._rooms.get(room_id)) is not None and room.is_empty():
+          del self._rooms[room_id]
+          reclaimed += 1
+
+    return reclaimed
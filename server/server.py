@@ -1,50 +1,63 @@
 import base64
-import dataclasses
 import sys
 import contextlib
-import hashlib
+import os
 import logging
 import sqlite3
 import time
 import traceback
 import threading
-import uuid
 
 import coloredlogs
 import spotipy
 import yt_dlp.extractor.youtube
 
 from utils import *
+from spotify_client import RateLimitedSpotify, build_session
+from track_index import TrackIndex
+from sessions import SessionRegistry
+from db import Database
+from snapshots import RoomJournal
+from capture import TrafficCapture
+from rooms import Room, RoomRegistry, QueueFull
+from passwords import PasswordHasher, HasherBusy, is_legacy
 
 # setup simple logger
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 coloredlogs.install(level='INFO')
 
 
-@dataclasses.dataclass()
-class Room:
-  id: int
-  listeners_tokens: list[str] = dataclasses.field(default_factory=list)
-  listeners: list[str] = dataclasses.field(default_factory=list)
-  queue: list[dict] = dataclasses.field(default_factory=list)
-  current_song: dict = dataclasses.field(default_factory=dict)
-  song_base64: str = ''
+def pick_image(images: list[dict], size: int) -> str:
+  """
+  The url of the smallest image that is at least `size` pixels wide (the biggest if none is),
+  the clients show album art at 50-80px, the first Spotify image is 640px
+  """
+  if not images:
+    return ''
+
+  # no width = unknown, assume it is big
+  by_width = sorted(images, key=lambda image: image.get('width') or float('inf'))
 
-  _start_time: float = None
-  _duration = None
+  for image in by_width:
+    if (image.get('width') or float('inf')) >= size:
+      return image['url']
 
-  @property
-  def current_seek(self):
-    if self._start_time is None:  # not playing
-      return 0
+  return by_width[-1]['url']
 
-    return time.time() - self._start_time
 
-  def __str__(self):
-    return f'Room {self.id} - {self.listeners=}, {self.queue=}, {self.current_song=}'
+def song_from_spotify(track: dict) -> dict:
+  """Convert a Spotify track object to the song dict the clients get"""
+  return {
+    "title": track['name'],
+    "artist": track['artists'][0]['name'],
+    "image_url": pick_image(track['album']['images'], config.getint('spotify_api', 'image_size', fallback=160)),
+    "id": track['id']
+  }
 
-  def __repr__(self):
-    return str(self)
+
+def page_limit(limit: int | None, default: int) -> int:
+  """The size of a page a client asked for (the default if it didn't), at most 500"""
+  return default if limit is None else max(0, min(limit, 500))
 
 
 class Routes:
@@ -54,28 +67,39 @@ class Routes:
     ping command"""
     return {"pong": msg}
 
+  def time_cmd(self, sock: socket.socket):
+    """SOCKET ROUTE -- TIME -- The server's clock (the clients estimate their offset from it, NTP style)"""
+    return {"time": time.time()}
+
+  def stats_cmd(self, sock: socket.socket):
+    """SOCKET ROUTE -- STAT -- Get the server metrics"""
+    return {"spotify": self.spotify_api.stats(), "passwords": self.hasher.stats()}
+
   def register_client(self, sock: socket.socket, username: str, password: str):
     """SOCKET ROUTE -- RGST -- Register a user"""
 
-    # check if the user exists
+    # check if the user exists (cheap, before the costly hash)
     resp = self.execute("""SELECT id FROM users WHERE username=?""", args=(username,),
                         fetchone=True)
 
     if resp is not None:
       return {"error": "Username is taken"}
 
-    # hash the password (sha256)
-    m = hashlib.sha256(password.encode() + b"spotishai" + username.encode())  # add a salt
-    hashed_password = m.hexdigest()
-
-    # insert the user
-    self.execute("""INSERT INTO users (username, password) VALUES (?, ?);""",
-                 args=(username, hashed_password))
+    # hash the password (scrypt, on the hashing processes)
+    try:
+      hashed_password = self.hasher.hash(password)
+    except HasherBusy:
+      return {"error": "Server is busy, try again soon"}
 
-    # create an auth token (random uuid)
-    auth = str(uuid.uuid4())
+    # insert the user (the username is unique, so a taken one fails)
+    try:
+      self.execute("""INSERT INTO users (username, password) VALUES (?, ?);""",
+                   args=(username, hashed_password))
+    except sqlite3.IntegrityError:
+      return {"error": "Username is taken"}
 
-    self.auths[auth] = username
+    # create an auth token
+    auth = self.sessions.login(username)
 
     return {"auth": auth}
 
@@ -83,282 +107,481 @@ class Routes:
     """SOCKET ROUTE -- LOGN -- Login a user"""
 
     # check if credentials are correct
+    resp = self.execute("""SELECT username, password FROM users WHERE username=?;""",
+                        args=(username,), fetchone=True)
 
-    # hash the password (sha256)
-    m = hashlib.sha256(password.encode() + b"spotishai" + username.encode())  # add a salt
-    hashed_password = m.hexdigest()
-
-    resp = self.execute("""SELECT username FROM users WHERE username=? AND password=?;""",
-                        args=(username, hashed_password), fetchone=True)
-
-    if resp is None:
-      return {"error": "Invalid username or password"}
+    try:
+      if resp is None or not self.hasher.verify(password, resp[1], username):
+        return {"error": "Invalid username or password"}
 
-    # check if the user is already logged in
-    if username in self.auths.values():
-      return {"auth": next(k for k, v in self.auths.items() if v == username), "username": resp[0]}
+      # registered before scrypt, upgrade the hash now that we know the password
+      if is_legacy(resp[1]):
+        self.execute("""UPDATE users SET password=? WHERE username=?;""",
+                     args=(self.hasher.hash(password), username))
+    except HasherBusy:
+      return {"error": "Server is busy, try again soon"}
 
-    # create an auth token (random uuid)
-    auth = str(uuid.uuid4())
-    self.auths[auth] = username
+    # the same token if the user is already logged in, else a new one
+    auth = self.sessions.login(username)
 
     return {"auth": auth, "username": resp[0]}
 
-  def room_info(self, sock, auth, room: int):
+  def room_info(self, sock, auth, room: int, listeners_offset: int = 0, queue_offset: int = 0,
+                listeners_limit: int = None, queue_limit: int = None):
     """SOCKET ROUTE -- ROOM -- Get the room info"""
 
-    if auth not in self.auths:
+    if auth not in self.sessions:
       return {"error": "Invalid auth token"}
 
-    if room < 1 or room > 6:
+    if not self.rooms.is_valid_id(room):
       return {"error": "Invalid room number"}
 
-    room: Room = self.get_room(room)
+    room: Room = self.rooms.get(room) or Room(id=room)  # an empty room is not allocated just to be looked at
+    username = self.sessions.user(auth)
+    playback = room.playback  # one read, so the song and the seek agree
 
     # logging.info(room)
 
     return {
-      "listeners": [u for u in room.listeners if u != self.auths[auth]],
-      "queue": room.queue,
-      "current_song": room.current_song,
-      "current_seek": room.current_seek,
+      # a page of the other listeners, so a huge room costs the same as a small one
+      "listeners": room.listeners_page(max(0, listeners_offset), page_limit(listeners_limit, self.listeners_page_size),
+                                       exclude=username),
+      "listeners_count": room.listener_count - (auth in room.listeners),
+      # a page of the queue too
+      "queue": room.queue.window(max(0, queue_offset), page_limit(queue_limit, self.queue_page_size)),
+      "queue_length": len(room.queue),
+      "current_song": playback.song,
+      "current_seek": playback.seek,
+      "start_time": playback.start_time,  # the server's clock, exact no matter how long the answer takes
     }
 
   def room_join(self, sock, auth, room: int):
     """SOCKET ROUTE -- RJOI -- Join a room"""
 
-    if auth not in self.auths:
+    if auth not in self.sessions:
       return {"error": "Invalid auth token"}
 
-    if room < 1 or room > 6:
+    if not self.rooms.is_valid_id(room):
       return {"error": "Invalid room number"}
 
-    room: Room = self.get_room(room)
-    username = self.auths[auth]
-
     # already in the room
-    if auth in room.listeners_tokens:
+    if self.sessions.room_of(auth) == room:
       return {"status": "ok"}
 
-    # in any other room?
-    for r in self.rooms:
-      if auth in r.listeners_tokens:
-        r.listeners_tokens.remove(auth)
-        r.listeners.remove(username)
-
-    room.listeners_tokens.append(auth)
-    room.listeners.append(username)
+    self.move_listener(auth, room)
 
     return {"status": "ok"}
 
   def room_leave(self, sock, auth):
     """SOCKET ROUTE -- LEAV -- Leave the room"""
 
-    if auth not in self.auths:
+    if auth not in self.sessions:
       return {"error": "Invalid auth token"}
 
-    username = self.auths[auth]
-
-    for room in self.rooms:
-      if auth in room.listeners_tokens:
-        room.listeners_tokens.remove(auth)
-        room.listeners.remove(username)
+    self.move_listener(auth, None)
 
     return {"status": "ok"}
 
   def search_songs(self, sock, auth, query: str):
     """SOCKET ROUTE -- SEAR -- Search for a song"""
 
-    if auth not in self.auths:
+    if auth not in self.sessions:
       return {"error": "Invalid auth token"}
 
-    self.spotify_api: spotipy.Spotify
+    if not isinstance(query, str) or not query.strip():  # nothing to search (spotify refuses an empty query)
+      return {"songs": base64.b64encode(b'[]').decode()}
 
-    js = self.spotify_api.search(q=query, limit=5, type="track")
+    # answer from the local index if it knows this query well enough
+    songs = self.track_index.lookup(query, limit=5)
 
-    logging.info('sending song results')
+    if songs is None:
+      try:
+        js = self.spotify_api.search(q=query, limit=5, type="track")
+      except spotipy.SpotifyException as e:  # still rate limited after the retries, or a query spotify refuses
+        logging.warning(f'Spotify search failed ({e.http_status}): {e.msg}')
+        return {"error": "Search failed, try again soon"}
 
-    songs = []
+      songs = [song_from_spotify(song) for song in js['tracks']['items']]
 
-    for song in js['tracks']['items']:
-      songs.append({
-        "title": song['name'],
-        "artist": song['artists'][0]['name'],
-        "image_url": song['album']['images'][0]['url'],
-        "id": song['id']
-      })
+      self.track_index.add(songs)
+      self.track_index.remember_query(query, songs, limit=5)
+
+    logging.info('sending song results')
 
     return {"songs": base64.b64encode(json.dumps(songs).encode()).decode()}
 
   def room_add_queue(self, sock, auth, song_id: str):
     """SOCKET ROUTE -- RQUE -- Add a song to the queue"""
 
-    if auth not in self.auths:
+    if auth not in self.sessions:
       return {"error": "Invalid auth token"}
 
     # is in any room?
-    room_id = None
-
-    for room in self.rooms:
-      if auth in room.listeners_tokens:
-        room_id = room.id
-        break
+    room_id = self.sessions.room_of(auth)
 
     if room_id is None:
       return {"error": "You are not in a room"}
 
-    # get song
-    song = self.spotify_api.track(song_id)
+    # get song (usually it was already seen in a search)
+    song = self.track_index.get(song_id)
 
     if song is None:
-      return {"error": "Invalid song id"}
+      try:
+        js = self.spotify_api.track(song_id)
+      except spotipy.SpotifyException as e:
+        logging.warning(f'Spotify track lookup failed ({e.http_status}): {e.msg}')
+        if e.http_status in (400, 404):  # not a track id
+          return {"error": "Invalid song id"}
+        return {"error": "Could not get the song, try again soon"}
 
-    room: Room = self.get_room(room_id)
+      if js is None:
+        return {"error": "Invalid song id"}
 
-    # twice in a row?
-    if (len(room.queue) > 0 and room.queue[-1]['id'] == song_id) or (
-        len(room.queue) == 0 and room.current_song and room.current_song.get('id') == song_id):
-      return {"error": "Song is already in the queue"}
+      song = song_from_spotify(js)
+      self.track_index.add([song])
 
-    room.queue.append({
-      "title": song['name'],
-      "artist": song['artists'][0]['name'],
-      "image_url": song['album']['images'][0]['url'],
-      "id": song_id
-    })
+    room: Room = self.rooms.get(room_id)
+
+    try:
+      room.enqueue(song, username=self.sessions.user(auth))  # not if it's already queued or playing
+    except QueueFull as e:
+      return {"error": str(e)}
 
-    logging.error(room)
+    logging.info(f'{room} - queued {song["title"]}')
 
     return {"status": "ok"}
 
   def room_skip(self, sock, auth):
     """SOCKET ROUTE -- RSKIP -- Skip the current song"""
 
-    if auth not in self.auths:
+    if auth not in self.sessions:
       return {"error": "Invalid auth token"}
 
     # is in any room?
-    room_id = None
-
-    for room in self.rooms:
-      if auth in room.listeners_tokens:
-        room_id = room.id
-        break
+    room_id = self.sessions.room_of(auth)
 
     if room_id is None:
       return {"error": "You are not in a room"}
 
-    room: Room = self.get_room(room_id)
+    room: Room = self.rooms.get(room_id)
+    playback = room.playback
+
+    if not playback.song:
+      return {"error": "Nothing is playing"}
 
     # is the current song loading? starts with ⏳ -- no skip
-    if room.current_song['title'].startswith('⏳'):
+    if playback.loading:
       return {"error": "Song is loading"}
 
-    room.current_song = {}
-    room.song_base64 = None
+    room.stop(playback)  # if the song changed in the meantime it was already skipped or over
 
     return {"status": "ok"}
 
-  def room_current(self, sock, auth):
-    """SOCKET ROUTE -- RCUR -- Get the current song"""
+  def room_next(self, sock, auth):
+    """SOCKET ROUTE -- RNXT -- Get the next song, if the server already has it (its file can be fetched with RCHK)"""
 
-    if auth not in self.auths:
+    if auth not in self.sessions:
       return {"error": "Invalid auth token"}
 
     # is in any room?
-    room_id = None
+    room_id = self.sessions.room_of(auth)
 
-    for room in self.rooms:
-      if auth in room.listeners_tokens:
-        room_id = room.id
-        break
+    if room_id is None:
+      return {"error": "You are not in a room"}
+
+    prepared = self.rooms.get(room_id).prepared
+
+    if prepared is None or not prepared.audio_path:
+      return {"ready": False}
+
+    try:
+      total = os.path.getsize(prepared.audio_path)
+    except OSError:
+      return {"ready": False}
+
+    return {
+      "ready": True,
+      "song": prepared.song,
+      "song_id": prepared.song_id,
+      "hash": prepared.audio_hash,
+      "total": total,
+      "duration": prepared.duration,
+    }
+
+  def room_list(self, sock, auth, offset: int = 0, limit: int = 50):
+    """SOCKET ROUTE -- RLST -- List the active rooms"""
+
+    if auth not in self.sessions:
+      return {"error": "Invalid auth token"}
+
+    rooms = self.rooms.active_page(max(0, offset), max(0, min(limit, 100)))
+
+    return {
+      "rooms": [
+        {"id": room.id, "listeners": room.listener_count, "current_song": room.current_song.get('title')}
+        for room in rooms
+      ],
+      "total": self.rooms.active_count(),
+    }
+
+  def room_current(self, sock, auth, have_hash: str = None):
+    """SOCKET ROUTE -- RCUR -- Get the current song"""
+
+    if auth not in self.sessions:
+      return {"error": "Invalid auth token"}
+
+    # is in any room?
+    room_id = self.sessions.room_of(auth)
 
     if room_id is None:
       return {"error": "You are not in a room"}
 
-    room: Room = self.get_room(room_id)
+    room: Room = self.rooms.get(room_id)
+    playback = room.playback
+
+    # the client has this song cached, no need to send it
+    if have_hash and playback.audio_path and have_hash == audio_hash(room, playback):
+      return {"current_song": playback.song, "current_seek": playback.seek, "start_time": playback.start_time,
+              "song_base64": '', "cached": True}
 
     return {
-      "current_song": room.current_song,
-      "current_seek": room.current_seek,
-      "song_base64": room.song_base64
+      "current_song": playback.song,
+      "current_seek": playback.seek,
+      "start_time": playback.start_time,
+      # from memory, or from the disk if it was released (no listeners for a while, or a restart)
+      "song_base64": room.load_audio(playback)
     }
 
+  def room_chunk(self, sock, auth, offset: int = 0, size: int = 256 * 1024, song_id: str = None,
+                 have_hash: str = None):
+    """SOCKET ROUTE -- RCHK -- Get a part of the current song file (so the client can play before it has all of it)"""
 
-def manage_songs(server):
-  while True:
-    for room in server.rooms:
-      if room._duration and room.current_seek >= room._duration:
-        # song is over
-        room.current_song = {}
-        room.song_base64 = None
-        room._start_time = None
-
-      if len(room.queue) == 0:
-        continue
+    if auth not in self.sessions:
+      return {"error": "Invalid auth token"}
 
-      # print(f'room: {room.id} - {room=}')
+    # is in any room?
+    room_id = self.sessions.room_of(auth)
 
-      if room.current_song == {}:
-        curr = room.queue.pop(0)
+    if room_id is None:
+      return {"error": "You are not in a room"}
+
+    room: Room = self.rooms.get(room_id)
+    playback = room.playback
+
+    # the next song, prefetched by the client (see RNXT)
+    if song_id is not None and song_id != playback.song_id and (prepared := room.prepared) is not None:
+      if prepared.song_id == song_id and prepared.audio_path:
+        playback = prepared
+
+    if not playback.audio_path:
+      return {"error": "Nothing is playing"}
+
+    # the client asks for the rest of a song that is not playing anymore
+    if song_id is not None and song_id != playback.song_id:
+      return {"error": "Song changed"}
 
-        # get the song
-        # no logs
-        ydl_opts = {
-          'outtmpl': 'downloads/%(id)s.%(ext)s',  # Output template for downloaded files
+    size = max(0, min(size, self.max_chunk_size))
 
-          # low quality audio, fastest download possible. mp3 format
-          'format': 'bestaudio/best',
-          'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-          }],
+    try:
+      song_hash = audio_hash(room, playback)
+
+      resp = {
+        "song_id": playback.song_id,
+        "hash": song_hash,
+        "offset": offset,
+        "duration": playback.duration,
+        "current_seek": playback.seek,
+        "start_time": playback.start_time,
+      }
+
+      # the client has this song cached, only tell it that it is the right one
+      if have_hash == song_hash:
+        return {**resp, "total": os.path.getsize(playback.audio_path), "cached": True, "chunk": ''}
+
+      with open(playback.audio_path, 'rb') as f:
+        total = os.fstat(f.fileno()).st_size
+        f.seek(max(0, offset))
+        chunk = f.read(size)
+    except OSError:
+      return {"error": "Song is not available"}
+
+    return {**resp, "total": total, "chunk": base64.b64encode(chunk).decode()}
 
-          'quiet': True,
 
-        }
+def audio_hash(room: Room, playback) -> str:
+  """The hash of a playback's audio file, computed once (restored rooms may not have it yet)"""
+  if playback.audio_hash is not None:
+    return playback.audio_hash
 
-        # show loading
-        room.current_song = {"title": f"⏳ {curr['title']}", "artist": f"{curr['artist']}",
-                             "image_url": curr['image_url']}
+  song_hash = file_hash(playback.audio_path)
+  room.remember_hash(playback, song_hash)
+  return song_hash
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-          info = ydl.extract_info(f"ytsearch:{curr['title']} {curr['artist']}", download=False)
-          video = info['entries'][0]
-          video_id = video['id']
 
-          file_ext = 'mp3'
+def download_song(song: dict) -> tuple[float, str]:
+  """
+  Find a song on youtube and download its audio (if it is not downloaded already).
+  Returns the duration and the audio file path
+  """
+  ydl_opts = {
+    'outtmpl': 'downloads/%(id)s.%(ext)s',  # Output template for downloaded files
 
-          import os
-          if not os.path.exists(f"downloads/{video_id}.{file_ext}"):
-            # print('DOWNLOADING')
-            ydl.download([video_id])
-          else:
-            pass
-            # print('CACHED')
+    # low quality audio, fastest download possible. mp3 format
+    'format': 'bestaudio/best',
+    'postprocessors': [{
+      'key': 'FFmpegExtractAudio',
+      'preferredcodec': 'mp3',
+      'preferredquality': '192',
+    }],
 
-          room._duration = video['duration']
-          # print(f'{room._duration=}')
+    'quiet': True,
+
+  }
+
+  with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    info = ydl.extract_info(f"ytsearch:{song['title']} {song['artist']}", download=False)
+    video = info['entries'][0]
+    video_id = video['id']
+
+    file_ext = 'mp3'
+
+    if not os.path.exists(f"downloads/{video_id}.{file_ext}"):
+      ydl.download([video_id])
+
+    return video['duration'], f"downloads/{video_id}.{file_ext}"
+
+
+def fake_download_song(song: dict) -> tuple[float, str]:
+  """
+  download_song without youtube and ffmpeg (`[downloader] backend = fake`, for load tests).
+  Every song is a file of random bytes, written the first time it is asked for
+  """
+  path = f"downloads/fake-{song['id']}.mp3"
 
-          with open(f"downloads/{video_id}.{file_ext}", 'rb') as f:
-            room.song_base64 = base64.b64encode(f.read()).decode()
+  if not os.path.exists(path):
+    os.makedirs('downloads', exist_ok=True)
 
-        room.current_song = curr
-        room._start_time = time.time()
+    with open(path + '.tmp', 'wb') as f:
+      f.write(os.urandom(config.getint('downloader', 'fake_size_kb', fallback=256) * 1024))
+    os.replace(path + '.tmp', path)
 
-        # with open('../client/sou.mp3', 'rb') as f:
-        #   room.song_base64 = base64.b64encode(f.read()).decode()  # todo download with ytdl
+  return config.getfloat('downloader', 'fake_duration', fallback=30), path
+
+
+DOWNLOADERS = {
+  "youtube": download_song,
+  "fake": fake_download_song,
+}
+
+
+def manage_room_songs(room: Room, download=download_song):
+  """
+  Move a room to its next song when the current one is over (downloads it).
+  The room is not locked during the download, a skip in the meantime just drops the loaded song
+  """
+  playback = room.playback
+
+  if playback.duration and playback.seek >= playback.duration:
+    # song is over
+    room.stop(playback)
+
+  # take the next song and show it as loading (or play it, if it was prepared)
+  if (taken := room.next_song()) is None:
+    prepare_next_song(room, download)
+    return
+
+  song, loading = taken
+
+  try:
+    duration, audio_path = download(song)
+    audio_hash = file_hash(audio_path)
+  except Exception:
+    logging.error(f'Cannot download {song["title"]}: {traceback.format_exc()}')
+    room.stop(loading)
+    return
+
+  # the base64 audio is only for the old clients (RCUR), it is read on the first one of them (Room.load_audio)
+  room.play(loading, song, duration, audio_path, audio_hash=audio_hash)
+
+
+def prepare_next_song(room: Room, download=download_song):
+  """
+  Download the next song while the current one plays, so the switch doesn't wait for a download
+  (and the clients can prefetch it, see RNXT)
+  """
+  if (song := room.song_to_prepare()) is None:
+    return
+
+  try:
+    duration, audio_path = download(song)
+    room.prepare(song, duration, audio_path, file_hash(audio_path))
+  except Exception:
+    logging.error(f'Cannot prepare {song["title"]}: {traceback.format_exc()}')
+    room.prepare(song)  # don't try again on every pass
+
+
+def manage_songs(server):
+  while True:
+    for room in server.rooms.active():  # only rooms with listeners or songs
+      manage_room_songs(room, download=server.download)
+
+    server.rooms.reap()
 
     time.sleep(0.1)
 
 
+def manage_sessions(server):
+  """Delete the expired sessions, a small batch at a time"""
+  while True:
+    deleted = server.sessions.sweep(limit=config.getint('sessions', 'sweep_batch', fallback=500))
+
+    if deleted:
+      logging.info(f'Swept {deleted} expired sessions')
+
+    time.sleep(1 if deleted else 60)  # more to sweep? come back soon
+
+
+def manage_reconnects(server):
+  """
+  Take the users whose connection dropped out of their rooms, once they had enough time to reconnect,
+  and the users whose session expired
+  """
+  while True:
+    for auth in server.sessions.expired_holds():
+      logging.info('A listener did not come back, leaving the room')
+      server.move_listener(auth, None)
+
+    for auth, room_id in server.sessions.expired_rooms():
+      logging.info("A listener's session expired, leaving the room")
+      with server.membership_lock:
+        if (room := server.rooms.get(room_id)) is not None:
+          room.remove_listener(auth)
+
+    time.sleep(1)
+
+
+def manage_snapshots(server):
+  """Write the rooms that changed to the journal, so a restart can bring them back"""
+  interval = config.getfloat('snapshots', 'interval', fallback=2)
+
+  while True:
+    time.sleep(interval)
+
+    try:
+      server.journal.write(server.rooms)
+    except OSError as e:
+      logging.error(f'Cannot write the rooms journal: {e}')
+
+
 class Server(Routes):
   """
   The server class handles and all the clients connected to it.
   """
 
-  def __init__(self):
+  def __init__(self, background: bool = True):
+    """
+    :param background: Start the songs, sessions and snapshots managers (benchmarks run without them)
+    """
     self.server_sock = None
     self.client_socks = []
 
@@ -366,6 +589,7 @@ class Server(Routes):
 
     self.SERVER_ROUTES = {
       "PING": self.ping_cmd,
+      "TIME": self.time_cmd,
       "RGST": self.register_client,
       "LOGN": self.login_client,
       "ROOM": self.room_info,
@@ -375,37 +599,151 @@ class Server(Routes):
       "RQUE": self.room_add_queue,
       "RSKP": self.room_skip,
       "RCUR": self.room_current,
+      "RCHK": self.room_chunk,
+      "RNXT": self.room_next,
+      "RLST": self.room_list,
+      "STAT": self.stats_cmd,
     }
 
-    self.conn = sqlite3.connect('database.db', isolation_level=None, check_same_thread=False)
-    self.auths = {}
-    self.rooms = [Room(id=i) for i in range(1, 6 + 1)]
-
-    auth_manager = spotipy.SpotifyOAuth(**config['spotify'])
-    self.spotify_api = spotipy.Spotify(auth_manager=auth_manager)
+    self.db = Database(config.get('database', 'path', fallback='database.db'),
+                       pool_size=config.getint('database', 'pool_size', fallback=8))
+    if self.db.migrate():
+      for user_id, old, new in self.db.renamed_users():
+        logging.warning(f'Duplicated username: user {user_id} "{old}" is now "{new}"')
+    self.hasher = PasswordHasher(workers=config.getint('passwords', 'workers', fallback=2),
+                                 max_pending=config.getint('passwords', 'max_pending', fallback=32))
+    self.sessions = SessionRegistry(self.db, ttl=config.getfloat('sessions', 'ttl', fallback=7 * 24 * 3600),
+                                    cache_size=config.getint('sessions', 'cache_size', fallback=10000))
+    logging.info(f'Restored {self.sessions.warm()} sessions')
+    self.membership_lock = threading.Lock()  # moving users between rooms
+    # seconds a user whose connection dropped stays in their room (0 = leaves right away)
+    self.reconnect_grace = config.getfloat('sessions', 'reconnect_grace', fallback=30)
+    self.rooms = RoomRegistry(max_rooms=config.getint('rooms', 'max_rooms', fallback=100000),
+                              idle_timeout=config.getfloat('rooms', 'idle_timeout', fallback=60),
+                              max_queue=config.getint('rooms', 'max_queue', fallback=500),
+                              max_queued_per_user=config.getint('rooms', 'max_queued_per_user', fallback=20),
+                              max_audio_bytes=config.getint('rooms', 'max_audio_mb', fallback=32) * 1024 * 1024)
+    self.listeners_page_size = config.getint('rooms', 'listeners_page_size', fallback=50)
+    self.queue_page_size = config.getint('rooms', 'queue_page_size', fallback=50)
+    self.max_chunk_size = config.getint('rooms', 'max_chunk_kb', fallback=1024) * 1024
+    self.download = DOWNLOADERS[config.get('downloader', 'backend', fallback='youtube')]
+
+    self.spotify_api = RateLimitedSpotify(
+      self.create_spotify_api(),
+      max_concurrency=config.getint('spotify_api', 'max_concurrency', fallback=4),
+      rate=config.getfloat('spotify_api', 'requests_per_second', fallback=10),
+      burst=config.getint('spotify_api', 'burst', fallback=20),
+      max_retries=config.getint('spotify_api', 'max_retries', fallback=3),
+    )
+
+    self.track_index = TrackIndex(config.get('index', 'path', fallback='tracks.db'),
+                                  query_ttl=config.getfloat('index', 'query_ttl', fallback=7 * 24 * 3600),
+                                  cache_size=config.getint('index', 'cache_size', fallback=1024))
+
+    self.journal = RoomJournal(config.get('snapshots', 'path', fallback='rooms.journal'))
+
+    # opt-in record of the traffic, for replay.py
+    capture_path = config.get('capture', 'path', fallback='')
+    self.capture = TrafficCapture(time.strftime(capture_path),
+                                  sent_max_bytes=config.getint('capture', 'sent_max_bytes', fallback=256)
+                                  ) if capture_path else None
+    self.restore_rooms()
+
+    if not background:
+      return
 
     self.manage_songs_thread = threading.Thread(target=manage_songs, args=(self,), daemon=True)
     self.manage_songs_thread.start()
 
-    self.sock_auth = {}  # mapping
+    self.manage_sessions_thread = threading.Thread(target=manage_sessions, args=(self,), daemon=True)
+    self.manage_sessions_thread.start()
 
-  def get_room(self, room_id: int) -> Room:
-    return self.rooms[room_id - 1]
+    self.manage_snapshots_thread = threading.Thread(target=manage_snapshots, args=(self,), daemon=True)
+    self.manage_snapshots_thread.start()
 
-  def execute(self, command, args=None, fetchall=False, fetchone=False, getid=False):
-    """Executes a command."""
-    cur = self.conn.cursor()
+    self.manage_reconnects_thread = threading.Thread(target=manage_reconnects, args=(self,), daemon=True)
+    self.manage_reconnects_thread.start()
+
+  @staticmethod
+  def create_spotify_api() -> spotipy.Spotify:
+    """
+    Create the spotipy object. If `fake_url` is set it talks to a local fake Spotify (see fake_spotify.py)
+    """
+    fake_url = config.get('spotify_api', 'fake_url', fallback='')
 
-    cur.execute(command, args)
+    if fake_url:
+      api = spotipy.Spotify(auth='fake', requests_session=build_session())
+      api.prefix = fake_url.rstrip('/') + '/v1/'
+      return api
 
-    resp = cur.fetchall() if fetchall else cur.fetchone() if fetchone else None
+    auth_manager = spotipy.SpotifyOAuth(**config['spotify'])
+    return spotipy.Spotify(auth_manager=auth_manager, requests_session=build_session())
+
+  def restore_rooms(self):
+    """
+    Bring back the rooms from the journal: queues and the current songs from where they were.
+    The audio of the playing songs is read from the disk when someone asks for it. The rooms have no listeners yet
+    (so nothing is kept in memory), but the files of the latest songs are read ahead in the background,
+    so the listeners coming back don't all wait for a cold disk at once
+    """
+    start = time.perf_counter()
+    states, saved_at = self.journal.load()
+    playing = []
+
+    for state in states.values():
+      if not self.rooms.is_valid_id(state['id']):
+        continue
+
+      room = self.rooms.get_or_create(state['id'])
+      room.queue.load_list(state['queue'])
 
-    if getid:
-      resp = cur.lastrowid
+      if not state['current_song'] or not os.path.exists(state['audio_path']):
+        continue
 
-    cur.close()
+      seek = saved_at - state['start_time']  # how far it played before the server went down
+
+      if state['duration'] and seek >= state['duration']:  # it was over
+        continue
 
-    return resp
+      room.resume(state['current_song'], seek, state['duration'], state['audio_path'], state.get('audio_hash'))
+      playing.append((state['start_time'], state['audio_path']))
+
+    logging.info(f'Restored {len(states)} rooms in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+    warm_songs = config.getint('snapshots', 'warm_songs', fallback=50)
+    paths = [path for _, path in sorted(playing, reverse=True)[:warm_songs]]  # the songs that started last
+
+    def warm():
+      for path in paths:
+        with contextlib.suppress(OSError):
+          with open(path, 'rb') as f:
+            if hasattr(os, 'posix_fadvise'):
+              os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)  # the kernel reads it, not this process
+            else:
+              while f.read(1024 * 1024):
+                pass
+
+    if paths:
+      threading.Thread(target=warm, daemon=True).start()
+
+  def move_listener(self, auth: str, room_id: int | None):
+    """
+    Move a user to a room (None = out of any room), keeping the rooms listeners and the session registry in sync
+    """
+    with self.membership_lock:
+      previous = self.sessions.set_room(auth, room_id)
+
+      if previous is not None:
+        self.rooms.get(previous).remove_listener(auth)
+
+      if room_id is not None:
+        room = self.rooms.get_or_create(room_id)
+        room.add_listener(auth, self.sessions.user(auth))
+        self.rooms.activate(room)  # in case it was deactivated between the two lines above
+
+  def execute(self, command, args=None, fetchall=False, fetchone=False, getid=False):
+    """Executes a command."""
+    return self.db.execute(command, args=args, fetchall=fetchall, fetchone=fetchone, getid=getid)
 
   def run(self, ip=None, port=None):
     """
@@ -466,31 +804,34 @@ class Server(Routes):
     print('Bye ..')
 
   def logtcp(self, dir, tid, byte_data):
-    """log direction, tid and all TCP byte array data"""
+    """log direction, tid and the TCP data of a message (without its length header), and capture it"""
+
+    if self.capture is not None:
+      self.capture.record(dir, tid, byte_data)
 
-    s = byte_data.decode() if isinstance(byte_data, bytes) else byte_data
-    if 'ROOM' in s:
+    route = bytes(byte_data[MSG_SENDER_LENGTH + MSG_TYPE_LENGTH:MSG_HEADER.size])
+    if route == b'ROOM':
       return
 
-    if dir == 'sent':
-      logging.info(f'{tid} S LOG:Sent\t>>>\t{byte_data}')
+    if dir == 'sent' and route != b'EROR':  # answers can be whole songs, only their size is logged
+      logging.info(f'{tid} S LOG:Sent\t>>>\t{route.decode()} {len(byte_data)} bytes')
+    elif dir == 'sent':
+      logging.info(f'{tid} S LOG:Sent\t>>>\t{bytes(byte_data)}')
     else:
-      logging.info(f'{tid} S LOG:Recieved\t<<<\t{byte_data}')
+      logging.info(f'{tid} S LOG:Recieved\t<<<\t{bytes(byte_data)}')
 
   def send_error(self, sock, tid, err, errmsg=None):
     """
     Send error message to client
     """
-    msg = f's{MessageType.ERROR}EROR' + json.dumps({
+    msg = build_message('s', MessageType.ERROR, 'EROR', json.dumps({
       "error_code": err.eid if hasattr(err, "eid") else GeneralError.eid,
       "error": errmsg or str(err)
-    })
-
-    length_header = length_header_send(msg)
+    }).encode())
 
     with contextlib.suppress(ConnectionError):
-      sock.sendall(length_header + msg.encode())
-      self.logtcp('sent', tid, msg)
+      sock.sendall(msg)
+      self.logtcp('sent', tid, msg[MSG_SIZE_FIELD:])
 
   def handle_client_message(self, sock, mdata, tid):
     """
@@ -511,7 +852,8 @@ class Server(Routes):
       # call function with arguments
       try:
         fun = self.SERVER_ROUTES[route]
-        self.sock_auth[sock] = kw.get('auth')
+        if kw.get('auth') in self.sessions:
+          self.sessions.bind_socket(sock, kw['auth'])
         return fun(sock=sock, **kw)
       except ResponseGenerateError as e:
         return send_error(sock, tid, e.eid)
@@ -547,16 +889,12 @@ class Server(Routes):
     else:
       otype = MessageType.RAW
 
-    resp = f's{otype}{route}'.encode() + resp
-
-    # get data length header
-    length_header = length_header_send(resp)
+    # the whole message with its length header, built in one go
+    msg = build_message('s', otype, route, resp)
 
     # send
-    sock.sendall(length_header + resp)
-    # logging.info(f"$ {length_header + resp}")
-    if route != 'ROOM':
-      self.logtcp('sent', tid, f'{route} {len(resp)} bytes')
+    sock.sendall(msg)
+    self.logtcp('sent', tid, memoryview(msg)[MSG_SIZE_FIELD:])
 
     return route
 
@@ -602,6 +940,11 @@ class Server(Routes):
         with contextlib.suppress(Exception):  # already disconnected, so prolly wouldn't work
           self.send_error(sock, tid, e, 'Disconnected')
         break
+      except MessageTooLongError as e:  # the rest of the frame is still in the stream, nothing after it can be read
+        logging.error(f'Client {tid} sent bad message ({e})')
+        with contextlib.suppress(Exception):
+          self.send_error(sock, tid, e)
+        break
       except BadMessageError as e:
         logging.error(f'Client {tid} sent bad message ({e})')
         self.send_error(sock, tid, e)
@@ -619,17 +962,18 @@ class Server(Routes):
 
     logging.info(f'Client {tid} Exit')
 
-    # remove from rooms
-    auth = self.sock_auth.get(sock)
+    if self.capture is not None:
+      self.capture.record('closed', tid)
 
-    if auth:
-      for room in self.rooms:
-        if auth in room.listeners_tokens:
-          room.listeners_tokens.remove(auth)
-          room.listeners.remove(self.auths[auth])
+    # remove from rooms, after a grace period: a client that lost its connection reconnects and goes on listening.
+    # Only when it was the user's last connection, a client that already reconnected keeps its room
+    auth = self.sessions.unbind_socket(sock)
 
-      with contextlib.suppress(KeyError):
-        del self.sock_auth[sock]
+    if auth is not None and self.sessions.room_of(auth) is not None and not self.sessions.is_bound(auth):
+      if self.reconnect_grace > 0:
+        self.sessions.hold(auth, self.reconnect_grace)
+      else:
+        self.move_listener(auth, None)
 
     sock.close()
 
@@ -0,0 +1,286 @@
+import collections
+import threading
+import time
+import uuid
+
+
+class SessionRegistry:
+  """
+  Keeps the logged-in users and where they are, with an index for every lookup the routes do:
+  token -> username, username -> token, token -> room id and socket -> token.
+
+  Sessions are saved in the database (with an expiry time) so they survive a restart,
+  and the recently used ones are kept in an in-memory LRU, so checking a token is O(1) most of the time.
+  Rooms and sockets only live in memory.
+  A user whose connection dropped stays in their room for a while (see hold), so a client that reconnects
+  finds everything as it was. A user whose session expired is out of their room (see expired_rooms).
+
+  All the indexes are changed only by the methods here (under one lock) so they always agree.
+  The database is never used while holding the lock, so a slow query (or a flood of unknown tokens,
+  which are remembered for a while as unknown) does not hold up the auth checks of everyone else.
+
+  :param db: The Database the sessions table is in
+  :param ttl: Seconds a session stays valid after its last use
+  :param cache_size: Maximum amount of sessions kept in memory
+  """
+
+  UNKNOWN_TTL = 60  # seconds a token that is not in the database is answered without looking again
+
+  def __init__(self, db, ttl: float = 7 * 24 * 3600, cache_size: int = 10000):
+    self.db = db
+    self.ttl = ttl
+    self.cache_size = cache_size
+
+    self._lock = threading.RLock()
+
+    self._token_user: collections.OrderedDict[str, list] = collections.OrderedDict()  # token -> [username, expires]
+    self._user_token: dict[str, str] = {}
+    self._token_room: dict[str, int] = {}
+    self._sock_token: dict[object, str] = {}
+    self._token_socks: collections.Counter[str] = collections.Counter()  # token -> sockets bound to it
+    self._held: dict[str, float] = {}  # token -> until when it keeps its room without a connection
+    self._unknown: collections.OrderedDict[str, float] = collections.OrderedDict()  # token not in the db -> until
+    self._expired_rooms: dict[str, int] = {}  # expired token -> the room it was in (still to leave)
+
+  def __contains__(self, token):
+    return self.user(token) is not None
+
+  def __len__(self):
+    return len(self._token_user)
+
+  def _cache(self, token: str, username: str, expires: float):
+    """Put a session in the LRU (evicts the least recently used one if full)"""
+    self._token_user[token] = [username, expires]
+    self._token_user.move_to_end(token)
+    self._user_token[username] = token
+
+    while len(self._token_user) > self.cache_size:
+      old_token, (old_username, _) = self._token_user.popitem(last=False)
+      if self._user_token.get(old_username) == old_token:
+        del self._user_token[old_username]
+
+  def _expire(self, token: str):
+    """Forget an expired session, its room is left by whoever calls expired_rooms"""
+    self._uncache(token)
+    self._held.pop(token, None)
+
+    if (room_id := self._token_room.pop(token, None)) is not None:
+      self._expired_rooms[token] = room_id
+
+  def _uncache(self, token: str):
+    if (session := self._token_user.pop(token, None)) is not None:
+      if self._user_token.get(session[0]) == token:
+        del self._user_token[session[0]]
+
+  def _touch(self, token: str, session: list):
+    """Slide the expiry of a used session, the database is written only once per half ttl"""
+    now = time.time()
+
+    with self._lock:
+      if session[1] - now >= self.ttl / 2:
+        return
+      session[1] = expires = now + self.ttl
+
+    self.db.execute("""UPDATE sessions SET expires_at=? WHERE token=?;""", args=(expires, token))
+
+  def _remember_unknown(self, token: str):
+    """A token that is not in the database, the next checks of it don't query again (for a minute)"""
+    with self._lock:
+      self._unknown[token] = time.time() + self.UNKNOWN_TTL
+      self._unknown.move_to_end(token)
+
+      while len(self._unknown) > self.cache_size:
+        self._unknown.popitem(last=False)
+
+  def warm(self):
+    """Load the most recently used valid sessions into memory (after a restart)"""
+    rows = self.db.execute("""
+    SELECT token, username, expires_at FROM sessions WHERE expires_at > ? ORDER BY expires_at DESC LIMIT ?;
+    """, args=(time.time(), self.cache_size), fetchall=True)
+
+    with self._lock:
+      for token, username, expires in reversed(rows):  # most recent last, like in the LRU
+        self._cache(token, username, expires)
+
+    return len(rows)
+
+  def login(self, username: str) -> str:
+    """
+    Get the auth token of a user, a new one (random uuid) if they are not logged in
+    """
+    if (token := self._user_token.get(username)) is not None and self.user(token) is not None:
+      return token
+
+    row = self.db.execute("""
+    SELECT token, expires_at FROM sessions WHERE username=? AND expires_at > ? ORDER BY expires_at DESC LIMIT 1;
+    """, args=(username, time.time()), fetchone=True)
+
+    created = row is None
+    if created:
+      token, expires = str(uuid.uuid4()), time.time() + self.ttl
+      self.db.execute("""INSERT INTO sessions (token, username, expires_at) VALUES (?, ?, ?);""",
+                      args=(token, username, expires))
+    else:
+      token, expires = row
+
+    with self._lock:
+      existing = self._user_token.get(username)
+      won = (existing is None or existing == token or (session := self._token_user.get(existing)) is None
+             or session[1] <= time.time())
+
+      if won:
+        self._unknown.pop(token, None)
+        self._cache(token, username, expires)
+        session = self._token_user[token]
+
+    if not won:  # a login of the same user at the same time cached its token first, everyone gets that one
+      if created:
+        self.db.execute("""DELETE FROM sessions WHERE token=?;""", args=(token,))
+      return existing
+
+    self._touch(token, session)
+    return token
+
+  def logout(self, token: str):
+    """Forget a token and its room (sockets bound to it are forgotten when they disconnect)"""
+    with self._lock:
+      self._uncache(token)
+      self._token_room.pop(token, None)
+      self._held.pop(token, None)
+
+    self.db.execute("""DELETE FROM sessions WHERE token=?;""", args=(token,))
+
+  def user(self, token: str) -> str | None:
+    """The username of a valid token"""
+    if not isinstance(token, str):
+      return None
+
+    with self._lock:
+      if (session := self._token_user.get(token)) is not None:
+        self._token_user.move_to_end(token)
+      elif self._unknown.get(token, 0) > time.time():  # looked up a moment ago, it is not there
+        return None
+
+    if session is None:  # not in memory, maybe in the database (queried without the lock)
+      row = self.db.execute("""SELECT username, expires_at FROM sessions WHERE token=?;""",
+                            args=(token,), fetchone=True)
+
+      if row is None:
+        self._remember_unknown(token)
+        return None
+
+      with self._lock:
+        if (session := self._token_user.get(token)) is None:  # another check may have cached it meanwhile
+          self._cache(token, *row)
+          session = self._token_user[token]
+
+    if session[1] <= time.time():  # expired
+      with self._lock:
+        self._expire(token)
+      return None
+
+    self._touch(token, session)
+    return session[0]
+
+  def token(self, username: str) -> str | None:
+    """The token of a logged-in user (if it is in memory)"""
+    return self._user_token.get(username)
+
+  def room_of(self, token: str) -> int | None:
+    """The room id the token's user is in (None if not in a room)"""
+    return self._token_room.get(token)
+
+  def set_room(self, token: str, room_id: int | None) -> int | None:
+    """
+    Move the token's user to a room (None = no room). Returns the previous room id
+    """
+    if room_id is not None and self.user(token) is None:  # checked before the lock, it may query the database
+      raise KeyError(token)
+
+    with self._lock:
+      previous = self._token_room.pop(token, None)
+
+      if room_id is not None:
+        self._token_room[token] = room_id
+
+      return previous
+
+  def bind_socket(self, sock, token: str):
+    """Remember which token is used on a socket (a held token is back)"""
+    with self._lock:
+      if (previous := self._sock_token.get(sock)) != token:
+        if previous is not None:
+          self._unbind_token(previous)
+
+        self._sock_token[sock] = token
+        self._token_socks[token] += 1
+
+      self._held.pop(token, None)
+
+  def unbind_socket(self, sock) -> str | None:
+    """Forget a socket, returns its token"""
+    with self._lock:
+      if (token := self._sock_token.pop(sock, None)) is not None:
+        self._unbind_token(token)
+      return token
+
+  def _unbind_token(self, token: str):
+    self._token_socks[token] -= 1
+    if self._token_socks[token] <= 0:
+      del self._token_socks[token]
+
+  def is_bound(self, token: str) -> bool:
+    """Whether a connection uses the token (e.g. the client reconnected before the old socket was found dead)"""
+    return self._token_socks.get(token, 0) > 0
+
+  def hold(self, token: str, grace: float) -> bool:
+    """
+    The token's connection dropped: it keeps its room for `grace` seconds, unless it comes back (bind_socket).
+    Not held (returns False) while another connection still uses it
+    """
+    with self._lock:
+      if self.is_bound(token):
+        return False
+
+      self._held[token] = time.time() + grace
+      return True
+
+  def expired_holds(self) -> list[str]:
+    """Forget the holds that are over, returns their tokens (their users should leave their rooms)"""
+    now = time.time()
+
+    with self._lock:
+      expired = [token for token, until in self._held.items() if until <= now]
+
+      for token in expired:
+        del self._held[token]
+
+      return [token for token in expired if not self.is_bound(token)]  # came back meanwhile
+
+  def expired_rooms(self) -> list[tuple[str, int]]:
+    """The sessions that expired while in a room since the last call: (token, room id), their users should leave"""
+    with self._lock:
+      expired = list(self._expired_rooms.items())
+      self._expired_rooms.clear()
+      return expired
+
+  def sweep(self, limit: int = 500) -> int:
+    """
+    Delete up to `limit` expired sessions (call it once in a while). Returns how many were deleted
+    """
+    now = time.time()
+
+    expired = self.db.execute("""SELECT token FROM sessions WHERE expires_at <= ? LIMIT ?;""",
+                              args=(now, limit), fetchall=True)
+
+    if not expired:
+      return 0
+
+    with self._lock:
+      for token, in expired:
+        self._expire(token)
+
+    self.db.execute(f"""DELETE FROM sessions WHERE token IN ({', '.join('?' * len(expired))});""",
+                    args=[token for token, in expired])
+
+    return len(expired)
@@ -1,19 +1,12 @@
-import sqlite3
+from db import Database
 
-# create the sqlite database file and connect to it
-conn = sqlite3.connect('database.db')
+# create the sqlite database file and bring its schema up to date
+db = Database('database.db')
+applied = db.migrate()
+renamed = db.renamed_users() if applied else []  # reported once, when it happens
+db.close()
 
-cur = conn.cursor()
+for user_id, old, new in renamed:
+  print(f'Duplicated username: user {user_id} "{old}" is now "{new}"')
 
-# setup the users table
-cur.execute("""DROP TABLE IF EXISTS users;""")
-cur.execute("""
-CREATE TABLE users (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  username TEXT NOT NULL,
-  password TEXT NOT NULL
-);
-""")
-
-cur.close()
-conn.close()
+print(f'Database is ready ({applied} migrations applied)')
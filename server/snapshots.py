@@ -0,0 +1,135 @@
+import json
+import os
+import struct
+import threading
+import time
+
+RECORD_HEADER = struct.Struct('!I')  # length of the json record that follows
+
+
+def room_state(room) -> dict:
+  """The part of a room that is worth keeping over a restart"""
+  playback = room.playback
+  playing = bool(playback.song.get('id'))  # a loading song (⏳) has no id, it is not kept
+
+  return {
+    "id": room.id,
+    "queue": room.queue.to_list(),
+    "current_song": playback.song if playing else {},
+    "start_time": playback.start_time if playing else None,
+    "duration": playback.duration if playing else None,
+    "audio_path": playback.audio_path if playing else None,
+    "audio_hash": playback.audio_hash if playing else None,
+  }
+
+
+class RoomJournal:
+  """
+  Append-only journal of the rooms state.
+
+  Every write appends only the rooms that changed since the last write ([4 bytes length][json] records).
+  Only the rooms whose version moved since they were written are looked at (rooms.Room.version), and when the file is mostly old records it is compacted to one record per room.
+  The file's modification time marks the last write, so a restore knows how far every song had played.
+
+  :param path: The journal file
+  :param compact_every: Compact when the journal has this many records per room
+  """
+
+  def __init__(self, path: str = 'rooms.journal', compact_every: int = 20):
+    self.path = path
+    self.compact_every = compact_every
+
+    self._written: dict[int, dict] = {}  # room id -> last state in the journal
+    self._versions: dict[int, int] = {}  # room id -> the room version that state is of
+    self._records = 0
+    self._lock = threading.Lock()
+
+  def load(self) -> tuple[dict[int, dict], float]:
+    """
+    Read the journal. Returns the latest state of every room and the time of the last write
+    """
+    states = {}
+
+    if not os.path.exists(self.path):
+      return states, time.time()
+
+    with open(self.path, 'rb') as f:
+      data = f.read()
+      saved_at = os.fstat(f.fileno()).st_mtime
+
+    records = 0
+    k = 0
+    while k + RECORD_HEADER.size <= len(data):
+      length, = RECORD_HEADER.unpack_from(data, k)
+      k += RECORD_HEADER.size
+
+      if k + length > len(data):  # cut in the middle of a write, ignore it
+        break
+
+      state = json.loads(data[k:k + length])
+      k += length
+      records += 1
+
+      if state.get('deleted'):
+        states.pop(state['id'], None)
+      else:
+        states[state['id']] = state
+
+    with self._lock:
+      self._written = dict(states)
+      self._records = records  # the old records are in the file until it is compacted
+
+    return states, saved_at
+
+  def write(self, rooms) -> int:
+    """
+    Append the rooms that changed since the last write. Returns how many records were appended
+    """
+    with self._lock:
+      changed = []
+
+      ids = set()
+
+      for room in rooms:
+        ids.add(room.id)
+
+        if self._versions.get(room.id) == (version := room.version):  # read before the state, so it is not newer
+          continue
+
+        state = room_state(room)
+        self._versions[room.id] = version
+
+        if self._written.get(room.id) != state:
+          changed.append(state)
+          self._written[room.id] = state
+
+      for room_id in self._written.keys() - ids:  # reclaimed rooms
+        changed.append({"id": room_id, "deleted": True})
+        del self._written[room_id]
+        self._versions.pop(room_id, None)
+
+      if self._records + len(changed) > self.compact_every * max(1, len(self._written)):
+        self._compact()
+      elif changed:
+        with open(self.path, 'ab') as f:
+          f.write(b''.join(self._record(state) for state in changed))
+        self._records += len(changed)
+      elif os.path.exists(self.path):
+        os.utime(self.path)  # nothing changed, but the songs kept on playing until now
+
+      return len(changed)
+
+  @staticmethod
+  def _record(state: dict) -> bytes:
+    data = json.dumps(state, separators=(',', ':')).encode()
+    return RECORD_HEADER.pack(len(data)) + data
+
+  def _compact(self):
+    """Rewrite the journal with one record for every room"""
+    tmp = self.path + '.tmp'
+
+    with open(tmp, 'wb') as f:
+      f.write(b''.join(self._record(state) for state in self._written.values()))
+
+    os.replace(tmp, self.path)
+    self._records = len(self._written)
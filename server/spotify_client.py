@@ -0,0 +1,176 @@
+import collections
+import logging
+import threading
+import time
+
+import requests
+import spotipy
+from urllib3.util.retry import Retry
+
+from utils import percentile
+
+
+def build_session() -> requests.Session:
+  """
+  A requests session for spotipy that retries only 5xx errors.
+  429 is left to RateLimitedSpotify, so one throttled call does not hold its thread for the whole Retry-After
+  """
+  session = requests.Session()
+  retry = Retry(total=3, read=False, allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+                backoff_factor=0.3, status_forcelist=(500, 502, 503, 504), respect_retry_after_header=False)
+
+  adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+  session.mount('http://', adapter)
+  session.mount('https://', adapter)
+
+  return session
+
+
+class TokenBucket:
+  """
+  A thread safe token bucket.
+
+  :param rate: How many tokens are added every second
+  :param capacity: Maximum amount of tokens (burst size)
+  """
+
+  def __init__(self, rate: float, capacity: int):
+    self.rate = rate
+    self.capacity = capacity
+
+    self._tokens = float(capacity)
+    self._last = time.monotonic()
+    self._lock = threading.Lock()
+
+  def _refill(self):
+    now = time.monotonic()
+    self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+    self._last = now
+
+  def acquire(self):
+    """
+    Take a token, sleep until one is available (BLOCKING)
+    """
+    while True:
+      with self._lock:
+        self._refill()
+
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return
+
+        wait = (1 - self._tokens) / self.rate
+
+      time.sleep(wait)
+
+
+class RateLimitedSpotify:
+  """
+  Wraps a spotipy.Spotify object so all the client threads can share it safely.
+
+  - at most `max_concurrency` requests are sent at the same time
+  - requests are spread by a token bucket (`rate` per second, `burst` at once)
+  - a 429 response blocks everyone until the Retry-After is over, then the call is retried
+
+  :param api: The spotipy object to send the requests with
+  """
+
+  def __init__(self, api: spotipy.Spotify, max_concurrency: int = 4, rate: float = 10, burst: int = 20,
+               max_retries: int = 3):
+    self.api = api
+    self.max_retries = max_retries
+
+    self._gate = threading.BoundedSemaphore(max_concurrency)
+    self._bucket = TokenBucket(rate, burst)
+
+    self._blocked_until = 0  # monotonic time, set by a 429
+    self._lock = threading.Lock()
+
+    # metrics
+    self._waiting = 0
+    self._in_flight = 0
+    self._max_waiting = 0
+    self._calls = 0
+    self._throttled = 0
+    self._waits = collections.deque(maxlen=1000)  # seconds each call waited before it was sent
+
+  def _wait_turn(self):
+    """
+    Block until the call is allowed to be sent (concurrency gate, token bucket and Retry-After)
+    """
+    self._gate.acquire()
+
+    try:
+      while (delay := self._blocked_until - time.monotonic()) > 0:
+        time.sleep(delay)
+
+      self._bucket.acquire()
+    except BaseException:
+      self._gate.release()
+      raise
+
+  def call(self, method: str, *args, **kwargs):
+    """
+    Call a spotipy method by its name, respecting the limits
+    """
+    fun = getattr(self.api, method)
+
+    for attempt in range(self.max_retries + 1):
+      start = time.monotonic()
+
+      with self._lock:
+        self._waiting += 1
+        self._max_waiting = max(self._max_waiting, self._waiting)
+
+      try:
+        self._wait_turn()
+      finally:
+        with self._lock:
+          self._waiting -= 1
+
+      with self._lock:
+        self._waits.append(time.monotonic() - start)
+        self._in_flight += 1
+        self._calls += 1
+
+      try:
+        return fun(*args, **kwargs)
+      except spotipy.SpotifyException as e:
+        if e.http_status != 429 or attempt == self.max_retries:
+          raise
+
+        retry_after = float((e.headers or {}).get('Retry-After', 1))
+        logging.warning(f'Spotify rate limit hit, waiting {retry_after}s (attempt {attempt + 1})')
+
+        with self._lock:
+          self._throttled += 1
+          self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+      finally:
+        with self._lock:
+          self._in_flight -= 1
+        self._gate.release()
+
+  def search(self, *args, **kwargs):
+    return self.call('search', *args, **kwargs)
+
+  def track(self, *args, **kwargs):
+    return self.call('track', *args, **kwargs)
+
+  def stats(self) -> dict:
+    """
+    Current queue depth and wait time metrics
+    """
+    with self._lock:
+      waits = list(self._waits)
+
+      return {
+        "waiting": self._waiting,
+        "max_waiting": self._max_waiting,
+        "in_flight": self._in_flight,
+        "calls": self._calls,
+        "throttled": self._throttled,
+        "blocked_for": max(0, self._blocked_until - time.monotonic()),
+        "wait_p50": percentile(waits, 50),
+        "wait_p99": percentile(waits, 99),
+        "wait_max": max(waits, default=0),
+      }
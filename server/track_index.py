@@ -0,0 +1,170 @@
+import collections
+import re
+import sqlite3
+import threading
+import time
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize_query(query: str) -> str:
+  """Lowercase the query and keep only its words ("Hey,  Jude!" -> "hey jude")"""
+  return ' '.join(TOKEN_RE.findall(query.lower()))
+
+
+def fts_query(query: str) -> str:
+  """
+  Build a FTS5 match expression where every word is a prefix (hey jud -> "hey"* "jud"*)
+  """
+  return ' '.join(f'"{token}"*' for token in normalize_query(query).split())
+
+
+class TrackIndex:
+  """
+  A local full text index of every track the server has seen (searches and queues).
+  It is kept in an SQLite FTS5 table with prefix indexes, so searches can be answered without Spotify.
+
+  :param path: The sqlite file of the index
+  :param query_ttl: For how many seconds a query that was answered by Spotify is trusted to the index
+  :param cache_size: How many answered lookups are kept in memory (typing sends the same prefixes again and again)
+  """
+
+  def __init__(self, path: str = 'tracks.db', query_ttl: float = 7 * 24 * 3600, cache_size: int = 1024):
+    self.query_ttl = query_ttl
+    self.cache_size = cache_size
+    # (query, limit) -> (songs, answered by spotify at, or None if by the index)
+    self._cache: collections.OrderedDict[tuple[str, int], tuple[list[dict], float | None]] = collections.OrderedDict()
+
+    self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    self.lock = threading.Lock()
+
+    with self.lock:
+      self.conn.execute("""PRAGMA journal_mode=WAL;""")
+      self.conn.executescript("""
+      CREATE TABLE IF NOT EXISTS tracks (
+        rowid INTEGER PRIMARY KEY,
+        id TEXT UNIQUE NOT NULL,
+        title TEXT NOT NULL,
+        artist TEXT NOT NULL,
+        image_url TEXT NOT NULL
+      );
+
+      -- the words index, its content is the tracks table (kept in sync by the triggers)
+      CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+        title, artist, content='tracks', content_rowid='rowid', prefix='2 3 4'
+      );
+
+      CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+        INSERT INTO tracks_fts (rowid, title, artist) VALUES (new.rowid, new.title, new.artist);
+      END;
+      CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN
+        INSERT INTO tracks_fts (tracks_fts, rowid, title, artist) VALUES ('delete', old.rowid, old.title, old.artist);
+      END;
+      CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE ON tracks BEGIN
+        INSERT INTO tracks_fts (tracks_fts, rowid, title, artist) VALUES ('delete', old.rowid, old.title, old.artist);
+        INSERT INTO tracks_fts (rowid, title, artist) VALUES (new.rowid, new.title, new.artist);
+      END;
+      """)
+      self.conn.execute("""
+      CREATE TABLE IF NOT EXISTS queries (
+        query TEXT PRIMARY KEY,
+        searched_at REAL NOT NULL
+      );""")
+
+  def add(self, songs: list[dict]):
+    """
+    Add (or update) songs in the index. A song is {"id", "title", "artist", "image_url"}
+    """
+    with self.lock:
+      self.conn.execute("""BEGIN;""")
+      try:
+        for song in songs:
+          self.conn.execute("""
+          INSERT INTO tracks (id, title, artist, image_url) VALUES (?, ?, ?, ?)
+          ON CONFLICT (id) DO UPDATE SET title=excluded.title, artist=excluded.artist, image_url=excluded.image_url;
+          """, (song['id'], song['title'], song['artist'], song['image_url']))
+        self.conn.execute("""COMMIT;""")
+      except Exception:
+        self.conn.execute("""ROLLBACK;""")
+        raise
+      finally:
+        # the index answers may change with the new songs, spotify's stay
+        for key in [key for key, (_, searched_at) in self._cache.items() if searched_at is None]:
+          del self._cache[key]
+
+  def get(self, song_id: str) -> dict | None:
+    """Get a song by its spotify id"""
+    with self.lock:
+      row = self.conn.execute("""SELECT id, title, artist, image_url FROM tracks WHERE id=?;""",
+                              (song_id,)).fetchone()
+
+    return dict(zip(('id', 'title', 'artist', 'image_url'), row)) if row else None
+
+  def search(self, query: str, limit: int = 5) -> list[dict]:
+    """Search songs by title and artist (all the words must match, as prefixes)"""
+    match = fts_query(query)
+
+    if not match:
+      return []
+
+    with self.lock:
+      rows = self.conn.execute("""
+      SELECT t.id, t.title, t.artist, t.image_url FROM tracks_fts JOIN tracks t ON t.rowid = tracks_fts.rowid
+      WHERE tracks_fts MATCH ? ORDER BY bm25(tracks_fts, 2, 1) LIMIT ?;
+      """, (match, limit)).fetchall()
+
+    return [dict(zip(('id', 'title', 'artist', 'image_url'), row)) for row in rows]
+
+  def remember_query(self, query: str, songs: list[dict] = None, limit: int = 5):
+    """
+    Mark a query as fully answered by Spotify (its results are in the index now).
+    With `songs` (Spotify's answer) the next lookups of the query give the same answer
+    """
+    now = time.time()
+
+    with self.lock:
+      self.conn.execute("""INSERT OR REPLACE INTO queries (query, searched_at) VALUES (?, ?);""",
+                        (normalize_query(query), now))
+
+      if songs is not None:
+        self._remember((normalize_query(query), limit), songs, now)
+
+  def _remember(self, key: tuple[str, int], songs: list[dict], searched_at: float | None):
+    self._cache[key] = (songs, searched_at)
+    self._cache.move_to_end(key)
+
+    while len(self._cache) > self.cache_size:
+      self._cache.popitem(last=False)
+
+  def is_known_query(self, query: str) -> bool:
+    """Was this query answered by Spotify lately?"""
+    with self.lock:
+      row = self.conn.execute("""SELECT searched_at FROM queries WHERE query=?;""",
+                              (normalize_query(query),)).fetchone()
+
+    return row is not None and time.time() - row[0] < self.query_ttl
+
+  def lookup(self, query: str, limit: int = 5) -> list[dict] | None:
+    """
+    Answer a search from the index.
+    Returns None when the local results are weak (not enough results for a query Spotify never answered)
+    """
+    key = (normalize_query(query), limit)
+
+    with self.lock:
+      if (cached := self._cache.get(key)) is not None:
+        songs, searched_at = cached
+
+        if searched_at is None or time.time() - searched_at < self.query_ttl:
+          self._cache.move_to_end(key)
+          return songs
+
+    songs = self.search(query, limit)
+
+    if not (len(songs) >= limit or (songs and self.is_known_query(query))):
+      return None
+
+    with self.lock:
+      self._remember(key, songs, None)
+
+    return songs